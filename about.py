@@ -52,14 +52,11 @@ class AboutScreen(BasicScreen):
     PADDING = (40, 20)
     TEXT_FONT_SIZE = "0.5cm"
 
-    def on_enter(self):
+    def build(self):
         scroll_view = ScrollView()
         info_label = TextLabel(text=self.TEXT, font_size=self.TEXT_FONT_SIZE,
                                padding=self.PADDING)
         scroll_view.add_widget(info_label)
         self.add_widget(scroll_view)
 
-    def on_exit(self):
-        self.clear_widgets()
-
 # eof
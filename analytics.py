@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""Vectorized analyses of played sessions.
+
+All functions take sessions as returned by Statistics.load_columns -
+numpy structured array ordered by date with (some of) the columns id,
+date, level, position, shape, success, count and noise."""
+
+__author__ = 'Tomas Novacik'
+
+import numpy
+import unittest
+
+DAYS_PER_WEEK = 7
+# 1970-01-01 was thursday, days since epoch + 3 is 0 on mondays (mod 7)
+MONDAY_OFFSET = 3
+
+
+class TestAnalytics(unittest.TestCase):
+    DTYPE = [("date", "datetime64[ms]"), ("level", numpy.int64),
+             ("success", numpy.float64), ("count", numpy.int64),
+             ("noise", numpy.float64)]
+
+    def _sessions(self, rows):
+        sessions = numpy.empty(len(rows), dtype=self.DTYPE)
+        for col, values in zip(sessions.dtype.names, zip(*rows)):
+            sessions[col] = values
+        return sessions
+
+    def test_rolling_mean(self):
+        means = rolling_mean([1, 2, 3, 4, 5], 2)
+        self.assertEqual(means.tolist(), [1, 1.5, 2.5, 3.5, 4.5])
+        self.assertEqual(rolling_mean([2, 4], 5).tolist(), [2, 3])
+        self.assertEqual(len(rolling_mean([], 3)), 0)
+
+    def test_learning_curves(self):
+        sessions = self._sessions([
+            ("2000-01-01", 1, 0.2, 20, 0.5),
+            ("2000-01-02", 2, 0.4, 20, 0.5),
+            ("2000-01-03", 1, 0.6, 20, 0.5),
+            ("2000-01-04", 1, 0.7, 20, 0.5)])
+        curves = learning_curves(sessions, window=2)
+        self.assertEqual(sorted(curves), [1, 2])
+        self.assertTrue(numpy.allclose(curves[1], [0.2, 0.4, 0.65]))
+        self.assertTrue(numpy.allclose(curves[2], [0.4]))
+
+    def test_weekly_rollup(self):
+        sessions = self._sessions([
+            # monday and sunday of one week, monday of the next one
+            ("2017-01-02T10:00", 1, 0.5, 10, 0.5),
+            ("2017-01-08T23:00", 1, 1.0, 30, 0.5),
+            ("2017-01-09T08:00", 2, 0.2, 20, 0.5)])
+        weeks = weekly_rollup(sessions)
+        self.assertEqual([str(week) for week in weeks["week"]],
+                         ["2017-01-02", "2017-01-09"])
+        self.assertEqual(weeks["sessions"].tolist(), [2, 1])
+        self.assertEqual(weeks["items"].tolist(), [40, 20])
+        self.assertTrue(numpy.allclose(weeks["success"], [0.875, 0.2]))
+
+    def test_weekly_rollup_compacted(self):
+        sessions = numpy.zeros(2, dtype=self.DTYPE + [("sessions",
+                                                       numpy.int64)])
+        sessions["date"] = ["2017-01-02", "2017-01-03"]
+        sessions["count"] = 20
+        sessions["sessions"] = [3, 1]
+        self.assertEqual(weekly_rollup(sessions)["sessions"].tolist(), [4])
+
+    def test_noise_effect(self):
+        sessions = self._sessions([
+            ("2000-01-01", 1, 0.8, 20, 0.3),
+            ("2000-01-02", 1, 0.6, 20, 0.3),
+            ("2000-01-03", 1, 0.4, 20, 0.7),
+            ("2000-01-04", 2, 0.5, 20, 0.3),
+            ("2000-01-05", 2, 0.5, 20, numpy.nan)])
+        effect = noise_effect(sessions)
+        self.assertEqual(effect["level"].tolist(), [1, 1, 2])
+        self.assertTrue(numpy.allclose(effect["noise"], [0.3, 0.7, 0.3]))
+        self.assertEqual(effect["sessions"].tolist(), [2, 1, 1])
+        self.assertTrue(numpy.allclose(effect["success"], [0.7, 0.4, 0.5]))
+        self.assertTrue(numpy.allclose(effect["success_sd"], [0.1, 0, 0]))
+
+
+def rolling_mean(values, window):
+    """Mean of the last 'window' values at every position, fewer values
+    are averaged at the beginning"""
+    values = numpy.asarray(values, dtype=numpy.float64)
+    sums = numpy.cumsum(values)
+    sums[window:] = sums[window:] - sums[:-window]
+    counts = numpy.minimum(numpy.arange(1, len(values) + 1), window)
+    return sums / counts
+
+
+def learning_curves(sessions, window=10):
+    """Returns {level: rolling mean of success rates} in order in which
+    sessions of every level were played"""
+    levels = sessions["level"]
+    return dict((level, rolling_mean(sessions["success"][levels == level],
+                                     window))
+                for level in numpy.unique(levels))
+
+
+def _group(keys):
+    """Returns unique keys, index of the group of every item and sizes of
+    the groups"""
+    unique, groups = numpy.unique(keys, return_inverse=True)
+    return unique, groups, numpy.bincount(groups, minlength=len(unique))
+
+
+def weekly_rollup(sessions):
+    """Returns sessions count, items count and success rate weighted by
+    items count of every week (starting on monday) with a session"""
+    days = sessions["date"].astype("datetime64[D]").astype(numpy.int64)
+    mondays = days - (days + MONDAY_OFFSET) % DAYS_PER_WEEK
+    weeks, groups, counts = _group(mondays)
+    if "sessions" in sessions.dtype.names:
+        # rows rolled up by compaction hold more sessions
+        counts = numpy.bincount(groups, weights=sessions["sessions"],
+                                minlength=len(weeks)).astype(numpy.int64)
+    items = numpy.bincount(groups, weights=sessions["count"],
+                           minlength=len(weeks))
+    success = numpy.bincount(groups,
+                             weights=sessions["success"] * sessions["count"],
+                             minlength=len(weeks))
+    rollup = numpy.empty(len(weeks), dtype=[
+        ("week", "datetime64[D]"), ("sessions", numpy.int64),
+        ("items", numpy.int64), ("success", numpy.float64)])
+    rollup["week"] = weeks.view("datetime64[D]")
+    rollup["sessions"] = counts
+    rollup["items"] = items
+    rollup["success"] = success / items
+    return rollup
+
+
+def noise_effect(sessions, decimals=2):
+    """Returns mean and standard deviation of success rates of every
+    (level, noise) pair, sessions with unknown noise are skipped. Noise
+    levels are rounded to given decimals."""
+    sessions = sessions[~numpy.isnan(sessions["noise"])]
+    keys = numpy.empty(len(sessions), dtype=[("level", numpy.int64),
+                                             ("noise", numpy.float64)])
+    keys["level"] = sessions["level"]
+    keys["noise"] = numpy.round(sessions["noise"], decimals)
+    unique, groups, counts = _group(keys)
+    success = sessions["success"]
+    means = numpy.bincount(groups, weights=success,
+                           minlength=len(unique)) / counts
+    variances = numpy.bincount(groups, weights=(success - means[groups]) ** 2,
+                               minlength=len(unique)) / counts
+    effect = numpy.empty(len(unique), dtype=[
+        ("level", numpy.int64), ("noise", numpy.float64),
+        ("sessions", numpy.int64), ("success", numpy.float64),
+        ("success_sd", numpy.float64)])
+    effect["level"] = unique["level"]
+    effect["noise"] = unique["noise"]
+    effect["sessions"] = counts
+    effect["success"] = means
+    effect["success_sd"] = numpy.sqrt(variances)
+    return effect
+
+# eof
@@ -6,9 +6,27 @@ __author__ = 'Tomas Novacik'
 from kivy.uix.screenmanager import Screen
 
 class BasicScreen(Screen):
-    """Adds configuration property to every screen object on initialization."""
+    """Adds configuration property to every screen object on initialization.
+
+    Widgets of the screen are added by build before the first enter and
+    retained, refresh updates the widgets displaying data on every enter."""
 
     def __init__(self, *args, **kwargs):
         super(BasicScreen, self).__init__(*args, **kwargs)
         self.config = App.get_running_app().config
+        self.built = False
+
+    def build(self):
+        """Add widgets of the screen, called once"""
+        pass
+
+    def refresh(self):
+        """Update data bound widgets, called before every enter"""
+        pass
+
+    def on_pre_enter(self, *args):
+        if not self.built:
+            self.build()
+            self.built = True
+        self.refresh()
 # eof
@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+"""Micro benchmarks of the hot paths, usage: python benchmarks.py [name...]
+
+All benchmarks are run when no name is given."""
+
+__author__ = 'Tomas Novacik'
+
+import collections
+import os
+import random
+import sys
+import timeit
+
+import numpy
+
+BENCHMARKS = collections.OrderedDict()
+
+REPEAT = 5
+
+
+def benchmark(fn):
+    """Registration decorator, benchmark is accessible under function name"""
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def best_time(stmt, number, setup=None):
+    """Returns the best time of one call of stmt in seconds"""
+    timer = timeit.Timer(stmt, setup or (lambda: None))
+    return min(timer.repeat(REPEAT, number)) / number
+
+
+def uncached(query, stats):
+    """Returns function running query(stats) with emptied query cache"""
+    def run():
+        stats.cache.invalidate()
+        query(stats)
+    return run
+
+
+def statistics_queries_of(day, level):
+    """(name, query(stats)) pairs of the queries statistics screens run"""
+    return [
+        ("success_rates(level)",
+         lambda stats: stats.success_rates(level=level)),
+        ("played_levels", lambda stats: stats.played_levels()),
+        ("sessions_played(date)", lambda stats: stats.sessions_played(day)),
+        ("success_rate(date)", lambda stats: stats.success_rate(day)),
+        ("daily_summary(date)", lambda stats: stats.daily_summary(day)),
+        ("success_series", lambda stats: stats.success_series()),
+        ("success_series(level)", lambda stats: stats.success_series(level))]
+
+
+def report(name, seconds, baseline=None):
+    line = "  %-40s %12.2f us" % (name, seconds * 1e6)
+    if baseline is not None:
+        line += "   x%.1f" % (baseline / seconds)
+    print(line)
+
+
+# word shape rendered with font size 3cm is roughly 300x120 pixels
+SHAPE_SIZE = (300, 120)
+NOISE_LEVELS = numpy.linspace(0.5, 0.1, 60)
+
+
+def _shape_buffer():
+    width, height = SHAPE_SIZE
+    buff = numpy.zeros(width * height * 4, dtype=numpy.uint8)
+    # roughly one third of pixels of a rendered text is opaque
+    buff[3::4] = numpy.random.rand(width * height) < 0.3
+    buff[3::4] *= 255
+    return buff
+
+
+class LegacyNoise(object):
+    """Original list based implementation of shape visibility"""
+
+    def __init__(self, buff):
+        self.buff = buff
+        self.visible = []
+        self.invisible = []
+        for index, item in enumerate(buff[3::4]):
+            if item != 0:
+                self.visible.append((index + 1) * 4 - 1)
+        random.shuffle(self.visible)
+
+    def set_visibility(self, visibility):
+        pix_count = len(self.invisible) + len(self.visible)
+        visible_diff = int(visibility * pix_count) - len(self.visible)
+        if visible_diff > 0:
+            for i in range(visible_diff):
+                p_index = self.invisible.pop()
+                self.buff[p_index] = 255
+                self.visible.append(p_index)
+        else:
+            for i in range(visible_diff * -1):
+                p_index = self.visible.pop()
+                self.buff[p_index] = 0
+                self.invisible.append(p_index)
+
+
+@benchmark
+def noise():
+    """One noise animation (60 frames) of a word shape"""
+    from shapes import NoiseMask, opaque_alphas
+
+    buff = _shape_buffer()
+
+    def animate(create_mask):
+        def run():
+            mask = create_mask(buff.copy())
+            for visibility in NOISE_LEVELS:
+                mask.set_visibility(visibility)
+        return run
+
+    legacy = best_time(animate(LegacyNoise), 3)
+    report("list based visibility", legacy)
+    vectorized = best_time(
+        animate(lambda b: NoiseMask(b, opaque_alphas(b))), 30)
+    report("numpy NoiseMask", vectorized, legacy)
+
+
+@benchmark
+def headless_frame():
+    """Headless rendering of one frame of the noise animation"""
+    from headless import HeadlessGrid
+
+    grid = HeadlessGrid("word")
+    grid.show(4, 0)
+    levels = iter(numpy.tile(NOISE_LEVELS, 1000))
+
+    def frame():
+        grid.set_visibility(next(levels))
+        grid.render()
+
+    report("noise step + render (3x3 grid)", best_time(frame, 50))
+    report("show new shape", best_time(lambda: grid.show(4, 1), 50))
+
+
+def legacy_rgba_to_rgb(vals):
+    arr = numpy.fromstring(vals, dtype=numpy.uint8).tolist()
+    del arr[3::4]
+    result = numpy.array(arr, dtype=numpy.uint8)
+    result.shape = [len(result) // 3, 3]
+    return result
+
+
+@benchmark
+def rgba_to_rgb():
+    """Conversion of one 800x600 rgba frame to rgb"""
+    from game import rgba_to_rgb, FrameRecorder
+
+    size = (800, 600)
+    frame = numpy.random.randint(0, 256, size[0] * size[1] * 4)
+    frame = frame.astype(numpy.uint8).tostring()
+    legacy = best_time(lambda: legacy_rgba_to_rgb(frame), 3)
+    report("list based conversion", legacy)
+    report("strided view", best_time(lambda: rgba_to_rgb(frame), 1000),
+           legacy)
+    report("contiguous copy",
+           best_time(lambda: rgba_to_rgb(frame, contiguous=True), 50),
+           legacy)
+    recorder = FrameRecorder(size, 60)
+    capture = best_time(lambda: recorder.capture(frame), 50)
+    report("FrameRecorder.capture (%.0f fps)" % (1 / capture), capture,
+           legacy)
+
+
+@benchmark
+def sequences():
+    """Generation and match rate audit of 10^6 sessions (20 items, 3-back)"""
+    import sequence
+
+    count, history = 10 ** 6, 3
+    length = 20 + history
+
+    def generate():
+        positions, shapes = sequence.generate(count, length, history, seed=1)
+        sequence.match_rates(positions, history)
+        sequence.match_rates(shapes, history)
+
+    elapsed = best_time(generate, 1)
+    report("10^6 sessions (%.1f M sessions/s)" % (count / elapsed / 1e6),
+           elapsed)
+
+
+@benchmark
+def scoring():
+    """Scoring of simulated sessions (20 items, 3-back)"""
+    import sequence
+    import session
+
+    count, history = 10 ** 5, 3
+    length = 20 + history
+    positions, shapes = sequence.generate(count, length, history, seed=1)
+    rand = numpy.random.RandomState(1)
+    p_clicked = rand.random_sample((count, length)) < 0.3
+    s_clicked = rand.random_sample((count, length)) < 0.3
+
+    elapsed = best_time(lambda: session.score(positions, shapes, history,
+                                              p_clicked, s_clicked), 1)
+    report("vectorized score (%.1f M sessions/s)" % (count / elapsed / 1e6),
+           elapsed)
+
+    responses = [(trial + 0.5, session.POSITION)
+                 for trial in xrange(0, length, 3)]
+    elapsed = best_time(lambda: session.run(positions[0], shapes[0], history,
+                                            responses, 1.0), 1000)
+    report("session.run (%.0f sessions/s)" % (1 / elapsed), elapsed)
+
+
+def _legacy_statistics_db(path, rows):
+    """Database with statistics table of schema version 0"""
+    import datetime
+    import sqlite3
+    import statistics
+
+    connection = sqlite3.connect(path)
+    connection.execute(statistics.LEGACY_SCHEMA)
+    rand = numpy.random.RandomState(1)
+    start = datetime.datetime(2000, 1, 1)
+    levels = rand.randint(1, 10, rows)
+    rates = rand.random_sample(rows)
+    connection.executemany(
+        "INSERT INTO statistics VALUES (?, ?, ?, ?, ?, ?)",
+        ((start + datetime.timedelta(minutes=10 * i), int(levels[i]),
+          rates[i], rates[i], rates[i], 20) for i in xrange(rows)))
+    connection.commit()
+    return connection
+
+
+@benchmark
+def statistics_queries():
+    """Statistics queries before and after schema migration"""
+    import datetime
+    import shutil
+    import sqlite3
+    import tempfile
+    from statistics import QueryCache, Statistics
+
+    queries = statistics_queries_of(datetime.datetime(2001, 6, 1), 5)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for rows in [10 ** 5, 10 ** 6]:
+            print("  %s rows" % rows)
+            path = os.path.join(tmp_dir, "%s.sqlite3" % rows)
+            # methods run directly against schema without migrations
+            legacy = Statistics.__new__(Statistics)
+            legacy.connection = _legacy_statistics_db(path, rows)
+            legacy.cache = QueryCache()
+            baselines = {}
+            for name, query in queries:
+                try:
+                    baselines[name] = best_time(uncached(query, legacy), 1)
+                except sqlite3.OperationalError:
+                    # query needs columns added by migrations
+                    baselines[name] = None
+                    print("  %-40s %12s" % ("legacy " + name, "n/a"))
+                    continue
+                report("legacy " + name, baselines[name])
+            legacy.connection.close()
+
+            begin = timeit.default_timer()
+            stats = Statistics(path)
+            report("migration", timeit.default_timer() - begin)
+            for name, query in queries:
+                report("indexed " + name,
+                       best_time(uncached(query, stats), 1), baselines[name])
+            stats.connection.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@benchmark
+def analytics():
+    """Columnar load and vectorized analyses of 10^6 sessions"""
+    import shutil
+    import tempfile
+    import analytics
+    from statistics import Statistics
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "analytics.sqlite3")
+        _legacy_statistics_db(path, 10 ** 6).close()
+        stats = Statistics(path)
+        sessions = stats.load_columns()
+        report("load_columns, all columns",
+               best_time(stats.load_columns, 1))
+        report("load_columns(level, success)", best_time(
+            lambda: stats.load_columns(["level", "success"]), 1))
+        report("learning_curves",
+               best_time(lambda: analytics.learning_curves(sessions), 1))
+        report("weekly_rollup",
+               best_time(lambda: analytics.weekly_rollup(sessions), 1))
+        stats.connection.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@benchmark
+def transfer():
+    """Export and import of 10^6 sessions"""
+    import shutil
+    import tempfile
+    import transfer
+    from statistics import Statistics
+
+    rows = 10 ** 6
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "source.sqlite3")
+        _legacy_statistics_db(path, rows).close()
+        source = Statistics(path)
+        for extension in [transfer.CSV, transfer.JSONL]:
+            path = os.path.join(tmp_dir, "sessions" + extension)
+            begin = timeit.default_timer()
+            transfer.export_sessions(source, path)
+            elapsed = timeit.default_timer() - begin
+            report("export %s (%.0f k rows/s)" % (extension,
+                                                  rows / elapsed / 1e3),
+                   elapsed)
+            target = Statistics(os.path.join(tmp_dir, extension + ".sqlite3"))
+            for name in ["import", "import again"]:
+                begin = timeit.default_timer()
+                transfer.import_sessions(target, path)
+                elapsed = timeit.default_timer() - begin
+                report("%s %s (%.0f k rows/s)"
+                       % (name, extension, rows / elapsed / 1e3), elapsed)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@benchmark
+def concurrent_writes():
+    """Processes adding sessions into one database at once"""
+    import shutil
+    import tempfile
+    import statistics
+
+    sessions = 500
+    for processes in [1, 2, 4, 8]:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "stress.sqlite3")
+            added, elapsed = statistics.stress(path, processes, sessions)
+            report("%s processes (%.0f commits/s)"
+                   % (processes, added / elapsed), elapsed / added)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+@benchmark
+def compaction():
+    """Queries and size of 10 years of daily play before and after
+    rolling sessions up into daily rows"""
+    import datetime
+    import shutil
+    import tempfile
+    from statistics import Statistics
+
+    years = 10
+    sessions_per_day = 8
+    trials = [(trial, trial * 2.0, 1, 2, 0.5, None, True, None)
+              for trial in xrange(20)]
+    start = datetime.datetime(2000, 1, 1)
+    queries = statistics_queries_of(datetime.datetime(2005, 6, 1), 3)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "compaction.sqlite3")
+        stats = Statistics(path)
+        rand = random.Random(1)
+        results = []
+        for i in xrange(years * 365 * sessions_per_day):
+            date = start + datetime.timedelta(
+                days=i // sessions_per_day, hours=i % sessions_per_day)
+            rate = rand.random()
+            results.append((rand.randint(2, 4), rate, rate, rate, 20, date,
+                            trials, 0.5))
+        stats.add_many(results)
+        size = os.path.getsize(path)
+        print("  %s sessions, %.1f MB" % (len(results), size / 1e6))
+        baselines = {}
+        for name, query in queries:
+            baselines[name] = best_time(uncached(query, stats), 1)
+            report("raw " + name, baselines[name])
+        # keep the last year
+        max_age = datetime.timedelta(days=365)
+        now = start + datetime.timedelta(days=years * 365)
+        begin = timeit.default_timer()
+        stats.compact(max_age, now)
+        report("compact", timeit.default_timer() - begin)
+        begin = timeit.default_timer()
+        stats.vacuum()
+        report("vacuum", timeit.default_timer() - begin)
+        print("  compacted %.1f MB (x%.1f)"
+              % (os.path.getsize(path) / 1e6,
+                 size / float(os.path.getsize(path))))
+        for name, query in queries:
+            report("compacted " + name,
+                   best_time(uncached(query, stats), 1), baselines[name])
+        stats.connection.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@benchmark
+def screen_switch():
+    """Menu round trips through statistics and settings screens, widget
+    trees rebuilt on every enter (as before) and retained; needs a
+    window"""
+    import datetime
+    import shutil
+    import tempfile
+    from kivy.clock import Clock
+    from kivy.core.window import Window
+    import main
+    import settings
+    import statistics
+
+    tmp_dir = tempfile.mkdtemp()
+    app = main.NBackApp()
+    app._load_settings()
+    db_name = os.path.join(tmp_dir, statistics.Statistics.DB_NAME)
+    app.stats = statistics.Statistics(db_name)
+    app.stats_loader = statistics.StatisticsLoader(db_name,
+                                                   cache=app.stats.cache)
+    app.stats_loader.start()
+    try:
+        start = datetime.datetime(2000, 1, 1)
+        app.stats.add_many((level, 0.5, 0.5, 0.5, 20,
+                            start + datetime.timedelta(hours=i), None, 0.5)
+                           for i in xrange(1000) for level in [2, 3, 4])
+        screens = dict((screen.name, screen) for screen in [
+            main.MainScreen(name="menu"),
+            statistics.StatisticsScreen(name="statistics"),
+            settings.SettingScreen(name="settings")])
+        state = {"current": screens["menu"]}
+        Window.add_widget(state["current"])
+        state["current"].dispatch("on_pre_enter")
+
+        def switch(name, rebuild):
+            # what screen manager does without transition
+            screen = screens[name]
+            state["current"].dispatch("on_pre_leave")
+            state["current"].dispatch("on_leave")
+            Window.remove_widget(state["current"])
+            if rebuild:
+                screen.clear_widgets()
+                screen.built = False
+            Window.add_widget(screen)
+            screen.dispatch("on_pre_enter")
+            screen.dispatch("on_enter")
+            # layout and text rendering of the next frame
+            Clock.tick_draw()
+            state["current"] = screen
+
+        def round_trip(rebuild):
+            def run():
+                for name in ["statistics", "menu", "settings", "menu"]:
+                    switch(name, rebuild)
+            return run
+
+        baseline = best_time(round_trip(True), 5)
+        report("rebuilt widgets, 4 switches", baseline)
+        report("retained widgets, 4 switches",
+               best_time(round_trip(False), 5), baseline)
+    finally:
+        app.stats_loader.close()
+        shutil.rmtree(tmp_dir)
+
+
+@benchmark
+def tracing():
+    """Overhead of a traced call, disabled and enabled"""
+    from instrumentation import Tracer, traced
+
+    tracer = Tracer()
+
+    def plain():
+        pass
+
+    wrapped = traced("plain", tracer)(plain)
+    number = 100000
+    baseline = best_time(plain, number)
+    report("plain call", baseline)
+    report("traced call, disabled", best_time(wrapped, number))
+    tracer.enable()
+    report("traced call, enabled", best_time(wrapped, number))
+
+
+def main(names):
+    for name in names or BENCHMARKS:
+        print("%s: %s" % (name, BENCHMARKS[name].__doc__))
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+# eof
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+"""Collector of results of many devices and its client.
+
+The collector is an HTTP server storing batches of sessions (with their
+trials) posted as JSON into one statistics database. Devices put results
+into a durable on-disk outbox, a background thread uploads them in
+batches and retries with backoff while the collector is unreachable.
+
+usage: python collector.py [-h] [--host HOST] [--port PORT] [--db DB]"""
+
+__author__ = 'Tomas Novacik'
+
+import os
+# command line arguments belong to the collector, not to kivy
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+
+import argparse
+import BaseHTTPServer
+import datetime
+import httplib
+import json
+import mock
+import random
+import shutil
+import sqlite3 as lite
+import SocketServer
+import tempfile
+import threading
+import unittest
+import urllib2
+
+from kivy.logger import Logger
+
+from statistics import Statistics
+
+SESSIONS_PATH = "/sessions"
+TRIALS_KEY = "trials"
+# keys of a session record, trials are lists of Statistics.TRIALS_COLS
+# values without the session, every record is one session (not rolled up)
+RECORD_COLS = Statistics.TABLE_COLS + [Statistics.NOISE_COL]
+RECORD_KEYS = RECORD_COLS + [TRIALS_KEY]
+
+DEFAULT_PORT = 8765
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+BATCH_SIZE = 100
+REQUEST_TIMEOUT = 10.0
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 300.0
+
+
+class TestCollector(unittest.TestCase):
+    TRIALS = [[0, 0.0, 1, 2, None, None, None, None],
+              [1, 2.0, 1, 3, 0.25, None, True, False]]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "collected.sqlite3")
+        self._start_server()
+        self.outbox = self._outbox()
+
+    def tearDown(self):
+        self.outbox.close()
+        self._stop_server()
+        shutil.rmtree(self.tmp_dir)
+
+    def _start_server(self, port=0):
+        self.server = CollectorServer(("localhost", port), self.db_name)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://localhost:%s%s" % (self.server.server_port,
+                                              SESSIONS_PATH)
+
+    def _stop_server(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def _outbox(self, **kwargs):
+        kwargs.setdefault("min_backoff", 0.01)
+        return Outbox(os.path.join(self.tmp_dir, "outbox.sqlite3"),
+                      self.url, **kwargs)
+
+    def _put(self, outbox, count, level=3):
+        for i in xrange(count):
+            outbox.put(level, 0.8, 0.9, i / 100.0, 20,
+                       datetime.datetime(2000, 1, 1, 0, 0, i),
+                       trials=self.TRIALS, noise=0.5)
+
+    def _stored(self, table=Statistics.TABLE_NAME):
+        stats = Statistics(self.db_name)
+        q = "SELECT COUNT(*) FROM %s" % table
+        count = stats.connection.execute(q).fetchone()[0]
+        stats.connection.close()
+        return count
+
+    def test_upload(self):
+        self.outbox.start()
+        self._put(self.outbox, 5)
+        self.assertTrue(self.outbox.flush(timeout=10))
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(self._stored(), 5)
+        self.assertEqual(self._stored(Statistics.TRIALS_TABLE_NAME), 10)
+
+    def test_batches(self):
+        self._put(self.outbox, 5)
+        self.outbox.batch_size = 2
+        self.outbox.start()
+        self.assertTrue(self.outbox.flush(timeout=10))
+        self.assertEqual(self.outbox.uploads, 3)
+        self.assertEqual(self._stored(), 5)
+
+    def test_duplicates_skipped(self):
+        record = session_record(3, 0.8, 0.9, 0.7, 20,
+                                datetime.datetime(2000, 1, 1))
+        body = json.dumps([record, record])
+        response = json.load(urllib2.urlopen(self.url, body))
+        self.assertEqual(response, {"added": 1})
+        response = json.load(urllib2.urlopen(self.url, body))
+        self.assertEqual(response, {"added": 0})
+
+    def test_invalid_request(self):
+        for body in ["not json", json.dumps([{"level": 3}])]:
+            try:
+                urllib2.urlopen(self.url, body)
+            except urllib2.HTTPError as e:
+                self.assertEqual(e.code, 400)
+            else:
+                self.fail("Invalid request accepted")
+
+    def test_rejected_record(self):
+        """Record refused by the collector does not block the others"""
+        self._put(self.outbox, 2)
+        self.outbox.connection.execute(
+            "INSERT INTO %s (record) VALUES (?)" % Outbox.TABLE_NAME,
+            (json.dumps({"level": 3}),))
+        self.outbox.connection.commit()
+        self._put(self.outbox, 4, level=4)
+        self.outbox.batch_size = 4
+        self.outbox.start()
+        self.assertTrue(self.outbox.flush(timeout=10))
+        self.assertEqual(self._stored(), 6)
+        self.assertEqual(self.outbox.rejected, 1)
+        q = "SELECT record FROM %s" % Outbox.REJECTED_TABLE_NAME
+        self.assertEqual([json.loads(row[0]) for row in
+                          self.outbox.connection.execute(q)],
+                         [{"level": 3}])
+
+    def test_database_error(self):
+        locked = lite.OperationalError("database is locked")
+        with mock.patch.object(Statistics, "add_many", side_effect=locked):
+            record = session_record(3, 0.8, 0.9, 0.7, 20,
+                                    datetime.datetime(2000, 1, 1))
+            try:
+                urllib2.urlopen(self.url, json.dumps([record]))
+            except urllib2.HTTPError as e:
+                self.assertEqual(e.code, 503)
+            else:
+                self.fail("Error not reported")
+
+    def test_broken_response(self):
+        """Connection closed by the collector is retried"""
+        self.outbox.start()
+        with mock.patch.object(Statistics, "add_many",
+                               side_effect=RuntimeError):
+            self._put(self.outbox, 1)
+            self.assertFalse(self.outbox.flush(timeout=0.3))
+        self.assertTrue(self.outbox.failures > 0)
+        self.assertTrue(self.outbox.flush(timeout=10))
+        self.assertEqual(self._stored(), 1)
+
+    def test_collector_down(self):
+        """Results stay in outbox until the collector is available"""
+        port = self.server.server_port
+        self._stop_server()
+        self.outbox.start()
+        self._put(self.outbox, 3)
+        self.assertFalse(self.outbox.flush(timeout=0.3))
+        self.assertTrue(self.outbox.failures > 0)
+        # outbox survives restart of the application
+        self.outbox.close()
+        self.outbox = self._outbox()
+        self.assertEqual(len(self.outbox), 3)
+        self._start_server(port)
+        self.outbox.start()
+        self.assertTrue(self.outbox.flush(timeout=10))
+        self.assertEqual(self._stored(), 3)
+
+
+def session_record(level, position, shape, success, item_count, date,
+                   trials=None, noise=None):
+    """Returns JSON serializable record of a session"""
+    values = [date, level, position, shape, success, item_count, noise]
+    record = dict(zip(RECORD_COLS, values))
+    # dates are sent in the format sqlite stores them
+    record[Statistics.DATE_COL] = str(date)
+    record[TRIALS_KEY] = None if trials is None else [list(trial)
+                                                      for trial in trials]
+    return record
+
+
+def _record_result(record):
+    """Convert record to arguments of Statistics.add_many"""
+    if set(record) != set(RECORD_KEYS):
+        raise ValueError("Record keys must be %s." % ", ".join(RECORD_KEYS))
+    return (record[Statistics.LEVEL_COL], record[Statistics.POSITION_COL],
+            record[Statistics.SHAPE_COL], record[Statistics.SUCCESS_COL],
+            record[Statistics.COUNT_COL], record[Statistics.DATE_COL],
+            record[TRIALS_KEY], record[Statistics.NOISE_COL])
+
+
+class CollectorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Accepts POST of JSON list of session records, responds with count
+    of added sessions - sessions stored already are skipped, so a batch
+    can be safely sent again"""
+
+    def do_POST(self):
+        if self.path != SESSIONS_PATH:
+            self.send_error(404)
+            return
+        length = int(self.headers.getheader("content-length", 0))
+        if length > MAX_BODY_SIZE:
+            self.send_error(413)
+            return
+        try:
+            results = [_record_result(record)
+                       for record in json.loads(self.rfile.read(length))]
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_error(400, str(e))
+            return
+        # every request is handled by its own thread and connection
+        stats = Statistics(self.server.db_name)
+        try:
+            added = stats.add_many(results, skip_stored=True)
+        except lite.Error as e:
+            # e.g. database locked for too long, client sends it again
+            Logger.exception("Collector: cannot store sessions")
+            self.send_error(503, str(e))
+            return
+        finally:
+            stats.connection.close()
+        body = json.dumps({"added": added})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        Logger.debug("Collector: " + format % args)
+
+
+class CollectorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, db_name):
+        # tables are migrated before the first request
+        Statistics(db_name).connection.close()
+        self.db_name = db_name
+        BaseHTTPServer.HTTPServer.__init__(self, address, CollectorHandler)
+
+    def handle_error(self, request, client_address):
+        Logger.exception("Collector: request of %s:%s failed"
+                         % client_address)
+
+
+class Outbox(threading.Thread):
+    """Durable queue of results waiting for upload to the collector.
+
+    Results are stored in own sqlite database, they are deleted after the
+    collector confirms them. Failed uploads are retried after exponentially
+    growing delay (with jitter). Records the collector refuses (client
+    error responses) are moved to the rejected table, so they do not
+    block the others."""
+
+    TABLE_NAME = "outbox"
+    REJECTED_TABLE_NAME = "rejected"
+
+    def __init__(self, db_name, url, batch_size=BATCH_SIZE,
+                 min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF):
+        super(Outbox, self).__init__(name="Outbox")
+        self.daemon = True
+        self.db_name = db_name
+        self.url = url
+        self.batch_size = batch_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.uploads = 0
+        self.failures = 0
+        self.rejected = 0
+        # records up to this id are uploaded one by one to find the one
+        # refused by the collector
+        self._split_until = 0
+        self._wakeup = threading.Event()
+        self._empty = threading.Event()
+        self._stopped = False
+        self._lock = threading.Lock()
+        # connection is shared by the caller and the uploading thread,
+        # accesses are serialized by the lock
+        self.connection = lite.connect(db_name, check_same_thread=False)
+        q = "CREATE TABLE IF NOT EXISTS %s (id integer PRIMARY KEY" \
+            " AUTOINCREMENT, record text)"
+        self.connection.execute(q % self.TABLE_NAME)
+        self.connection.execute(q % self.REJECTED_TABLE_NAME)
+        self.connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            q = "SELECT COUNT(*) FROM %s" % self.TABLE_NAME
+            return self.connection.execute(q).fetchone()[0]
+
+    def put(self, level, position, shape, success, item_count, date,
+            trials=None, noise=None):
+        """Store result, it is committed to disk before return"""
+        record = json.dumps(session_record(level, position, shape, success,
+                                           item_count, date, trials, noise))
+        with self._lock:
+            self.connection.execute("INSERT INTO %s (record) VALUES (?)"
+                                    % self.TABLE_NAME, (record,))
+            self.connection.commit()
+            self._empty.clear()
+        self._wakeup.set()
+
+    def flush(self, timeout=None):
+        """Wait until all results are uploaded, returns False on timeout"""
+        self._wakeup.set()
+        return self._empty.wait(timeout)
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self.is_alive():
+            self.join()
+        self.connection.close()
+
+    def _next_batch(self):
+        q = "SELECT id, record FROM %s ORDER BY id LIMIT ?" % self.TABLE_NAME
+        with self._lock:
+            rows = self.connection.execute(q, (self.batch_size,)).fetchall()
+            if not rows:
+                self._empty.set()
+        if rows and rows[0][0] <= self._split_until:
+            return rows[:1]
+        return rows
+
+    def _upload(self, rows):
+        body = "[%s]" % ", ".join(record for _, record in rows)
+        request = urllib2.Request(self.url, body,
+                                  {"Content-Type": "application/json"})
+        urllib2.urlopen(request, timeout=REQUEST_TIMEOUT).read()
+        with self._lock:
+            self.connection.execute("DELETE FROM %s WHERE id <= ?"
+                                    % self.TABLE_NAME, (rows[-1][0],))
+            self.connection.commit()
+        self.uploads += 1
+
+    def _reject(self, rows, error):
+        if len(rows) > 1:
+            Logger.warning("Outbox: batch refused by collector (%s),"
+                           " uploading records one by one" % error)
+            self._split_until = rows[-1][0]
+            return
+        Logger.error("Outbox: record %s refused by collector (%s), moved"
+                     " to %s table" % (rows[0][0], error,
+                                       self.REJECTED_TABLE_NAME))
+        with self._lock:
+            self.connection.execute("INSERT INTO %s SELECT * FROM %s"
+                                    " WHERE id = ?"
+                                    % (self.REJECTED_TABLE_NAME,
+                                       self.TABLE_NAME), (rows[0][0],))
+            self.connection.execute("DELETE FROM %s WHERE id = ?"
+                                    % self.TABLE_NAME, (rows[0][0],))
+            self.connection.commit()
+        self.rejected += 1
+
+    def run(self):
+        backoff = self.min_backoff
+        while not self._stopped:
+            rows = self._next_batch()
+            if not rows:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                self._upload(rows)
+                backoff = self.min_backoff
+            except urllib2.HTTPError as e:
+                if 400 <= e.code < 500:
+                    # sending the same records again would not help
+                    self._reject(rows, e)
+                else:
+                    self._failed(e, backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+            except (urllib2.URLError, httplib.HTTPException, IOError) as e:
+                # HTTPException when the collector closes the connection
+                self._failed(e, backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def _failed(self, error, backoff):
+        self.failures += 1
+        Logger.warning("Outbox: upload failed (%s), next attempt in %.1f s"
+                       % (error, backoff))
+        self._wakeup.wait(backoff * random.uniform(0.5, 1.5))
+        self._wakeup.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--db", default="collected.sqlite3",
+                        help="statistics database to store results into")
+    args = parser.parse_args()
+    server = CollectorServer((args.host, args.port), args.db)
+    print("Collecting results on http://%s:%s%s"
+          % (args.host, server.server_port, SESSIONS_PATH))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
+
+# eof
@@ -17,6 +17,7 @@ from kivy.core.window import Window
 from kivy.properties import NumericProperty, ObjectProperty
 from kivy.uix.anchorlayout import AnchorLayout
 from kivy.clock import Clock
+from kivy.logger import Logger
 from kivy.graphics import Color, Rectangle
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button
@@ -25,12 +26,15 @@ from kivy.uix.label import Label
 from kivy.uix.popup import Popup
 from kivy.uix.widget import Widget
 
+import sequence
 from basic_screen import BasicScreen
+from instrumentation import traced
+from session import Session, TrialLog, POSITION, SHAPE
 from shapes import Shapes
+from timeline import Timeline, ONSET, CLEAR, EVALUATE, FINISH
 
 
 # TODO too much code duplication
-# TODO there should be separate class for statistics
 # reformat using test generating approach
 class TestGameEvaluation(unittest.TestCase):
 
@@ -42,70 +46,85 @@ class TestGameEvaluation(unittest.TestCase):
         self.game = GameLayout()
         self.game._get_config_vals = mock.MagicMock()
         self.game.build()
-        self.game.positions = [self.PREV_POSITION]
-        self.game.shapes = [self.PREV_SHAPE]
-        self.game.a_shape = self.PREV_SHAPE
-        self.game.a_position = self.PREV_POSITION
+        self.game.session = Session(history=1)
+        self.game.session.present(self.PREV_POSITION, self.PREV_SHAPE)
+
+    def _present(self, position=PREV_POSITION, shape=PREV_SHAPE):
+        self.game.session.present(position, shape)
 
     def _game_eval(self):
         # eval must be called with some delta time
         self.game._evaluate(self.GUI_DT)
 
     def test_mistake_shape_clicked(self):
-        self.game.a_shape = self.PREV_SHAPE + 1
-        self.game.n_clicked = True
+        self._present(shape=self.PREV_SHAPE + 1)
+        self.game.shape_callback(None)
         self._game_eval()
         self.assertTrue(self.game.n_err)
 
     def test_mistake_shape_not_clicked(self):
-        self.game.a_shape = self.PREV_SHAPE
-        self.game.n_clicked = False
+        self._present(shape=self.PREV_SHAPE)
         self._game_eval()
         self.assertTrue(self.game.n_err)
 
     def test_mistake_position_clicked(self):
-        self.game.a_position = self.PREV_POSITION + 1
-        self.game.p_clicked = True
+        self._present(position=self.PREV_POSITION + 1)
+        self.game.position_callback(None)
         self._game_eval()
         self.assertTrue(self.game.p_err)
 
     def test_mistake_position_not_clicked(self):
-        self.game.a_position = self.PREV_POSITION
-        self.game.p_clicked = False
+        self._present(position=self.PREV_POSITION)
         self._game_eval()
         self.assertTrue(self.game.p_err)
 
     def test_success_position_clicked(self):
-        self.game.a_position = self.PREV_POSITION
-        self.game.p_clicked = True
+        self._present(position=self.PREV_POSITION)
+        self.game.position_callback(None)
         self._game_eval()
         self.assertFalse(self.game.p_err)
 
     def test_success_position_not_clicked(self):
-        self.game.a_position = self.PREV_POSITION + 1
-        self.game.p_clicked = False
+        self._present(position=self.PREV_POSITION + 1)
         self._game_eval()
         self.assertFalse(self.game.p_err)
 
     def test_success_shape_clicked(self):
-        self.game.a_shape = self.PREV_SHAPE
-        self.game.n_clicked = True
+        self._present(shape=self.PREV_SHAPE)
+        self.game.shape_callback(None)
         self._game_eval()
         self.assertFalse(self.game.n_err)
 
     def test_success_shape_not_clicked(self):
-        self.game.a_shape = self.PREV_SHAPE + 1
-        self.game.n_clicked = False
+        self._present(shape=self.PREV_SHAPE + 1)
         self._game_eval()
         self.assertFalse(self.game.n_err)
 
 
+class TestGameScreen(unittest.TestCase):
+
+    def test_random_shape_type_per_session(self):
+        screen = mock.Mock(_games={})
+        screen.config.get.return_value = Shapes.RANDOM_TYPE_STR
+        types = list(Shapes.TYPES.values())[:2]
+        with mock.patch("game.GameLayout") as layout_cls, \
+                mock.patch("random.choice", side_effect=types):
+            for _ in types:
+                GameScreen.on_enter.__func__(screen)
+        self.assertEqual(set(screen._games), set(types))
+        self.assertEqual(layout_cls.return_value.build.call_args_list,
+                         [mock.call(shape_cls) for shape_cls in types])
+
+
 class GameScreen(BasicScreen):
 
     BACKGROUND_COLOR = [0.6, 0.65, 0.65]
 
     def __init__(self, *args, **kwargs):
         super(GameScreen, self).__init__(*args, **kwargs)
+        # layouts are built once per shape type and reused by next sessions
+        self._games = {}
+        self.game = None
         with self.canvas.before:
             Color(*self.BACKGROUND_COLOR)
             self.rect = Rectangle(size=self.size, pos=self.pos)
@@ -117,30 +136,71 @@ class GameScreen(BasicScreen):
         self.rect.size = instance.size
 
     def on_enter(self, *args):
-        self.game = GameLayout()
-        self.add_widget(self.game)
-        self.game.build()
+        shape_type = self.config.get(GameLayout.GAME_CONFIG_SECTION,
+                                     "shape_type")
+        # random shape type is picked for every session
+        shape_cls = Shapes.get(shape_type)
+        self.game = self._games.get(shape_cls)
+        if self.game is None:
+            self.game = self._games[shape_cls] = GameLayout()
+            self.add_widget(self.game)
+            self.game.build(shape_cls)
+        else:
+            self.add_widget(self.game)
+        self.game.prepare()
         self.game.start()
 
     def on_leave(self, *args):
-        Clock.unschedule(self.game._step)
+        self.game.stop()
         self.clear_widgets()
         self.game = None
 
 RGBA_SIZE = 4
 RGB_SIZE = 3
 
-def rgba_to_rgb(vals):
-        """Converts values from rgba ubyte format to rgb in list format"""
-        if len(vals) % RGBA_SIZE != 0:
-            raise ValueError("Input array formatting is wrong.")
-        arr = numpy.fromstring(vals, dtype=numpy.uint8).tolist()
-        # remove every 4th element (alpha)
-        del arr[RGB_SIZE::RGBA_SIZE]
-        # create new numpy array
-        result = numpy.array(arr, dtype=numpy.uint8)
-        result.shape = [len(result)/RGB_SIZE, RGB_SIZE]
-        return result
+def rgba_to_rgb(vals, contiguous=False, out=None):
+    """Converts values from rgba ubyte format to (pixels, rgb) array.
+
+    Returned array is a strided view on vals - nothing is copied unless
+    contiguous result is requested or out array is given."""
+    if len(vals) % RGBA_SIZE != 0:
+        raise ValueError("Input array formatting is wrong.")
+    rgba = numpy.frombuffer(vals, dtype=numpy.uint8).reshape(-1, RGBA_SIZE)
+    result = rgba[:, :RGB_SIZE]
+    if out is not None:
+        out[...] = result
+        return out
+    if contiguous:
+        return numpy.ascontiguousarray(result)
+    return result
+
+
+class FrameRecorder(object):
+    """Captures rgba frames of given size into preallocated rgb buffer,
+    the oldest frames are overwritten when the buffer is full."""
+
+    def __init__(self, size, capacity):
+        width, height = size
+        self.size = size
+        self.capacity = capacity
+        self.count = 0
+        self._frames = numpy.empty((capacity, width * height, RGB_SIZE),
+                                   dtype=numpy.uint8)
+
+    def capture(self, pixels):
+        """Store rgba ubyte pixels (string, buffer or array)"""
+        rgba_to_rgb(pixels, out=self._frames[self.count % self.capacity])
+        self.count += 1
+
+    def frames(self):
+        """Returns captured frames in chronological order as
+        (frames, height, width, rgb) array"""
+        width, height = self.size
+        stored = min(self.count, self.capacity)
+        start = self.count % self.capacity if self.count > stored else 0
+        order = (numpy.arange(stored) + start) % self.capacity
+        return self._frames[order].reshape(stored, height, width, RGB_SIZE)
+
 
 class TestRgbaToRgb(unittest.TestCase):
 
@@ -168,6 +228,45 @@ class TestRgbaToRgb(unittest.TestCase):
             exception_raised = True
         self.assertTrue(exception_raised, "Exception was not raised.")
 
+    def test_no_copy(self):
+        test_input = numpy.arange(RGBA_SIZE * 4, dtype=numpy.uint8)
+        result = rgba_to_rgb(test_input)
+        self.assertFalse(result.flags.owndata)
+        self.assertTrue(numpy.may_share_memory(result, test_input))
+
+    def test_contiguous(self):
+        test_input = '\x01\x02\x03\x04' * 4
+        result = rgba_to_rgb(test_input, contiguous=True)
+        self.assertTrue(result.flags.c_contiguous)
+        self.assertEqual(result.tolist(), [[1, 2, 3]] * 4)
+
+    def test_out(self):
+        out = numpy.zeros((2, RGB_SIZE), dtype=numpy.uint8)
+        result = rgba_to_rgb('\x01\x02\x03\x04' * 2, out=out)
+        self.assertIs(result, out)
+        self.assertEqual(out.tolist(), [[1, 2, 3]] * 2)
+
+
+class TestFrameRecorder(unittest.TestCase):
+    SIZE = (2, 1)
+
+    def _frame(self, value):
+        return chr(value) * RGBA_SIZE * self.SIZE[0] * self.SIZE[1]
+
+    def test_capture(self):
+        recorder = FrameRecorder(self.SIZE, 3)
+        for value in xrange(2):
+            recorder.capture(self._frame(value))
+        frames = recorder.frames()
+        self.assertEqual(frames.shape, (2, 1, 2, RGB_SIZE))
+        self.assertEqual(frames[:, 0, 0, 0].tolist(), [0, 1])
+
+    def test_oldest_overwritten(self):
+        recorder = FrameRecorder(self.SIZE, 3)
+        for value in xrange(5):
+            recorder.capture(self._frame(value))
+        self.assertEqual(recorder.frames()[:, 0, 0, 0].tolist(), [2, 3, 4])
+
 
 GREEN = (0,1,0,1)
 RED = (1,0,0,1)
@@ -178,15 +277,16 @@ class GameLayout(GridLayout):
     GAME_CONFIG_SECTION = "game"
     POSITION_MATCH_KEYBIND = ord('a')
     SHAPE_MATCH_KEYBIND = ord('f')
-    CLEAR_INTERVAL = 0.2
+    KEY_MODALITIES = {POSITION_MATCH_KEYBIND: POSITION,
+                      SHAPE_MATCH_KEYBIND: SHAPE}
     EVALUATE_INTERVAL = 0.3
     DEFAULT_BUTTON_COLOR = (0.8, 0.8, 0.8, 1)
     BTN_SIZE_HINT = (0.3, 0.3)
-    RAND_RANGE = range(9)
     STATS_POPUP_SIZE_HINT = (.35, .35)
     INFO_LABEL_SIZE_HINT = (.1, .1)
     GRID_SIZE = 9
     MIN_TIME = 0.3
+    MAX_SEED = 2 ** 31
 
     iter = NumericProperty(None)
     p_errors = NumericProperty(None)
@@ -203,23 +303,40 @@ class GameLayout(GridLayout):
         self.start_noise_level = float(self._get_config("start_noise_level"))
         self.final_noise_level = float(self._get_config("final_noise_level"))
         self.shape_type = str(self._get_config("shape_type"))
+        self.position_match_rate = float(
+            self._get_config("position_match_rate"))
+        self.shape_match_rate = float(self._get_config("shape_match_rate"))
 
     def _action_keys(self, window, key, *args):
-        # bind to 'position match' and 'shape match'
-        if key == self.POSITION_MATCH_KEYBIND and not self.p_clicked:
-            self.p_btn.trigger_action()
-        elif key == self.SHAPE_MATCH_KEYBIND and not self.n_clicked:
-            self.n_btn.trigger_action()
+        # timestamp first, before any other work is done
+        timestamp = Clock.time()
+        modality = self.KEY_MODALITIES.get(key)
+        if modality is None:
+            return
+        btn = self.buttons[modality]
+        if not btn.disabled and self.session.respond(modality, timestamp):
+            # response is recorded, button press is only visual feedback
+            btn.trigger_action()
+
+    def _bind_keyboard(self):
+        if not self._keyboard_bound:
+            Window.bind(on_keyboard=self._action_keys)
+            self._keyboard_bound = True
 
-    def build(self):
+    def _unbind_keyboard(self):
+        if self._keyboard_bound:
+            Window.unbind(on_keyboard=self._action_keys)
+            self._keyboard_bound = False
+
+    def build(self, shape_cls=None):
+        """Create widgets of the game with cells of given shape class (by
+        configured shape type if None), the layout is reused by following
+        sessions with the same shape class (see prepare)"""
         self._get_config_vals()
         self.cols = 3
         self.rows = 5
         self.spacing = 5
-        # animate noise application
-        visibility = 1 - self.final_noise_level
-        self.noise_animation = Animation(shape_visibility=visibility,
-                                         duration=self.shape_display_duration)
+        self.actual_cell = None
 
         def create_info_label():
             return Label(size_hint=self.INFO_LABEL_SIZE_HINT)
@@ -248,7 +365,7 @@ class GameLayout(GridLayout):
         self.add_widget(overall_info)
 
         self.cells = []
-        cell_shape_cls = Shapes.get(self.shape_type)
+        cell_shape_cls = shape_cls or Shapes.get(self.shape_type)
         for _ in xrange(self.GRID_SIZE):
             label = cell_shape_cls(self.start_noise_level)
             self.cells.append(label)
@@ -256,80 +373,124 @@ class GameLayout(GridLayout):
 
         self.p_btn = Button(text="A: Position match",
                             size_hint=self.BTN_SIZE_HINT,
-                            on_release=self.position_callback)
+                            on_press=self.position_callback)
         self.add_widget(self.p_btn)
         self.n_btn = Button(text="F: Shape match", size_hint=self.BTN_SIZE_HINT,
-                            on_release=self.shape_callback)
+                            on_press=self.shape_callback)
 
         self.add_widget(self.n_btn)
+        self.buttons = {POSITION: self.p_btn, SHAPE: self.n_btn}
+        self._keyboard_bound = False
+
+        self.level_info = Label(font_size="25sp", markup=True,
+                                size_hint=self.INFO_LABEL_SIZE_HINT)
+        self.add_widget(self.level_info)
 
-        level_info = Label(text="[color=000000]%s-back[/color]" % self.history,
-                           font_size="25sp", markup=True,
-                           size_hint=self.INFO_LABEL_SIZE_HINT)
-        self.add_widget(level_info)
+    def prepare(self):
+        """Apply current configuration and warm up cells before a session"""
+        self._get_config_vals()
+        self.level_info.text = "[color=000000]%s-back[/color]" % self.history
+        # progress info is refreshed with new max_iter when session starts
+        self.iter = 0
+        # animate noise application
+        visibility = 1 - self.final_noise_level
+        self.noise_animation = Animation(shape_visibility=visibility,
+                                         duration=self.shape_display_duration)
+        for cell in self.cells:
+            cell.set_noise_level(self.start_noise_level)
         # disable buttons at the start
-        self.p_btn.disabled = True
-        self.n_btn.disabled = True
+        for btn in self.buttons.values():
+            btn.background_color = self.DEFAULT_BUTTON_COLOR
+            btn.disabled = True
+        self.warm_up()
+
+    @traced("game.warm_up")
+    def warm_up(self):
+        """Rasterize all stimuli and allocate textures of all cells, so the
+        first trials are not slowed down by it"""
+        begin = Clock.time()
+        for cell in self.cells:
+            cell.warm_up()
+        self.warm_up_time = Clock.time() - begin
+        Logger.info("Game: warm-up finished in %.1f ms"
+                    % (self.warm_up_time * 1000))
 
     def position_callback(self, instance):
-        self.p_clicked = True
+        self.session.respond(POSITION, Clock.time())
 
     def shape_callback(self, instance):
-        self.n_clicked = True
-
-    def _rand(self, default_choice, choice_history):
-        """Make items from the past more likely to be selected."""
-        return random.choice(default_choice + choice_history + choice_history)
-
-    def rand_shape(self):
-        return self._rand(self.RAND_RANGE, self.shapes)
-
-    def rand_position(self):
-        return self._rand(self.RAND_RANGE, self.positions)
-
-    def new_cell(self, dt=None):
-        self.a_shape, self.a_position = self.rand_shape(), self.rand_position()
-        self.actual_cell = self.cells[self.a_position]
-        self.actual_cell.set_shape(self.a_shape)
+        self.session.respond(SHAPE, Clock.time())
+
+    def _generate_sequence(self):
+        """Generate stimuli of the whole session up front, session can be
+        reproduced by its seed."""
+        self.seed = random.randrange(self.MAX_SEED)
+        self.seq_positions, self.seq_shapes = sequence.generate_session(
+            self.max_iter, self.history, self.position_match_rate,
+            self.shape_match_rate, self.seed)
+
+    @traced("game.new_cell")
+    def new_cell(self, trial):
+        position = int(self.seq_positions[trial])
+        shape = int(self.seq_shapes[trial])
+        self.session.present(position, shape, Clock.time())
+        self.actual_cell = self.cells[position]
+        self.actual_cell.set_shape(shape)
         self.noise_animation.start(self.actual_cell)
-        self.p_clicked = False
-        self.n_clicked = False
 
     def start(self):
         self.iter = 1
         self.s_errors = 0
         self.p_errors = 0
-        self.tested_positions = 0.0
-        self.tested_shapes = 0.0
-
-        self.p_clicked = False
-        self.n_clicked = False
-
-        self.positions = []
-        self.shapes = []
-
-        Clock.schedule_once(self.new_cell, self.MIN_TIME)
-        Clock.schedule_interval(self._step, self.step_duration)
-        self._schedule_cell_clearing()
-
-    def _evaluate(self, dt):
-        # using xor
-        self.p_err = (self.positions[0] == self.a_position) != self.p_clicked
-        self.n_err = (self.shapes[0] == self.a_shape) != self.n_clicked
-
-        self.p_errors += self.p_err
-        self.s_errors += self.n_err
-
-        self.tested_positions += self.positions[0] == self.a_position
-        self.tested_shapes += self.shapes[0] == self.a_shape
+        self._generate_sequence()
+        self.timeline = Timeline(Clock.time(), self.max_iter, self.history,
+                                 self.step_duration,
+                                 self.shape_display_duration,
+                                 self.EVALUATE_INTERVAL, self.MIN_TIME)
+        # trials are logged in memory, stored at the end of the session
+        self.trial_log = TrialLog(self.max_iter,
+                                  origin=self.timeline.start + self.MIN_TIME)
+        self.session = Session(self.history, log=self.trial_log)
+        self._event_handlers = {ONSET: self._on_onset,
+                                CLEAR: self._clear_cell,
+                                EVALUATE: self._evaluate,
+                                FINISH: self._on_finish}
+        self._schedule_next_event()
+        # one keyboard handler for the whole session
+        self._bind_keyboard()
+
+    def stop(self):
+        Clock.unschedule(self._fire_events)
+        self._unbind_keyboard()
+        if self.actual_cell is not None:
+            self._clear_cell()
+
+    def _schedule_next_event(self):
+        deadline = self.timeline.next_deadline()
+        if deadline is not None:
+            Clock.schedule_once(self._fire_events,
+                                max(deadline - Clock.time(), 0))
+
+    @traced("game.step")
+    def _fire_events(self, dt):
+        for event in self.timeline.due(Clock.time()):
+            self._event_handlers[event.kind](event.trial)
+        self._schedule_next_event()
+
+    @traced("game.evaluate")
+    def _evaluate(self, *largs):
+        outcome = self.session.evaluate()
+        self.p_err = outcome.p_err
+        self.n_err = outcome.s_err
+        self.p_errors = self.session.p_errors
+        self.s_errors = self.session.s_errors
 
         # change buttons background color depending on success/fail
-        if self.positions[0] == self.a_position or self.p_clicked:
+        if outcome.p_match or outcome.p_clicked:
             self.p_btn.background_color = RED if self.p_err else GREEN
-        if self.shapes[0] == self.a_shape or self.n_clicked:
+        if outcome.s_match or outcome.s_clicked:
             self.n_btn.background_color = RED if self.n_err else GREEN
 
-
     def _display_statistics(self, position, shape, success):
         layout = BoxLayout(orientation="vertical")
         msg = self._format_statistics(position, shape, success)
@@ -347,81 +508,33 @@ class GameLayout(GridLayout):
             size_hint=self.STATS_POPUP_SIZE_HINT)
         popup.open()
 
-    def _clear_cell(self, dt):
+    @traced("game.clear_cell")
+    def _clear_cell(self, *largs):
         self.noise_animation.cancel(self.actual_cell)
         self.actual_cell.clear()
 
-    def _schedule_cell_clearing(self):
-        Clock.schedule_once(self._clear_cell, self.shape_display_duration)
-
-    def _on_finish(self):
-        Clock.unschedule(self._step)
-        Window.unbind(on_keyboard=self._action_keys)
+    def _on_finish(self, *largs):
+        self.stop()
         self.p_btn.disabled = True
         self.n_btn.disabled = True
-        position, shape, success = self._compute_statistics()
+        position, shape, success = self.session.statistics()
         App.get_running_app().add_result(self.history, position, shape,
-                                         success, self.iter)
+                                         success, self.iter,
+                                         trials=self.trial_log.rows(),
+                                         noise=self.start_noise_level)
         self._display_statistics(position, shape, success)
 
-    def _compute_statistics(self):
-        if not self.tested_positions:
-            c_position = 100.0
-        else:
-            c_position = (1 - self.p_errors / self.tested_positions) * 100
-
-        if not self.tested_shapes:
-            c_shape = 100.0
-        else:
-            c_shape = (1 - self.s_errors / self.tested_shapes) * 100
-
-        tested_items = self.tested_positions + self.tested_shapes
-        if not tested_items:
-            s_rate = 100.0
-        else:
-            all_errors = self.p_errors + self.s_errors
-            s_rate = 1 - (all_errors / tested_items)
-            s_rate *= 100
-
-        if c_position < 0:
-            c_position = 0
-
-        if c_shape < 0:
-            c_shape = 0
-
-        if s_rate < 0:
-            s_rate = 0
-
-        return c_position, c_shape, s_rate
-
-    def _step(self, dt):
-
-        if self.iter >= self.history and self.iter < self.max_iter:
-            Clock.schedule_once(self._evaluate, dt - self.EVALUATE_INTERVAL)
-
-        if self.iter >= self.max_iter:
-            self._on_finish()
-            return
-        else:
-            self._schedule_cell_clearing()
-
-        if len(self.positions) >= self.history:
-            del(self.positions[0])
-            del(self.shapes[0])
-
-        self.positions.append(self.a_position)
-        self.shapes.append(self.a_shape)
-        self.new_cell()
+    def _on_onset(self, trial):
+        self.new_cell(trial)
 
         # enable buttons if it make sense to click
-        if self.iter >= self.history:
+        if trial >= self.history:
             self.p_btn.background_color = self.DEFAULT_BUTTON_COLOR
             self.n_btn.background_color = self.DEFAULT_BUTTON_COLOR
             self.p_btn.disabled = False
             self.n_btn.disabled = False
-            Window.bind(on_keyboard=self._action_keys)
 
-        self.iter += 1
+        self.iter = trial + 1
 
     def _format_statistics(self, c_position, c_shape, s_rate):
         return "Samples count: %s\n"\
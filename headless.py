@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""Rendering of the game grid into numpy arrays without any window.
+
+Text is not rendered by a font engine (which requires OpenGL context) but
+by a simple numpy rasterizer - every character is a block glyph of the
+same extent as a rendered character. Noise is applied by the same
+NoiseMask as in the application so the per frame cost is comparable."""
+
+__author__ = 'Tomas Novacik'
+
+import numpy
+import unittest
+import zlib
+
+from shapes import (Shapes, NoiseMask, opaque_alphas, glyph_cache,
+                    DEFAULT_NOISE_LEVEL, RGBA_SIZE)
+
+GLYPH_COLS = 5
+GLYPH_ROWS = 7
+GLYPH_SPACING = 1
+
+# roughly '3cm' on a common display
+DEFAULT_FONT_SIZE = 112
+
+
+def rasterize(text, font_size=DEFAULT_FONT_SIZE):
+    """Returns rgba ubyte buffer of the text and its size. Every character
+    is a pseudo random block glyph derived from the character itself."""
+    scale = max(1, int(font_size) // GLYPH_ROWS)
+    glyphs = []
+    for char in text:
+        seed = zlib.crc32(char.encode("utf8")) & 0xffffffff
+        bits = numpy.random.RandomState(seed).rand(GLYPH_ROWS, GLYPH_COLS)
+        glyph = numpy.zeros((GLYPH_ROWS, GLYPH_COLS + GLYPH_SPACING),
+                            dtype=numpy.bool_)
+        glyph[:, :GLYPH_COLS] = bits < 0.5
+        glyphs.append(glyph)
+    mask = numpy.hstack(glyphs) if glyphs else \
+        numpy.zeros((GLYPH_ROWS, 1), dtype=numpy.bool_)
+    mask = mask.repeat(scale, axis=0).repeat(scale, axis=1)
+    height, width = mask.shape
+    pixels = numpy.zeros((height, width, RGBA_SIZE), dtype=numpy.uint8)
+    pixels[mask] = NoiseMask.PIXEL_MAX
+    buff = pixels.reshape(-1)
+    return buff, opaque_alphas(buff), (width, height)
+
+
+class HeadlessShape(object):
+    """Window-less counterpart of shapes.BaseLabelShape."""
+
+    def __init__(self, shape_cls, noise_level=DEFAULT_NOISE_LEVEL,
+                 font_size=DEFAULT_FONT_SIZE):
+        self.shape_cls = shape_cls
+        self.font_size = font_size
+        self.texture_buffer = None
+        self.size = (0, 0)
+        self._init_visibility = 1 - noise_level
+        self._shape_visibility = 0
+        self._noise_mask = None
+
+    @property
+    def shape_visibility(self):
+        return self._shape_visibility
+
+    @shape_visibility.setter
+    def shape_visibility(self, visibility):
+        if visibility > 1 or visibility < 0:
+            raise ValueError("Visibility can be set only in the interval"
+                             " between 0 and 1.")
+        if self._noise_mask is not None:
+            self._noise_mask.set_visibility(visibility)
+        self._shape_visibility = visibility
+
+    def set_shape(self, shape_index):
+        text = self.shape_cls.SHAPES[shape_index]
+        key = (self.__class__, text, self.font_size)
+        glyph = glyph_cache.get(key, lambda: rasterize(text, self.font_size))
+        self.texture_buffer = glyph.buff.copy()
+        self.size = glyph.size
+        self._noise_mask = NoiseMask(self.texture_buffer, glyph.alpha_indexes)
+        self.shape_visibility = self._init_visibility
+
+    def pixels(self):
+        """Returns shape as array of (height, width, rgba) pixels"""
+        width, height = self.size
+        return self.texture_buffer.reshape(height, width, RGBA_SIZE)
+
+    def clear(self):
+        self.shape_visibility = 0
+
+
+class TestHeadlessGrid(unittest.TestCase):
+    CELL_SIZE = (200, 100)
+    FONT_SIZE = 14
+
+    def setUp(self):
+        self.grid = HeadlessGrid(Shapes.DEFAULT_SHAPE, noise_level=0,
+                                 cell_size=self.CELL_SIZE,
+                                 font_size=self.FONT_SIZE)
+
+    def _lit_cells(self, frame):
+        width, height = self.CELL_SIZE
+        lit = []
+        for position in xrange(HeadlessGrid.GRID_SIZE):
+            row, col = divmod(position, HeadlessGrid.COLS)
+            cell = frame[row * height:(row + 1) * height,
+                         col * width:(col + 1) * width]
+            lit.append(numpy.count_nonzero(cell))
+        return lit
+
+    def test_frame_shape(self):
+        frame = self.grid.render()
+        self.assertEqual(frame.shape, (self.CELL_SIZE[1] * 3,
+                                       self.CELL_SIZE[0] * 3, 3))
+        self.assertFalse(frame.any())
+
+    def test_shape_displayed_in_its_cell(self):
+        position = 4
+        self.grid.show(position, 0)
+        lit = self._lit_cells(self.grid.render())
+        self.assertTrue(lit[position] > 0)
+        self.assertEqual(sum(lit), lit[position])
+
+    def test_noise(self):
+        self.grid.show(0, 0)
+        visible = self._lit_cells(self.grid.render())[0]
+        self.grid.set_visibility(0.5)
+        noisy = self._lit_cells(self.grid.render())[0]
+        self.assertTrue(0 < noisy < visible)
+
+    def test_clear(self):
+        self.grid.show(0, 0)
+        self.grid.show(8, 1)
+        self.grid.clear()
+        self.assertFalse(self.grid.render().any())
+
+    def test_clear_before_show(self):
+        self.grid.clear()
+        self.assertFalse(self.grid.render().any())
+
+    def test_rasterize_deterministic(self):
+        first = rasterize("car", self.FONT_SIZE)
+        second = rasterize("car", self.FONT_SIZE)
+        self.assertEqual(first[2], second[2])
+        self.assertTrue((first[0] == second[0]).all())
+
+
+class HeadlessGrid(object):
+    """3x3 game grid rendered into rgb numpy array.
+
+    Only one shape is displayed at a time (as in the game), frame is
+    redrawn only in the cell of the displayed shape."""
+
+    GRID_SIZE = 9
+    COLS = 3
+    DEFAULT_CELL_SIZE = (320, 160)
+
+    def __init__(self, shape_type=Shapes.DEFAULT_SHAPE,
+                 noise_level=DEFAULT_NOISE_LEVEL,
+                 cell_size=DEFAULT_CELL_SIZE, font_size=DEFAULT_FONT_SIZE):
+        self.cell_size = cell_size
+        shape_cls = Shapes.get(shape_type)
+        self.cells = [HeadlessShape(shape_cls, noise_level, font_size)
+                      for _ in xrange(self.GRID_SIZE)]
+        rows = self.GRID_SIZE // self.COLS
+        width, height = cell_size
+        self.frame = numpy.zeros((rows * height, self.COLS * width, 3),
+                                 dtype=numpy.uint8)
+        self.actual_cell = None
+        self._actual_position = None
+
+    def _cell_view(self, position):
+        width, height = self.cell_size
+        row, col = divmod(position, self.COLS)
+        return self.frame[row * height:(row + 1) * height,
+                          col * width:(col + 1) * width]
+
+    def show(self, position, shape_index):
+        if self.actual_cell is not None:
+            self.clear()
+        self.actual_cell = self.cells[position]
+        self._actual_position = position
+        self.actual_cell.set_shape(shape_index)
+
+    def set_visibility(self, visibility):
+        self.actual_cell.shape_visibility = visibility
+
+    def clear(self):
+        if self.actual_cell is None:
+            return
+        self.actual_cell.clear()
+        self._cell_view(self._actual_position)[:] = 0
+
+    def render(self):
+        """Draws the actual shape (alpha blended on black background) into
+        the frame, the frame is returned - it is overwritten by next call"""
+        if self.actual_cell is None:
+            return self.frame
+        view = self._cell_view(self._actual_position)
+        pixels = self.actual_cell.pixels()
+        height = min(view.shape[0], pixels.shape[0])
+        width = min(view.shape[1], pixels.shape[1])
+        top = (view.shape[0] - height) // 2
+        left = (view.shape[1] - width) // 2
+        src_top = (pixels.shape[0] - height) // 2
+        src_left = (pixels.shape[1] - width) // 2
+        src = pixels[src_top:src_top + height, src_left:src_left + width]
+        alpha = src[:, :, RGBA_SIZE - 1:].astype(numpy.uint16)
+        view[top:top + height, left:left + width] = \
+            src[:, :, :RGBA_SIZE - 1] * alpha // NoiseMask.PIXEL_MAX
+        return self.frame
+
+# eof
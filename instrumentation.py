@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""Lightweight timing of the hot paths.
+
+Functions decorated by traced record their wall time into preallocated
+ring buffers when the tracer is enabled, when it is disabled the only
+cost is one attribute check per call. Records can be exported as Chrome
+trace events (chrome://tracing, Perfetto) and as a summary table."""
+
+__author__ = 'Tomas Novacik'
+
+import contextlib
+import functools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import timeit
+import unittest
+
+import numpy
+
+DEFAULT_CAPACITY = 4096
+US = 1e6
+PERCENTILES = [50, 95]
+
+
+class TestTracer(unittest.TestCase):
+    CAPACITY = 4
+
+    def setUp(self):
+        self.tracer = Tracer(self.CAPACITY)
+        self.tmp_dir = tempfile.mkdtemp()
+
+        @traced("double", self.tracer)
+        def double(value):
+            return value * 2
+
+        self.double = double
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_disabled(self):
+        self.assertEqual(self.double(2), 4)
+        self.assertEqual(self.tracer.probes, {})
+
+    def test_enabled(self):
+        self.tracer.enable()
+        for i in xrange(3):
+            self.double(i)
+        probe = self.tracer.probes["double"]
+        self.assertEqual(probe.count, 3)
+        self.assertEqual(len(probe.durations()), 3)
+        self.assertTrue((probe.durations() >= 0).all())
+
+    def test_exception_recorded(self):
+        self.tracer.enable()
+        self.assertRaises(TypeError, self.double, None)
+        self.assertEqual(self.tracer.probes["double"].count, 1)
+
+    def test_ring_buffer(self):
+        self.tracer.enable()
+        for i in xrange(self.CAPACITY * 2 + 1):
+            self.tracer.record("probe", i, 1)
+        probe = self.tracer.probes["probe"]
+        self.assertEqual(probe.count, self.CAPACITY * 2 + 1)
+        self.assertEqual(sorted(probe.starts().tolist()), [5, 6, 7, 8])
+
+    def test_chrome_trace(self):
+        self.tracer.enable()
+        self.double(1)
+        path = os.path.join(self.tmp_dir, "trace.json")
+        self.tracer.export_chrome_trace(path)
+        with open(path) as f:
+            events = json.load(f)["traceEvents"]
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["name"], "double")
+        self.assertEqual(events[0]["ph"], "X")
+        for key in ["ts", "dur", "pid", "tid"]:
+            self.assertTrue(key in events[0])
+
+    def test_suspended(self):
+        self.tracer.enable()
+        with self.tracer.suspended():
+            self.double(1)
+        self.assertTrue(self.tracer.enabled)
+        self.assertEqual(self.tracer.probes, {})
+
+    def test_summary(self):
+        self.tracer.enable()
+        for duration in [1, 2, 3]:
+            self.tracer.record("probe", 0, duration)
+        row = self.tracer.summary()[0]
+        self.assertEqual(row[:2], ("probe", 3))
+        self.assertEqual(row[2], 2 * US)
+        self.assertTrue("probe" in self.tracer.format_summary())
+
+
+class Probe(object):
+    """Ring buffer of start times and durations of one traced function"""
+
+    __slots__ = ("name", "count", "_starts", "_durations", "_threads")
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.count = 0
+        self._starts = numpy.zeros(capacity)
+        self._durations = numpy.zeros(capacity)
+        self._threads = numpy.zeros(capacity, dtype=numpy.int64)
+
+    def record(self, start, duration, thread=0):
+        index = self.count % len(self._starts)
+        self._starts[index] = start
+        self._durations[index] = duration
+        self._threads[index] = thread
+        self.count += 1
+
+    def _stored(self):
+        return min(self.count, len(self._starts))
+
+    def starts(self):
+        return self._starts[:self._stored()]
+
+    def durations(self):
+        return self._durations[:self._stored()]
+
+    def threads(self):
+        return self._threads[:self._stored()]
+
+
+class Tracer(object):
+    """Collects timing of traced functions"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, clock=timeit.default_timer):
+        self.capacity = capacity
+        self.clock = clock
+        self.enabled = False
+        self.origin = clock()
+        self.probes = {}
+
+    def enable(self):
+        self.origin = self.clock()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """Nothing is recorded in the block (by any thread)"""
+        enabled = self.enabled
+        self.enabled = False
+        try:
+            yield
+        finally:
+            self.enabled = enabled
+
+    def record(self, name, start, duration):
+        probe = self.probes.get(name)
+        if probe is None:
+            probe = self.probes[name] = Probe(name, self.capacity)
+        # thread ids are only used to separate tracks in the trace viewer
+        probe.record(start, duration, threading.current_thread().ident or 0)
+
+    def export_chrome_trace(self, path):
+        """Write records as Chrome trace event JSON (complete events)"""
+        pid = os.getpid()
+        events = []
+        for probe in self.probes.values():
+            for start, duration, thread in zip(probe.starts(),
+                                               probe.durations(),
+                                               probe.threads()):
+                events.append({"name": probe.name, "ph": "X", "pid": pid,
+                               "tid": int(thread),
+                               "ts": (start - self.origin) * US,
+                               "dur": duration * US})
+        events.sort(key=lambda event: event["ts"])
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events,
+                       "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        """Returns (name, calls, mean, p50, p95, max) rows sorted by total
+        time, times are in microseconds"""
+        rows = []
+        for probe in self.probes.values():
+            durations = probe.durations() * US
+            if not len(durations):
+                continue
+            p50, p95 = numpy.percentile(durations, PERCENTILES)
+            rows.append((probe.name, probe.count, durations.mean(), p50, p95,
+                         durations.max()))
+        rows.sort(key=lambda row: row[1] * row[2], reverse=True)
+        return rows
+
+    def format_summary(self):
+        lines = ["%-24s %8s %10s %10s %10s %10s"
+                 % ("name", "calls", "mean us", "p50 us", "p95 us", "max us")]
+        for row in self.summary():
+            lines.append("%-24s %8d %10.1f %10.1f %10.1f %10.1f" % row)
+        return "\n".join(lines)
+
+
+# tracer of the application
+tracer = Tracer()
+
+
+def traced(name, tracer=tracer):
+    """Decorator recording wall time of every call under given name"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return fn(*args, **kwargs)
+            start = tracer.clock()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                tracer.record(name, start, tracer.clock() - start)
+        return wrapper
+    return decorator
+
+# eof
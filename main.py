@@ -6,12 +6,14 @@ from kivy.uix.label import Label
 import about
 import statistics
 from basic_screen import BasicScreen
-from statistics import Statistics
+from statistics import Statistics, StatisticsLoader, StatisticsWriter
 
 Config.set('kivy', 'exit_on_escape', '0')
 Config.write()
 
+import datetime
 import os
+from kivy.logger import Logger
 from kivy.properties import ObjectProperty
 from kivy.uix.anchorlayout import AnchorLayout
 from kivy.app import App
@@ -22,6 +24,8 @@ from kivy.uix.screenmanager import ScreenManager
 from kivy.config import ConfigParser
 import game
 import settings
+from collector import Outbox
+from instrumentation import tracer
 
 # TODO add content to about page
 # TODO move graphics definitions to separate kv files
@@ -31,6 +35,9 @@ import settings
 # to previous screen
 BACK_KEY_CODES = [27, 1001]
 
+TRACE_FILENAME = "trace.json"
+OUTBOX_FILENAME = "outbox.sqlite3"
+
 
 class MainScreen(BasicScreen):
     MENU_SPACING = 10
@@ -39,26 +46,23 @@ class MainScreen(BasicScreen):
     HEADING_SIZE_HINT = (.3, .3)
     INFO_SIZE_HINT = (.3, .1)
 
-    def _get_session_played(self):
-        sessions_played = App.get_running_app().stats.sessions_played()
-        return "Sessions played today: %s" % sessions_played
+    def _get_session_played(self, summary):
+        return "Sessions played today: %s" % summary.sessions
 
-    def _get_tested_items(self):
-        tested_items = App.get_running_app().stats.tested_items()
-        return "Tested items today: %s" % tested_items
+    def _get_tested_items(self, summary):
+        return "Tested items today: %s" % summary.items
 
-    def _get_overall_success(self):
-        success_rate = App.get_running_app().stats.success_rate()
-        return "Today success rate: %1.f%%" % success_rate
+    def _get_overall_success(self, summary):
+        return "Today success rate: %1.f%%" % summary.success_rate
 
     def _format_heading(self):
         return self.APP_HEADING % self.config.get("game", "level")
 
-    def on_enter(self, *args):
+    def build(self):
         self.heading_layout = AnchorLayout(anchor_x='center', anchor_y='top')
-        heading = Label(text=self._format_heading(), font_size='55sp',
-                        size_hint=self.HEADING_SIZE_HINT)
-        self.heading_layout.add_widget(heading)
+        self.heading = Label(font_size='55sp',
+                             size_hint=self.HEADING_SIZE_HINT)
+        self.heading_layout.add_widget(self.heading)
         self.add_widget(self.heading_layout)
         self.menu_layout = AnchorLayout()
 
@@ -82,13 +86,12 @@ class MainScreen(BasicScreen):
 
         info_box = BoxLayout(orientation="vertical",
                              size_hint=self.INFO_SIZE_HINT)
-        info_labels = [
-            Label(text=self._get_session_played()),
-            Label(text=self._get_tested_items()),
-            Label(text=self._get_overall_success())
-        ]
-
-        for label in info_labels:
+        # texts are set by refresh
+        self.session_label = Label()
+        self.items_label = Label()
+        self.success_label = Label()
+        for label in [self.session_label, self.items_label,
+                      self.success_label]:
             info_box.add_widget(label)
 
         self.info_layout.add_widget(info_box)
@@ -112,8 +115,12 @@ class MainScreen(BasicScreen):
         self.menu_layout.add_widget(box_layout)
         self.add_widget(self.menu_layout)
 
-    def on_leave(self, *args):
-        self.clear_widgets()
+    def refresh(self):
+        self.heading.text = self._format_heading()
+        summary = App.get_running_app().stats.daily_summary()
+        self.session_label.text = self._get_session_played(summary)
+        self.items_label.text = self._get_tested_items(summary)
+        self.success_label.text = self._get_overall_success(summary)
 
 
 class ScreenHistoryManager(ScreenManager):
@@ -148,6 +155,28 @@ class NBackApp(App):
         db_dir = self.config.get('internal', 'db_path')
         db_location = os.path.join(db_dir, Statistics.DB_NAME)
         self.stats = Statistics(db_location)
+        # results are written in background, UI does not wait for the disk
+        self.stats_writer = StatisticsWriter(
+            db_location, on_commit=self.stats.cache.invalidate)
+        self.stats_writer.start()
+        # graphs are loaded in background, UI does not freeze meanwhile
+        self.stats_loader = StatisticsLoader(db_location,
+                                             cache=self.stats.cache)
+        self.stats_loader.start()
+        # old sessions are rolled up into daily rows in background
+        retention_days = self.config.getint('internal', 'retention_days')
+        if retention_days > 0:
+            self.stats_writer.compact(
+                datetime.timedelta(days=retention_days))
+        # results are uploaded to the collector if its address is set
+        self.outbox = None
+        collector_url = self.config.get('internal', 'collector_url')
+        if collector_url:
+            self.outbox = Outbox(os.path.join(db_dir, OUTBOX_FILENAME),
+                                 collector_url)
+            self.outbox.start()
+        if self.config.getint('internal', 'trace'):
+            tracer.enable()
         self.sm = ScreenHistoryManager()
         self.sm.add_widget(MainScreen(name='menu'))
         self.sm.add_widget(game.GameScreen(name='game'))
@@ -158,8 +187,28 @@ class NBackApp(App):
         # return game
         return self.sm
 
-    def add_result(self, level, position, shape, success, items_count):
-        self.stats.add(level, position, shape, success, items_count)
+    def add_result(self, level, position, shape, success, items_count,
+                   trials=None, noise=None):
+        date = datetime.datetime.now()
+        if trials is not None:
+            trials = list(trials)
+        self.stats_writer.add(level, position, shape, success, items_count,
+                              date, trials=trials, noise=noise)
+        if self.outbox is not None:
+            self.outbox.put(level, position, shape, success, items_count,
+                            date, trials=trials, noise=noise)
+
+    def on_stop(self):
+        self.stats_writer.close()
+        self.stats_loader.close()
+        if self.outbox is not None:
+            self.outbox.close()
+        Logger.info("Statistics: query cache hit rate %.0f%%"
+                    % (self.stats.cache.hit_rate * 100))
+        if tracer.enabled:
+            db_dir = self.config.get('internal', 'db_path')
+            tracer.export_chrome_trace(os.path.join(db_dir, TRACE_FILENAME))
+            Logger.info("Trace: hot path timing\n%s" % tracer.format_summary())
 
     def _hook_keyboard(self, window, key, *args):
         if key in BACK_KEY_CODES:
@@ -173,6 +222,13 @@ class NBackApp(App):
         if not os.path.exists(self.SETTINGS_FILENAME):
             raise IOError("Cannot locate configuration file.")
         self.config.read(self.SETTINGS_FILENAME)
+        # options added after the first release, configuration files of
+        # existing users do not have them
+        self.config.setdefaults('game', {'position_match_rate': 0.3,
+                                         'shape_match_rate': 0.3})
+        self.config.setdefaults('internal', {'trace': 0,
+                                             'collector_url': '',
+                                             'retention_days': 0})
 
 
 if __name__ == '__main__':
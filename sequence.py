@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Generation of stimuli sequences of whole n-back sessions."""
+
+__author__ = 'Tomas Novacik'
+
+import numpy
+import unittest
+
+DEFAULT_MATCH_RATE = 0.3
+CHOICES = 9
+
+
+class TestSequence(unittest.TestCase):
+    LENGTH = 25
+    HISTORY = 3
+    SEED = 42
+
+    def test_reproducible(self):
+        first = generate_session(self.LENGTH, self.HISTORY, seed=self.SEED)
+        second = generate_session(self.LENGTH, self.HISTORY, seed=self.SEED)
+        for a, b in zip(first, second):
+            self.assertEqual(a.tolist(), b.tolist())
+
+    def test_shape(self):
+        positions, shapes = generate(10, self.LENGTH, self.HISTORY,
+                                     seed=self.SEED)
+        self.assertEqual(positions.shape, (10, self.LENGTH))
+        self.assertEqual(shapes.shape, (10, self.LENGTH))
+        for seq in [positions, shapes]:
+            self.assertTrue(0 <= seq.min() and seq.max() < CHOICES)
+
+    def test_no_matches(self):
+        positions, shapes = generate(100, self.LENGTH, self.HISTORY,
+                                     rates=(0, 0), seed=self.SEED)
+        self.assertFalse(n_back_matches(positions, self.HISTORY).any())
+        self.assertFalse(n_back_matches(shapes, self.HISTORY).any())
+
+    def test_all_matches(self):
+        positions, shapes = generate(100, self.LENGTH, self.HISTORY,
+                                     rates=(1, 0), seed=self.SEED)
+        self.assertTrue(n_back_matches(positions, self.HISTORY).all())
+        self.assertFalse(n_back_matches(shapes, self.HISTORY).any())
+
+    def test_match_rate(self):
+        rates = (0.2, 0.4)
+        positions, shapes = generate(10000, self.LENGTH, self.HISTORY,
+                                     rates=rates, seed=self.SEED)
+        for seq, rate in zip([positions, shapes], rates):
+            observed = match_rates(seq, self.HISTORY).mean()
+            self.assertAlmostEqual(observed, rate, places=2)
+
+
+def n_back_matches(sequences, history):
+    """Returns boolean array - True where an item is equal to the item
+    'history' steps back, works for one or many (2d array) sequences"""
+    sequences = numpy.asarray(sequences)
+    return sequences[..., history:] == sequences[..., :-history]
+
+
+def match_rates(sequences, history):
+    """Returns observed match rate of every sequence"""
+    return n_back_matches(sequences, history).mean(axis=-1)
+
+
+def _generate_items(rand, count, length, history, match_rate, choices):
+    items = numpy.empty((count, length), dtype=numpy.int8)
+    items[:, :history] = rand.randint(0, choices, (count, history))
+    matches = rand.random_sample((count, length)) < match_rate
+    # non matching item is shifted by random non zero offset
+    offsets = rand.randint(1, choices, (count, length))
+    for i in xrange(history, length):
+        previous = items[:, i - history]
+        items[:, i] = numpy.where(matches[:, i], previous,
+                                  (previous + offsets[:, i]) % choices)
+    return items
+
+
+def generate(count, length, history,
+             rates=(DEFAULT_MATCH_RATE, DEFAULT_MATCH_RATE),
+             seed=None, choices=CHOICES):
+    """Generates count sequences of (position, shape) pairs. Every item
+    from 'history' index on matches the item n steps back with given
+    probability (separately for positions and shapes).
+
+    Returns two (count, length) arrays - positions and shapes."""
+    rand = numpy.random.RandomState(seed)
+    position_rate, shape_rate = rates
+    positions = _generate_items(rand, count, length, history, position_rate,
+                                choices)
+    shapes = _generate_items(rand, count, length, history, shape_rate,
+                             choices)
+    return positions, shapes
+
+
+def generate_session(length, history, position_rate=DEFAULT_MATCH_RATE,
+                     shape_rate=DEFAULT_MATCH_RATE, seed=None,
+                     choices=CHOICES):
+    """Returns positions and shapes of one session"""
+    positions, shapes = generate(1, length, history,
+                                 (position_rate, shape_rate), seed, choices)
+    return positions[0], shapes[0]
+
+# eof
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+"""N-back session logic (evaluation and scoring) independent of kivy."""
+
+__author__ = 'Tomas Novacik'
+
+import array
+import collections
+import numpy
+import unittest
+
+from sequence import n_back_matches, generate
+
+POSITION = "position"
+SHAPE = "shape"
+
+MAX_RATE = 100.0
+
+
+class TestSessionEvaluation(unittest.TestCase):
+    PREV_POSITION = 1
+    PREV_SHAPE = 2
+
+    def setUp(self):
+        self.session = Session(history=1)
+        self.session.present(self.PREV_POSITION, self.PREV_SHAPE)
+
+    def _evaluate(self, position_match, shape_match, p_clicked, s_clicked):
+        position = self.PREV_POSITION + (not position_match)
+        shape = self.PREV_SHAPE + (not shape_match)
+        self.session.present(position, shape)
+        if p_clicked:
+            self.session.respond(POSITION)
+        if s_clicked:
+            self.session.respond(SHAPE)
+        return self.session.evaluate()
+
+    def test_mistake_clicked(self):
+        outcome = self._evaluate(False, False, True, True)
+        self.assertTrue(outcome.p_err)
+        self.assertTrue(outcome.s_err)
+
+    def test_mistake_not_clicked(self):
+        outcome = self._evaluate(True, True, False, False)
+        self.assertTrue(outcome.p_err)
+        self.assertTrue(outcome.s_err)
+
+    def test_success_clicked(self):
+        outcome = self._evaluate(True, True, True, True)
+        self.assertFalse(outcome.p_err)
+        self.assertFalse(outcome.s_err)
+
+    def test_success_not_clicked(self):
+        outcome = self._evaluate(False, False, False, False)
+        self.assertFalse(outcome.p_err)
+        self.assertFalse(outcome.s_err)
+
+    def test_counters(self):
+        # shape does not match, but it is clicked
+        self._evaluate(True, False, False, True)
+        self.session.present(self.PREV_POSITION, self.PREV_SHAPE + 1)
+        self.session.respond(POSITION)
+        self.session.respond(SHAPE)
+        self.session.evaluate()
+        self.assertEqual((self.session.p_errors, self.session.s_errors), (1, 1))
+        self.assertEqual((self.session.tested_positions,
+                          self.session.tested_shapes), (2, 1))
+        self.assertEqual(len(self.session.outcomes), 2)
+
+    def test_first_response_counts(self):
+        self.session.present(self.PREV_POSITION, self.PREV_SHAPE, onset=10)
+        self.assertTrue(self.session.respond(POSITION, 10.25))
+        self.assertFalse(self.session.respond(POSITION, 10.5))
+        outcome = self.session.evaluate()
+        self.assertEqual(outcome.p_latency, 0.25)
+        self.assertEqual(outcome.s_latency, None)
+
+    def test_unknown_modality(self):
+        self.assertRaises(ValueError, self.session.respond, "color")
+
+    def test_not_evaluable(self):
+        session = Session(history=2)
+        session.present(0, 0)
+        session.present(1, 1)
+        self.assertFalse(session.evaluable)
+        session.present(0, 0)
+        self.assertTrue(session.evaluable)
+
+
+class TestRingBuffer(unittest.TestCase):
+    CAPACITY = 3
+
+    def setUp(self):
+        self.buff = RingBuffer(self.CAPACITY)
+
+    def test_empty(self):
+        self.assertEqual(len(self.buff), 0)
+        self.assertRaises(IndexError, self.buff.ago, 0)
+        self.assertEqual(self.buff.to_array().tolist(), [])
+
+    def test_ago(self):
+        for item in xrange(5):
+            self.buff.append(item)
+        self.assertEqual(len(self.buff), self.CAPACITY)
+        self.assertEqual([self.buff.ago(i) for i in xrange(self.CAPACITY)],
+                         [4, 3, 2])
+        self.assertRaises(IndexError, self.buff.ago, self.CAPACITY)
+
+    def test_to_array(self):
+        for item in xrange(4):
+            self.buff.append(item)
+        self.assertEqual(self.buff.to_array().tolist(), [1, 2, 3])
+
+    def test_n_back_matches(self):
+        buff = RingBuffer(6)
+        for item in [1, 2, 1, 2, 3, 1]:
+            buff.append(item)
+        self.assertEqual(buff.n_back_matches(2).tolist(),
+                         [True, True, False, False])
+
+    def test_clear(self):
+        self.buff.append(1)
+        self.buff.clear()
+        self.assertEqual(len(self.buff), 0)
+
+
+class TestTrialLog(unittest.TestCase):
+
+    def setUp(self):
+        self.log = TrialLog(4, origin=100.0)
+        self.session = Session(history=1, log=self.log)
+
+    def test_rows(self):
+        self.session.present(1, 2, onset=100.0)
+        self.session.respond(SHAPE, 100.5)
+        self.session.present(1, 3, onset=102.0)
+        self.session.respond(POSITION, 102.25)
+        self.session.evaluate()
+        self.assertEqual(len(self.log), 2)
+        self.assertEqual(list(self.log.rows()), [
+            (0, 0.0, 1, 2, None, 0.5, None, None),
+            (1, 2.0, 1, 3, 0.25, None, True, True)])
+
+    def test_errors_logged(self):
+        self.session.present(1, 2, onset=100.0)
+        self.session.present(0, 2, onset=102.0)
+        self.session.evaluate()
+        self.assertEqual(list(self.log.rows())[-1][-2:], (True, False))
+
+    def test_capacity(self):
+        for trial in xrange(4):
+            self.session.present(trial, trial)
+        self.assertRaises(IndexError, self.session.present, 0, 0)
+
+    def test_no_onset(self):
+        self.session.present(1, 2)
+        self.assertEqual(list(self.log.rows())[0][1], None)
+
+
+class TestScoring(unittest.TestCase):
+    HISTORY = 2
+    STEP = 1.0
+
+    def test_statistics(self):
+        self.assertEqual(compute_statistics(0, 0, 0, 0),
+                         (MAX_RATE, MAX_RATE, MAX_RATE))
+        self.assertEqual(compute_statistics(1, 1, 4, 4), (75.0, 75.0, 75.0))
+        # more errors than tested items
+        self.assertEqual(compute_statistics(1, 3, 4, 2)[1], 0)
+
+    def test_run(self):
+        positions = [0, 1, 0, 2, 2]
+        shapes = [3, 3, 3, 4, 5]
+        # position match at trial 2 clicked, shape match at trial 2 missed,
+        # false shape click at trial 4
+        responses = [(2.5, POSITION), (4.1, SHAPE), (4.2, SHAPE)]
+        outcomes, statistics = run(positions, shapes, self.HISTORY,
+                                   responses, self.STEP)
+        self.assertEqual([o.trial for o in outcomes], [2, 3, 4])
+        self.assertEqual([o.p_err for o in outcomes], [False] * 3)
+        self.assertEqual([o.s_err for o in outcomes], [True, False, True])
+        self.assertEqual([o.p_latency for o in outcomes], [0.5, None, None])
+        # only the first response counts
+        self.assertAlmostEqual(outcomes[2].s_latency, 0.1)
+        self.assertEqual(statistics, (MAX_RATE, 0, 0))
+
+    def test_score_equals_session(self):
+        count, length = 50, 12
+        rand = numpy.random.RandomState(0)
+        positions, shapes = generate(count, length, self.HISTORY, seed=0)
+        p_clicked = rand.random_sample((count, length)) < 0.3
+        s_clicked = rand.random_sample((count, length)) < 0.3
+        scores = score(positions, shapes, self.HISTORY, p_clicked, s_clicked)
+        for i in xrange(count):
+            session = Session(self.HISTORY)
+            for trial in xrange(length):
+                session.present(positions[i, trial], shapes[i, trial])
+                if p_clicked[i, trial]:
+                    session.respond(POSITION)
+                if s_clicked[i, trial]:
+                    session.respond(SHAPE)
+                if session.evaluable:
+                    session.evaluate()
+            for expected, actual in zip(session.statistics(), scores):
+                self.assertAlmostEqual(expected, actual[i])
+
+
+TrialOutcome = collections.namedtuple("TrialOutcome", [
+    "trial", "p_match", "s_match", "p_clicked", "s_clicked", "p_err",
+    "s_err", "onset", "p_latency", "s_latency"])
+
+
+TRIAL_DTYPE = numpy.dtype([
+    ("onset", numpy.float64), ("position", numpy.int8),
+    ("shape", numpy.int8), ("p_latency", numpy.float64),
+    ("s_latency", numpy.float64), ("p_correct", numpy.int8),
+    ("s_correct", numpy.int8)])
+
+NOT_EVALUATED = -1
+
+
+class TrialLog(object):
+    """Columnar in-memory log of all trials of a session.
+
+    Storage is allocated at once for the whole session, missing values
+    (no response, trial not evaluated) are stored as nan/-1."""
+
+    def __init__(self, capacity, origin=0):
+        self.origin = origin
+        self.count = 0
+        self.columns = numpy.empty(capacity, dtype=TRIAL_DTYPE)
+        for name in ["onset", "p_latency", "s_latency"]:
+            self.columns[name] = numpy.nan
+        self.columns["p_correct"] = NOT_EVALUATED
+        self.columns["s_correct"] = NOT_EVALUATED
+
+    def __len__(self):
+        return self.count
+
+    def present(self, trial, onset, position, shape):
+        if trial >= len(self.columns):
+            raise IndexError("Trial log is full.")
+        row = self.columns[trial]
+        if onset is not None:
+            row["onset"] = onset - self.origin
+        row["position"] = position
+        row["shape"] = shape
+        self.count = trial + 1
+
+    def respond(self, trial, modality, latency):
+        if latency is not None:
+            column = "p_latency" if modality == POSITION else "s_latency"
+            self.columns[trial][column] = latency
+
+    def evaluate(self, trial, p_err, s_err):
+        row = self.columns[trial]
+        row["p_correct"] = not p_err
+        row["s_correct"] = not s_err
+
+    def rows(self):
+        """Generates (trial, onset, position, shape, p_latency, s_latency,
+        p_correct, s_correct) tuples, missing values are None"""
+        def value(item):
+            return None if item != item else float(item)
+
+        def correct(item):
+            return None if item == NOT_EVALUATED else bool(item)
+
+        for trial, row in enumerate(self.columns[:self.count]):
+            yield (trial, value(row["onset"]), int(row["position"]),
+                   int(row["shape"]), value(row["p_latency"]),
+                   value(row["s_latency"]), correct(row["p_correct"]),
+                   correct(row["s_correct"]))
+
+
+def compute_statistics(p_errors, s_errors, tested_positions, tested_shapes):
+    """Returns success rates (in percents) of positions, shapes and overall
+    success rate, rate is never negative"""
+    if not tested_positions:
+        c_position = MAX_RATE
+    else:
+        c_position = (1 - float(p_errors) / tested_positions) * 100
+
+    if not tested_shapes:
+        c_shape = MAX_RATE
+    else:
+        c_shape = (1 - float(s_errors) / tested_shapes) * 100
+
+    tested_items = tested_positions + tested_shapes
+    if not tested_items:
+        s_rate = MAX_RATE
+    else:
+        all_errors = p_errors + s_errors
+        s_rate = 1 - (float(all_errors) / tested_items)
+        s_rate *= 100
+
+    return max(c_position, 0), max(c_shape, 0), max(s_rate, 0)
+
+
+class RingBuffer(object):
+    """Fixed capacity buffer of integer items, item appended n steps ago
+    is accessible in constant time. When the buffer is full the oldest
+    item is overwritten."""
+
+    __slots__ = ("_items", "_capacity", "_count")
+
+    TYPECODE = "l"
+
+    def __init__(self, capacity):
+        self._items = array.array(self.TYPECODE, [0]) * capacity
+        self._capacity = capacity
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self._capacity)
+
+    def append(self, item):
+        self._items[self._count % self._capacity] = item
+        self._count += 1
+
+    def ago(self, steps):
+        """Returns item appended 'steps' appends ago, 0 is the last one"""
+        if not 0 <= steps < min(self._count, self._capacity):
+            raise IndexError("Item %s steps ago is not stored." % steps)
+        return self._items[(self._count - 1 - steps) % self._capacity]
+
+    def to_array(self):
+        """Returns stored items in chronological order as numpy array"""
+        items = numpy.frombuffer(self._items, dtype=self.TYPECODE)
+        if self._count <= self._capacity:
+            return items[:self._count].copy()
+        return numpy.roll(items, -(self._count % self._capacity))
+
+    def n_back_matches(self, history):
+        """Vectorized match check of all stored items, see
+        sequence.n_back_matches"""
+        return n_back_matches(self.to_array(), history)
+
+    def clear(self):
+        self._count = 0
+
+
+class Session(object):
+    """State of one n-back session.
+
+    Stimuli are presented one by one, every stimulus can be responded to
+    (position/shape match) and once there is 'history' stimuli before it,
+    it can be evaluated."""
+
+    def __init__(self, history, log=None):
+        self.history = history
+        self.log = log
+        # actual item and 'history' items before it
+        self.positions = RingBuffer(history + 1)
+        self.shapes = RingBuffer(history + 1)
+        self.a_position = None
+        self.a_shape = None
+        self.trial = -1
+        self.p_clicked = False
+        self.s_clicked = False
+        # onset of the actual stimulus and first responses to it
+        self.onset = None
+        self.p_time = None
+        self.s_time = None
+        self.p_errors = 0
+        self.s_errors = 0
+        self.tested_positions = 0
+        self.tested_shapes = 0
+        self.outcomes = []
+
+    def present(self, position, shape, onset=None):
+        """Make given stimulus the actual one, onset is its display time"""
+        self.positions.append(position)
+        self.shapes.append(shape)
+        self.a_position = position
+        self.a_shape = shape
+        self.trial += 1
+        self.p_clicked = False
+        self.s_clicked = False
+        self.onset = onset
+        self.p_time = None
+        self.s_time = None
+        if self.log is not None:
+            self.log.present(self.trial, onset, position, shape)
+
+    def respond(self, modality, timestamp=None):
+        """Mark actual stimulus as matching in given modality, only the
+        first response counts. Returns True if the response is accepted."""
+        if modality == POSITION:
+            if self.p_clicked:
+                return False
+            self.p_clicked = True
+            self.p_time = timestamp
+        elif modality == SHAPE:
+            if self.s_clicked:
+                return False
+            self.s_clicked = True
+            self.s_time = timestamp
+        else:
+            raise ValueError("Unknown modality %s." % modality)
+        if self.log is not None:
+            self.log.respond(self.trial, modality, self._latency(timestamp))
+        return True
+
+    def _latency(self, timestamp):
+        if timestamp is None or self.onset is None:
+            return None
+        return timestamp - self.onset
+
+    @property
+    def evaluable(self):
+        return self.trial >= self.history
+
+    def evaluate(self):
+        """Evaluate responses to the actual stimulus"""
+        p_match = self.positions.ago(self.history) == self.a_position
+        s_match = self.shapes.ago(self.history) == self.a_shape
+        # using xor
+        p_err = p_match != self.p_clicked
+        s_err = s_match != self.s_clicked
+
+        self.p_errors += p_err
+        self.s_errors += s_err
+        self.tested_positions += p_match
+        self.tested_shapes += s_match
+
+        outcome = TrialOutcome(self.trial, p_match, s_match, self.p_clicked,
+                               self.s_clicked, p_err, s_err, self.onset,
+                               self._latency(self.p_time),
+                               self._latency(self.s_time))
+        self.outcomes.append(outcome)
+        if self.log is not None:
+            self.log.evaluate(self.trial, p_err, s_err)
+        return outcome
+
+    def statistics(self):
+        return compute_statistics(self.p_errors, self.s_errors,
+                                  self.tested_positions, self.tested_shapes)
+
+
+def run(positions, shapes, history, responses, step_duration, log=None):
+    """Plays the whole session, responses is a sequence of
+    (timestamp, modality) pairs, timestamps are relative to the onset of
+    the first stimulus, every stimulus lasts step_duration. Trials are
+    written into the log if given.
+
+    Returns list of trial outcomes and session statistics."""
+    by_trial = collections.defaultdict(list)
+    for timestamp, modality in responses:
+        by_trial[int(timestamp // step_duration)].append((timestamp,
+                                                          modality))
+
+    session = Session(history, log=log)
+    for trial, (position, shape) in enumerate(zip(positions, shapes)):
+        session.present(position, shape, trial * step_duration)
+        for timestamp, modality in sorted(by_trial.get(trial, ())):
+            session.respond(modality, timestamp)
+        if session.evaluable:
+            session.evaluate()
+    return session.outcomes, session.statistics()
+
+
+def _rates(errors, tested):
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        rates = (1 - errors / tested) * 100
+    rates[tested == 0] = MAX_RATE
+    return numpy.maximum(rates, 0)
+
+
+def score(positions, shapes, history, p_clicked, s_clicked):
+    """Vectorized statistics of many sessions, all arguments are
+    (sessions, trials) arrays (clicks are boolean).
+
+    Returns arrays of position, shape and overall success rates."""
+    p_match = n_back_matches(positions, history)
+    s_match = n_back_matches(shapes, history)
+    p_errors = (p_match != p_clicked[..., history:]).sum(axis=-1)
+    s_errors = (s_match != s_clicked[..., history:]).sum(axis=-1)
+    tested_positions = p_match.sum(axis=-1).astype(numpy.float64)
+    tested_shapes = s_match.sum(axis=-1).astype(numpy.float64)
+    return (_rates(p_errors, tested_positions),
+            _rates(s_errors, tested_shapes),
+            _rates(p_errors + s_errors, tested_positions + tested_shapes))
+
+# eof
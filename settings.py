@@ -28,13 +28,10 @@ class NBackSettings(Settings):
 
 class SettingScreen(BasicScreen):
 
-    def on_enter(self, *args):
+    def build(self):
+        # panels are parsed once, they update themselves on config change
         self.settings = NBackSettings()
         self.settings.create_panels(self.config)
         self.add_widget(self.settings)
 
-    def on_leave(self, *args):
-        self.clear_widgets()
-        del self.settings
-
 # eof
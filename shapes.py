@@ -1,14 +1,19 @@
 #!/usr/bin/env python
+from kivy.graphics.texture import Texture
 from kivy.graphics.vertex_instructions import Rectangle
 
 __author__ = 'Tomas Novacik'
 
+import collections
 import numpy
 import random
 import string
 import re
+import unittest
 from kivy.uix.label import Label
 
+from instrumentation import traced, tracer
+
 RGBA_SIZE = 4
 
 
@@ -66,6 +71,168 @@ class Shapes(object):
 DEFAULT_NOISE_LEVEL = 0
 
 
+def opaque_alphas(buff):
+    """Returns indexes of all non zero alpha bytes in rgba ubyte buffer."""
+    alphas = buff[RGBA_SIZE - 1::RGBA_SIZE]
+    return numpy.flatnonzero(alphas) * RGBA_SIZE + RGBA_SIZE - 1
+
+
+class TestNoiseMask(unittest.TestCase):
+    PIXEL_COUNT = 1000
+
+    def setUp(self):
+        self.buff = numpy.zeros(self.PIXEL_COUNT * RGBA_SIZE,
+                                dtype=numpy.uint8)
+        # every second pixel is opaque
+        self.buff[RGBA_SIZE - 1::RGBA_SIZE * 2] = NoiseMask.PIXEL_MAX
+        self.mask = NoiseMask(self.buff, opaque_alphas(self.buff))
+
+    def _visible_count(self):
+        return numpy.count_nonzero(self.buff[RGBA_SIZE - 1::RGBA_SIZE])
+
+    def test_opaque_alphas(self):
+        indexes = opaque_alphas(self.buff)
+        self.assertEqual(len(indexes), self.PIXEL_COUNT / 2)
+        self.assertTrue((self.buff[indexes] == NoiseMask.PIXEL_MAX).all())
+
+    def test_visibility_levels(self):
+        opaque_count = self.PIXEL_COUNT / 2
+        for visibility in [0.5, 0.2, 0.7, 0, 1, 0.33]:
+            self.mask.set_visibility(visibility)
+            self.assertEqual(self._visible_count(),
+                             int(visibility * opaque_count))
+
+    def test_only_alphas_modified(self):
+        self.buff[0::RGBA_SIZE] = 7
+        self.mask.set_visibility(0)
+        self.assertTrue((self.buff[0::RGBA_SIZE] == 7).all())
+        self.assertEqual(self._visible_count(), 0)
+
+    def test_transparent_pixels_untouched(self):
+        self.mask.set_visibility(0)
+        self.mask.set_visibility(1)
+        self.assertTrue((self.buff[RGBA_SIZE * 2 - 1::RGBA_SIZE * 2] ==
+                         NoiseMask.PIXEL_MIN).all())
+
+
+class NoiseMask(object):
+    """Applies noise on a shape stored in rgba ubyte buffer.
+
+    Opaque alphas are randomly permuted once, visibility level then
+    determines how many of them (from the start of the permutation)
+    are visible."""
+
+    PIXEL_MAX = 255
+    PIXEL_MIN = 0
+
+    def __init__(self, buff, alpha_indexes):
+        self.buff = buff
+        self._indexes = numpy.random.permutation(alpha_indexes)
+        self._visible = len(self._indexes)
+
+    def set_visibility(self, visibility):
+        visible = int(visibility * len(self._indexes))
+        if visible > self._visible:
+            self.buff[self._indexes[self._visible:visible]] = self.PIXEL_MAX
+        elif visible < self._visible:
+            self.buff[self._indexes[visible:self._visible]] = self.PIXEL_MIN
+        self._visible = visible
+
+
+class TestGlyphCache(unittest.TestCase):
+    CACHE_SIZE = 2
+
+    def setUp(self):
+        self.cache = GlyphCache(self.CACHE_SIZE)
+        self.rasterized = []
+
+    def _rasterize(self, key):
+        def rasterize():
+            self.rasterized.append(key)
+            buff = numpy.zeros(RGBA_SIZE, dtype=numpy.uint8)
+            return buff, opaque_alphas(buff), (1, 1)
+        return rasterize
+
+    def _get(self, key):
+        return self.cache.get(key, self._rasterize(key))
+
+    def test_hit(self):
+        first = self._get("a")
+        self.assertIs(self._get("a"), first)
+        self.assertEqual(self.rasterized, ["a"])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.cache.hit_rate, 0.5)
+
+    def test_glyph_is_read_only(self):
+        glyph = self._get("a")
+        self.assertRaises(ValueError, glyph.buff.__setitem__, 0, 1)
+
+    def test_least_recently_used_evicted(self):
+        for key in ["a", "b", "a", "c", "a", "b"]:
+            self._get(key)
+        self.assertEqual(self.rasterized, ["a", "b", "c", "b"])
+        self.assertEqual(len(self.cache), self.CACHE_SIZE)
+
+    def test_clear(self):
+        self._get("a")
+        self.cache.clear()
+        self._get("a")
+        self.assertEqual(self.rasterized, ["a", "a"])
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+
+
+Glyph = collections.namedtuple("Glyph", ["buff", "alpha_indexes", "size"])
+
+
+class GlyphCache(object):
+    """Bounded LRU cache of rasterized shapes.
+
+    Rasterization of a text is expensive (layout, rendering and texture
+    read back), result depends only on shape class, text and font size."""
+
+    DEFAULT_SIZE = 64
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self._glyphs = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._glyphs)
+
+    @property
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return float(self.hits) / requests if requests else 0.0
+
+    def get(self, key, rasterize):
+        """Returns glyph stored under key, rasterize is called on cache miss
+        and it must return rgba buffer, its opaque alpha indexes and size"""
+        try:
+            glyph = self._glyphs.pop(key)
+            self.hits += 1
+        except KeyError:
+            buff, alpha_indexes, size = rasterize()
+            # cached buffers are shared -> users must work on copies
+            buff.flags.writeable = False
+            glyph = Glyph(buff, alpha_indexes, tuple(size))
+            self.misses += 1
+            if len(self._glyphs) >= self.size:
+                self._glyphs.popitem(last=False)
+        self._glyphs[key] = glyph
+        return glyph
+
+    def clear(self):
+        self._glyphs.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# shared by all cells of the game grid
+glyph_cache = GlyphCache()
+
+
 class BaseLabelShape(Label, Shapes):
     SHAPE_COLOR = [255, 255, 255]
     BACKGROUND_COLOR = [0, 0, 0]
@@ -73,21 +240,23 @@ class BaseLabelShape(Label, Shapes):
     FONT_SIZE = '3cm'
     MAX_NUM = 10
     SHAPES = None  # must be changed by subclass
-    PIXEL_MAX = 255
-    PIXEL_MIN = 0
 
     def __init__(self, noise_level=DEFAULT_NOISE_LEVEL):
 
         super(BaseLabelShape, self).__init__(font_size=self.FONT_SIZE)
         self.shape_box = None
+        self.texture_buffer = None
+        self._shape_texture = None
+        # textures of all sizes displayed so far, reused by later shapes
+        self._textures = {}
         self._init_visibility = 1 - noise_level
         self._shape_visibility = 1
-        # when applying noise -> here are pixels that should be normally visible
-        # but are not and pixels that should be visible and really are visible
-        # this information is used to handle visibility of the shape,
-        # only alphas are being modified
-        self._invisible_pixels = []
-        self._visible_pixels = []
+        # handles visibility of the shape, only alphas are being modified
+        self._noise_mask = None
+
+    def set_noise_level(self, noise_level):
+        """Noise level applied to the next displayed shape"""
+        self._init_visibility = 1 - noise_level
 
     def reposition_shape_box(self, *largs):
         self.shape_box.pos = self.pos
@@ -101,6 +270,7 @@ class BaseLabelShape(Label, Shapes):
         return self._shape_visibility
 
     @shape_visibility.setter
+    @traced("shapes.noise")
     def shape_visibility(self, visibility):
         if visibility > 1 or visibility < 0:
             raise ValueError("Visibility can be set only in the interval"
@@ -110,81 +280,79 @@ class BaseLabelShape(Label, Shapes):
         if visibility == self._shape_visibility:
             return
 
-        # handle specifically two special cases - when the visibility
-        # should be zero and 1 -> just to make it faster
-        if visibility == 0:
-            for index in self._visible_pixels:
-                self.texture_buffer[index] = self.PIXEL_MIN
-            self._invisible_pixels.extend(self._visible_pixels)
-            self._visible_pixels = []
-        elif visibility == 1:
-            for index in self._invisible_pixels:
-                self.texture_buffer[index] = self.PIXEL_MAX
-            self._visible_pixels.extend(self._invisible_pixels)
-            self._invisible_pixels = []
-        else:
-            # compute how many pixels should be [in]visible on given
-            # visibility level
-            pix_count = len(self._invisible_pixels)\
-                        + len(self._visible_pixels)
-            visible_diff = int(visibility * pix_count) -\
-                           len(self._visible_pixels)
-
-            if visible_diff > 0:
-                # we are going to make some pixels visible
-                for i in xrange(visible_diff):
-                    p_index = self._invisible_pixels.pop()
-                    self.texture_buffer[p_index] = self.PIXEL_MAX
-                    self._visible_pixels.append(p_index)
-            else:
-                # we are going to make some pixels invisible
-                for i in xrange(visible_diff * -1):
-                    p_index = self._visible_pixels.pop()
-                    self.texture_buffer[p_index] = self.PIXEL_MIN
-                    self._invisible_pixels.append(p_index)
-
-        self._label.texture.blit_buffer(self.texture_buffer,
-                                            colorfmt='rgba',
-                                            bufferfmt='ubyte')
-
-        self.shape_box.texture = self._label.texture
+        self._noise_mask.set_visibility(visibility)
+        self._blit()
         self._shape_visibility = visibility
 
+    @traced("shapes.blit")
+    def _blit(self):
+        self._shape_texture.blit_buffer(self.texture_buffer, colorfmt='rgba',
+                                        bufferfmt='ubyte')
+        self.shape_box.texture = self._shape_texture
+
     def _convert_shape(self, shape_index):
         """Convert shape to text"""
         return self.SHAPES[shape_index]
 
-    def set_shape(self, shape_index):
-        self.text = self._convert_shape(shape_index)
+    @traced("shapes.rasterize")
+    def _rasterize(self, text):
+        """Render text by the label, returns its rgba pixels"""
+        self.text = text
         self._label.refresh()
-        self.texture_buffer = numpy.fromstring(self._label.texture.pixels,
-                                               dtype=numpy.uint8)
-        alphas = self.texture_buffer[RGBA_SIZE - 1::RGBA_SIZE]
-        # reset [in]visible pixels buffers
-        self._invisible_pixels = []
-        self._visible_pixels = []
-        for index, item in enumerate(alphas):
-            if item != 0:
-                r_index = (index + 1) * RGBA_SIZE - 1
-                self._visible_pixels.append(r_index)
-        # shuffle the indexes so manipulation with visibility seems random
-        random.shuffle(self._visible_pixels)
+        texture = self._label.texture
+        buff = numpy.fromstring(texture.pixels, dtype=numpy.uint8)
+        self.text = ""
+        return buff, opaque_alphas(buff), texture.size
+
+    def _get_glyph(self, shape_index):
+        text = self._convert_shape(shape_index)
+        key = (self.__class__, text, self.font_size)
+        return glyph_cache.get(key, lambda: self._rasterize(text))
+
+    def _get_texture(self, size):
+        """Reuse texture of the same size if possible"""
+        texture = self._textures.get(size)
+        if texture is None:
+            texture = self._textures[size] = Texture.create(size=size,
+                                                            colorfmt='rgba')
+            # keep the orientation of textures rendered by core label
+            texture.flip_vertical()
+        self._shape_texture = texture
+        return texture
+
+    @traced("shapes.set_shape")
+    def set_shape(self, shape_index):
+        glyph = self._get_glyph(shape_index)
+        self.texture_buffer = glyph.buff.copy()
+        self._noise_mask = NoiseMask(self.texture_buffer, glyph.alpha_indexes)
+        texture = self._get_texture(glyph.size)
         if not self.shape_box:
             with self.canvas:
                 self.shape_box = Rectangle(size=self.size, pos=self.pos,
-                                           texture=self._label.texture)
+                                           texture=texture)
             self.bind(pos=self.reposition_shape_box,
                       size=self.resize_shape_box)
-        center_x = self.center_x - self._label.texture.size[0] / 2
-        center_y = self.center_y - self._label.texture.size[1] / 2
-        self.shape_visibility = self._init_visibility
+        center_x = self.center_x - glyph.size[0] / 2
+        center_y = self.center_y - glyph.size[1] / 2
+        # buffer holds a new shape -> it must be blitted in any case
+        self._noise_mask.set_visibility(self._init_visibility)
+        self._shape_visibility = self._init_visibility
+        self._blit()
         self.shape_box.pos = (center_x, center_y)
-        self.shape_box.size = self._label.texture.size
-        self.text = ""
+        self.shape_box.size = glyph.size
 
     def clear(self):
         self.shape_visibility = 0
 
+    def warm_up(self):
+        """Rasterize all shapes and allocate their textures, so displaying
+        a shape for the first time is not slower than later on"""
+        # warm-up would be counted among displayed shapes otherwise
+        with tracer.suspended():
+            for shape_index in xrange(len(self.SHAPES)):
+                self.set_shape(shape_index)
+            self.clear()
+
 
 @Shapes.register
 class BasicNumericShape(BaseLabelShape):
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""Load harness - simulated players play sessions in a process pool and
+store their results into statistics database.
+
+usage: python simulation.py [-h] [--db DB] [--levels LEVELS] ..."""
+
+__author__ = 'Tomas Novacik'
+
+import os
+# command line arguments belong to the harness, not to kivy
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+
+import argparse
+import collections
+import datetime
+import multiprocessing
+import shutil
+import tempfile
+import timeit
+import unittest
+
+import numpy
+
+import sequence
+import session
+from statistics import Statistics
+
+DEFAULT_ITEMS = 20
+DEFAULT_STEP_DURATION = 2.0
+# margin before the next onset, simulated reactions are clipped to end
+# this long before the next stimulus, so they are counted for their trial
+RESPONSE_WINDOW = 0.3
+MIN_REACTION_TIME = 0.1
+PERCENTILES = [50, 90, 99]
+
+
+class TestSimulatedPlayer(unittest.TestCase):
+    HISTORY = 2
+    LENGTH = 30
+
+    def setUp(self):
+        self.positions, self.shapes = sequence.generate_session(
+            self.LENGTH, self.HISTORY, seed=1)
+
+    def _play(self, player):
+        responses = player.responses(self.positions, self.shapes,
+                                     self.HISTORY, DEFAULT_STEP_DURATION)
+        return session.run(self.positions, self.shapes, self.HISTORY,
+                           responses, DEFAULT_STEP_DURATION)
+
+    def test_perfect_player(self):
+        outcomes, statistics = self._play(SimulatedPlayer(accuracy=1, seed=1))
+        self.assertEqual(statistics, (100.0, 100.0, 100.0))
+        latencies = [o.p_latency for o in outcomes if o.p_clicked]
+        self.assertTrue(latencies)
+        self.assertTrue(all(0 < latency < DEFAULT_STEP_DURATION
+                            for latency in latencies))
+
+    def test_inverse_player(self):
+        outcomes, statistics = self._play(SimulatedPlayer(accuracy=0, seed=1))
+        self.assertTrue(all(o.p_err and o.s_err for o in outcomes))
+
+    def test_reproducible(self):
+        first = SimulatedPlayer(seed=3).responses(
+            self.positions, self.shapes, self.HISTORY, DEFAULT_STEP_DURATION)
+        second = SimulatedPlayer(seed=3).responses(
+            self.positions, self.shapes, self.HISTORY, DEFAULT_STEP_DURATION)
+        self.assertEqual(first, second)
+
+
+class TestHarness(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, Statistics.DB_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_run(self):
+        levels = [1, 3]
+        report = run_harness(self.db_name, levels, sessions=6, processes=2,
+                             items=5)
+        self.assertEqual(report.sessions, 12)
+        self.assertEqual(sorted(report.scores), levels)
+        stats = Statistics(self.db_name)
+        self.assertEqual(stats.played_levels(), set(levels))
+
+        def count(table):
+            q = "SELECT COUNT(*) FROM %s" % table
+            return stats.connection.execute(q).fetchone()[0]
+
+        self.assertEqual(count(stats.TABLE_NAME), 12)
+        self.assertEqual(count(stats.TRIALS_TABLE_NAME),
+                         6 * (5 + 1) + 6 * (5 + 3))
+
+
+class SimulatedPlayer(object):
+    """Player responding correctly with given probability (separately for
+    positions and shapes), reaction times are normally distributed."""
+
+    def __init__(self, accuracy=0.8, rt_mean=0.7, rt_sd=0.2, seed=None):
+        self.accuracy = accuracy
+        self.rt_mean = rt_mean
+        self.rt_sd = rt_sd
+        self._rand = numpy.random.RandomState(seed)
+
+    def responses(self, positions, shapes, history, step_duration):
+        """Returns sorted (timestamp, modality) pairs of the whole session,
+        timestamps are relative to the first onset"""
+        responses = []
+        latest = step_duration - RESPONSE_WINDOW
+        for modality, items in [(session.POSITION, positions),
+                                (session.SHAPE, shapes)]:
+            matches = sequence.n_back_matches(items, history)
+            correct = self._rand.random_sample(len(matches)) < self.accuracy
+            reaction_times = self._rand.normal(self.rt_mean, self.rt_sd,
+                                               len(matches))
+            reaction_times = numpy.clip(reaction_times, MIN_REACTION_TIME,
+                                        latest)
+            # respond to matches when correct, to non matches when wrong
+            for index in numpy.flatnonzero(matches == correct):
+                trial = index + history
+                responses.append((trial * step_duration +
+                                  reaction_times[index], modality))
+        responses.sort()
+        return responses
+
+
+HarnessReport = collections.namedtuple("HarnessReport", [
+    "sessions", "elapsed", "write_latencies", "scores"])
+
+
+def _play(task):
+    """Play sessions of one level and store them, returns list of
+    (level, success rate, database write time) triples"""
+    db_name, level, first_session, sessions, items, seed, player_args = task
+    stats = Statistics(db_name)
+    player = SimulatedPlayer(seed=seed, **player_args)
+    positions, shapes = sequence.generate(sessions, items + level, level,
+                                          seed=seed)
+    # every session is played on a different day
+    start = datetime.datetime(2000, 1, 1)
+    results = []
+    for i in xrange(sessions):
+        responses = player.responses(positions[i], shapes[i], level,
+                                     DEFAULT_STEP_DURATION)
+        log = session.TrialLog(items + level)
+        outcomes, statistics = session.run(positions[i], shapes[i], level,
+                                           responses, DEFAULT_STEP_DURATION,
+                                           log=log)
+        date = start + datetime.timedelta(days=first_session + i,
+                                          seconds=level)
+        begin = timeit.default_timer()
+        stats.add(level, *statistics, item_count=items + level, date=date,
+                  trials=log.rows())
+        results.append((level, statistics[-1],
+                        timeit.default_timer() - begin))
+    stats.connection.close()
+    return results
+
+
+def run_harness(db_name, levels, sessions, processes=None,
+                items=DEFAULT_ITEMS, chunk_size=50, seed=0, **player_args):
+    """Play given number of sessions of every level in a pool of
+    processes, all results are written into db_name."""
+    # tables must exist before processes start to write
+    Statistics(db_name).connection.close()
+    tasks = []
+    for level in levels:
+        for first in xrange(0, sessions, chunk_size):
+            count = min(chunk_size, sessions - first)
+            tasks.append((db_name, level, first, count, items,
+                          seed + len(tasks), player_args))
+
+    pool = multiprocessing.Pool(processes)
+    begin = timeit.default_timer()
+    try:
+        results = pool.map(_play, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = timeit.default_timer() - begin
+
+    results = [item for chunk in results for item in chunk]
+    scores = collections.defaultdict(list)
+    for level, success, _ in results:
+        scores[level].append(success)
+    latencies = numpy.array([latency for _, _, latency in results])
+    return HarnessReport(len(results), elapsed, latencies,
+                         dict((level, numpy.array(values))
+                              for level, values in scores.items()))
+
+
+def format_report(report):
+    lines = ["Sessions: %s in %.2f s (%.1f sessions/s)"
+             % (report.sessions, report.elapsed,
+                report.sessions / report.elapsed)]
+    latencies = numpy.percentile(report.write_latencies, PERCENTILES) * 1000
+    lines.append("DB write latency [ms]: " + ", ".join(
+        "p%s %.2f" % item for item in zip(PERCENTILES, latencies)) +
+        ", max %.2f" % (report.write_latencies.max() * 1000))
+    lines.append("Success rate per level [%]:")
+    for level in sorted(report.scores):
+        scores = report.scores[level]
+        quartiles = numpy.percentile(scores, [25, 50, 75])
+        lines.append("  %2s-back: mean %.1f, sd %.1f, quartiles %s"
+                     % (level, scores.mean(), scores.std(),
+                        " / ".join("%.1f" % q for q in quartiles)))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="simulation.sqlite3",
+                        help="statistics database to write into")
+    parser.add_argument("--levels", default="1,2,3,4,5",
+                        help="comma separated n-back levels")
+    parser.add_argument("--sessions", type=int, default=1000,
+                        help="sessions per level")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--items", type=int, default=DEFAULT_ITEMS)
+    parser.add_argument("--accuracy", type=float, default=0.8)
+    parser.add_argument("--rt-mean", type=float, default=0.7)
+    parser.add_argument("--rt-sd", type=float, default=0.2)
+    args = parser.parse_args()
+    levels = [int(level) for level in args.levels.split(",")]
+    report = run_harness(args.db, levels, args.sessions, args.processes,
+                         args.items, accuracy=args.accuracy,
+                         rt_mean=args.rt_mean, rt_sd=args.rt_sd)
+    print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
+
+# eof
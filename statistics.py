@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.garden.graph import Graph, MeshLinePlot
 from kivy.uix.anchorlayout import AnchorLayout
 from kivy.uix.boxlayout import BoxLayout
@@ -12,13 +13,28 @@ from kivy.uix.spinner import Spinner
 Graph._with_stencilbuffer = False
 
 from basic_screen import BasicScreen
+from instrumentation import traced
 
 __author__ = 'Tomas Novacik'
 
+import collections
+import copy
 import datetime
+import functools
 import inspect
+import mock
+import multiprocessing
+import os
+import Queue
+import random
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import sqlite3 as lite
+import numpy
+from kivy.logger import Logger
 
 
 # TODO move clear_btn to the bottom
@@ -42,7 +58,7 @@ class TestStatistic(unittest.TestCase):
 
     def tearDown(self):
         # remove db file
-        import os
+        self.stats.connection.close()
         if os.path.exists(self.TEST_DB_NAME):
             os.remove(self.TEST_DB_NAME)
 
@@ -52,7 +68,49 @@ class TestStatistic(unittest.TestCase):
         cols = self.stats.connection.execute("PRAGMA table_info(%s);"
                                              % self.stats.TABLE_NAME).fetchall()
         col_names = {row[self.NAME_COL] for row in cols}
-        self.assertEqual(col_names, set(self.stats.TABLE_COLS))
+        self.assertEqual(col_names, set([self.stats.ID_COL,
+                                         self.stats.NOISE_COL,
+                                         self.stats.SESSIONS_COL] +
+                                        self.stats.TABLE_COLS))
+        self.assertEqual(self.stats.schema_version(),
+                         self.stats.SCHEMA_VERSION)
+
+    def test_migrate_legacy_db(self):
+        """Database created before migrations is upgraded in place"""
+        self.stats.connection.close()
+        os.remove(self.TEST_DB_NAME)
+        connection = lite.connect(self.TEST_DB_NAME)
+        connection.execute(LEGACY_SCHEMA)
+        rows = [(self.DUMMY_DATE, 3, 0.8, 0.9, 0.7, 20),
+                (datetime.datetime(2000, 1, 1), 4, 0.5, 0.6, 0.55, 21)]
+        connection.executemany("INSERT INTO statistics VALUES"
+                               " (?, ?, ?, ?, ?, ?)", rows)
+        connection.commit()
+        connection.close()
+
+        self.stats = Statistics(self.TEST_DB_NAME)
+        self.assertEqual(self.stats.schema_version(),
+                         self.stats.SCHEMA_VERSION)
+        self.assertEqual(self.stats.played_levels(), {3, 4})
+        self.assertEqual(self.stats.success_rates(level=4), [0.55])
+        # sessions with the same timestamp do not collide any more
+        self.stats.add(*self.TEST_ITEM, date=self.DUMMY_DATE)
+        self.assertEqual(self.stats.sessions_played(self.DUMMY_DATE), 2)
+        q = "SELECT %s FROM %s ORDER BY %s"
+        q %= (self.stats.ID_COL, self.stats.TABLE_NAME, self.stats.ID_COL)
+        ids = [row[0] for row in self.stats.connection.execute(q)]
+        self.assertEqual(ids, [1, 2, 3])
+        # the first vacuum enables incremental vacuum of old databases
+        self.stats.vacuum()
+        self.assertEqual(self.stats.connection.execute(
+            "PRAGMA auto_vacuum").fetchone()[0], INCREMENTAL_VACUUM)
+        self.assertEqual(self.stats.played_levels(), {3, 4})
+
+    def test_migrate_idempotent(self):
+        self.stats.add(*self.TEST_ITEM)
+        self.stats.connection.close()
+        self.stats = Statistics(self.TEST_DB_NAME)
+        self.assertEqual(len(self.stats.success_rates()), 1)
 
     def test_db_basic_operation(self):
         """Inserted items into db should be equal to gathered items"""
@@ -118,6 +176,15 @@ class TestStatistic(unittest.TestCase):
         expected_success_rate /= items_count
         self.assertEqual(self.stats.success_rate(), expected_success_rate)
 
+    def test_daily_summary(self):
+        self.assertEqual(self.stats.daily_summary(), (0, 0, 0))
+        self.stats.add(3, 0.8, 0.9, 0.5, 10)
+        self.stats.add(3, 0.8, 0.9, 1.0, 30)
+        self.stats.add(*self.TEST_ITEM, date=self.DUMMY_DATE)
+        self.assertEqual(self.stats.daily_summary(), (2, 40, 0.875))
+        self.assertEqual(self.stats.daily_summary(self.DUMMY_DATE),
+                         (1, 20, 0.7))
+
     def test_played_levels(self):
         # no items
         self.assertEqual(len(self.stats.played_levels()), 0)
@@ -156,6 +223,79 @@ class TestStatistic(unittest.TestCase):
         self.assertEqual(self.stats.success_rates(level=test_level),
                          expected_rates)
 
+    def test_success_series_short(self):
+        rates = [0.1, 0.2, 0.4]
+        for i, rate in enumerate(rates):
+            item = list(self.TEST_ITEM)
+            item[self.SUCCESS_RATE_COL] = rate
+            self.stats.add(*item, date=datetime.datetime(2000, 1, i + 1))
+        self.assertEqual(self.stats.success_series(), rates)
+        self.assertEqual(self.stats.success_series(
+            start=datetime.datetime(2000, 1, 2),
+            end=datetime.datetime(2000, 1, 3)), [0.2])
+        self.assertEqual(self.stats.success_series(level=1), [])
+
+    def test_success_series_downsampled(self):
+        # two sessions a day for 100 days, rate grows every day
+        for day in xrange(100):
+            for hour in [8, 20]:
+                item = list(self.TEST_ITEM)
+                item[self.SUCCESS_RATE_COL] = day / 100.0 + hour / 1000.0
+                date = datetime.datetime(2000, 1, 1, hour) + \
+                    datetime.timedelta(days=day)
+                self.stats.add(*item, date=date)
+        series = self.stats.success_series(points=10)
+        self.assertTrue(len(series) <= 10)
+        self.assertEqual(series, sorted(series))
+        self.assertAlmostEqual(series[0], 0.059, places=2)
+        self.assertAlmostEqual(series[-1], 0.959, places=2)
+        # short range is not downsampled
+        series = self.stats.success_series(
+            start=datetime.datetime(2000, 1, 2),
+            end=datetime.datetime(2000, 1, 4), points=10)
+        self.assertEqual(len(series), 4)
+
+    def test_load_columns(self):
+        self.stats.add(*self.TEST_ITEM, date=self.DUMMY_DATE, noise=0.5)
+        self.stats.add(4, 0.5, 0.6, 0.55, 21,
+                       date=datetime.datetime(2000, 1, 1, 12, 30))
+        sessions = self.stats.load_columns()
+        self.assertEqual(list(sessions.dtype.names),
+                         list(self.stats.ANALYTICS_DTYPES))
+        self.assertEqual(sessions["level"].tolist(), [3, 4])
+        self.assertEqual(sessions["date"].tolist(),
+                         [self.DUMMY_DATE,
+                          datetime.datetime(2000, 1, 1, 12, 30)])
+        self.assertEqual(sessions["count"].tolist(), [20, 21])
+        self.assertEqual(sessions["noise"][0], 0.5)
+        self.assertTrue(numpy.isnan(sessions["noise"][1]))
+
+        sessions = self.stats.load_columns(["success"], level=4)
+        self.assertEqual(sessions.dtype.names, ("success",))
+        self.assertEqual(sessions["success"].tolist(), [0.55])
+        self.assertEqual(len(self.stats.load_columns(level=5)), 0)
+
+    def test_add_trials(self):
+        trials = [(0, 0.0, 1, 2, None, 0.5, None, None),
+                  (1, 2.0, 1, 3, 0.25, None, True, False)]
+        self.stats.add(*self.TEST_ITEM, trials=trials)
+        self.stats.add(*self.TEST_ITEM)
+        q = "SELECT * FROM %s" % self.stats.TRIALS_TABLE_NAME
+        rows = self.stats.connection.execute(q).fetchall()
+        session = rows[0][0]
+        self.assertEqual([row[0] for row in rows], [session] * 2)
+        self.assertEqual([row[1:] for row in rows], [
+            (0, 0.0, 1, 2, None, 0.5, None, None),
+            (1, 2.0, 1, 3, 0.25, None, 1, 0)])
+
+    def test_add_many_rolled_back(self):
+        results = [tuple(self.TEST_ITEM) + (self.DUMMY_DATE,),
+                   tuple(self.TEST_ITEM) + (self.DUMMY_DATE, [5])]
+        self.assertRaises(TypeError, self.stats.add_many, results)
+        # rows added before the error are not committed by next write
+        self.stats.add(*self.TEST_ITEM)
+        self.assertEqual(len(self.stats.success_rates()), 1)
+
     def test_delete_rows(self):
         test_lvl = 3
         lvl_range = range(10)
@@ -172,9 +312,133 @@ class TestStatistic(unittest.TestCase):
         self.stats.delete_rows()
         self.assertEqual(len(self.stats.get()), 0)
 
+    def test_delete_rows_trials(self):
+        trials = [(0, 0.0, 1, 2, None, None, None, None)]
+        for lvl in xrange(2):
+            test_item = [i for i in self.TEST_ITEM]
+            test_item[self.LEVEL_COL] = lvl
+            self.stats.add(*test_item, trials=trials)
+        self.stats.delete_rows(0)
+        q = "SELECT COUNT(*) FROM %s" % self.stats.TRIALS_TABLE_NAME
+        self.assertEqual(self.stats.connection.execute(q).fetchone()[0], 1)
+
+    def test_compact(self):
+        trials = [(0, 0.0, 1, 2, None, None, None, None)]
+        now = datetime.datetime(2000, 3, 1, 12)
+        # three days of two levels played twice a day, the last one recent
+        for day in [1, 2, 28]:
+            for level, hour in [(3, 8), (3, 20), (4, 9), (4, 10)]:
+                date = datetime.datetime(2000, 2, day, hour)
+                self.stats.add(level, 0.5, 0.4 + level / 10.0,
+                               hour / 100.0, level * 5 + hour, date,
+                               trials=trials)
+        days = [datetime.datetime(2000, 2, day) for day in [1, 2, 28]]
+        summaries = [self.stats.daily_summary(day) for day in days]
+        series = self.stats.success_series(level=3, points=3)
+        max_age = datetime.timedelta(days=7)
+        self.assertEqual(self.stats.compact(max_age, now), 4)
+        self.assertEqual(len(self.stats.success_rates()), 8)
+        self.assertEqual([self.stats.daily_summary(day) for day in days],
+                         summaries)
+        self.assertEqual(self.stats.success_series(level=3, points=3),
+                         series)
+        self.assertEqual(self.stats.played_levels(), {3, 4})
+        q = "SELECT COUNT(*) FROM %s" % self.stats.TRIALS_TABLE_NAME
+        self.assertEqual(self.stats.connection.execute(q).fetchone()[0], 4)
+        # compacted days are not rolled up again
+        self.assertEqual(self.stats.compact(max_age, now), 0)
+
+    def test_compact_single_sessions(self):
+        trials = [(0, 0.0, 1, 2, None, None, None, None)] * 20
+        for day in xrange(1, 31):
+            self.stats.add(3, 0.5, 0.5, 0.5, 20,
+                           datetime.datetime(2000, 1, day, 10),
+                           trials=trials)
+        now = datetime.datetime(2000, 1, 31)
+        self.assertEqual(self.stats.compact(datetime.timedelta(days=1), now),
+                         0)
+        self.assertEqual(len(self.stats.success_rates()), 30)
+        # only trials of the last day are kept
+        q = "SELECT COUNT(*) FROM %s" % self.stats.TRIALS_TABLE_NAME
+        self.assertEqual(self.stats.connection.execute(q).fetchone()[0], 20)
+
+    def test_compact_noise(self):
+        date = datetime.datetime(2000, 1, 1)
+        for count, noise in [(10, 0.0), (40, 0.8), (10, None)]:
+            self.stats.add(3, 0.5, 0.5, 0.5, count, date, noise=noise)
+        self.stats.compact(datetime.timedelta(days=1),
+                           datetime.datetime(2000, 2, 1))
+        q = "SELECT %s FROM %s" % (self.stats.NOISE_COL,
+                                   self.stats.TABLE_NAME)
+        self.assertAlmostEqual(
+            self.stats.connection.execute(q).fetchone()[0], 0.64)
+
+    def test_vacuum(self):
+        self.stats.vacuum()
+        self.assertEqual(self.stats.connection.execute(
+            "PRAGMA auto_vacuum").fetchone()[0], INCREMENTAL_VACUUM)
+
+
+# statistics table as created before schema migrations were introduced
+LEGACY_SCHEMA = "CREATE TABLE statistics (date date PRIMARY KEY default" \
+                " current_timestamp, level integer, position real," \
+                " shape real, success real, count integer)"
 
 DATE_ARG = "date"
 
+# seconds a connection waits for a lock held by other connection
+BUSY_TIMEOUT = 5.0
+# PRAGMA auto_vacuum value of incremental vacuum
+INCREMENTAL_VACUUM = 2
+# attempts of a write failing on a lock
+WRITE_ATTEMPTS = 5
+# seconds to wait before the second attempt, doubled for every next one
+RETRY_DELAY = 0.05
+
+
+def connect(db_name, timeout=BUSY_TIMEOUT):
+    """Returns connection to the statistics database which can be shared
+    by many processes. Every process and thread must open its own
+    connection, sqlite connections cannot be shared."""
+    connection = lite.connect(db_name, timeout=timeout)
+    # free pages can be returned to the file system without rebuilding
+    # the whole file, has effect only on new databases
+    connection.execute("PRAGMA auto_vacuum = %d" % INCREMENTAL_VACUUM)
+    # readers do not block the writer and vice versa
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+def _is_locked(error):
+    message = str(error)
+    return "locked" in message or "busy" in message
+
+
+def retry_when_locked(fn):
+    """Retry write method of Statistics when the database stays locked by
+    other writers longer than busy timeout (or sqlite gives up waiting
+    to avoid a deadlock). Open transaction is rolled back before next
+    attempt, delays grow exponentially with random jitter. Transaction
+    is rolled back on any other error too, so rows written before the
+    error are not committed by the next write."""
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        for attempt in xrange(WRITE_ATTEMPTS):
+            try:
+                return fn(self, *args, **kwargs)
+            except lite.OperationalError as e:
+                self.connection.rollback()
+                if not _is_locked(e) or attempt == WRITE_ATTEMPTS - 1:
+                    raise
+                Logger.warning("Statistics: database locked, retrying")
+                time.sleep(RETRY_DELAY * 2 ** attempt *
+                           random.uniform(0.5, 1.5))
+            except Exception:
+                self.connection.rollback()
+                raise
+    return wrapper
+
 
 def set_date_if_not_set(fn):
     """Automatically sets the date argument of a function/method
@@ -196,6 +460,153 @@ def set_date_if_not_set(fn):
     return wrapper
 
 
+class TestQueryCache(unittest.TestCase):
+    TEST_DB_NAME = "test_query_cache.sqlite3"
+    TEST_ITEM = [3, 0.8, 0.9, 0.7, 20]
+
+    def setUp(self):
+        self.stats = Statistics(self.TEST_DB_NAME)
+
+    def tearDown(self):
+        self.stats.connection.close()
+        os.remove(self.TEST_DB_NAME)
+
+    def test_hit(self):
+        self.stats.add(*self.TEST_ITEM)
+        self.stats.connection = mock.Mock(wraps=self.stats.connection)
+        for _ in xrange(3):
+            self.assertEqual(self.stats.success_rates(level=3), [0.7])
+            self.assertEqual(self.stats.played_levels(), {3})
+            self.assertEqual(self.stats.daily_summary().sessions, 1)
+        self.assertEqual(self.stats.cache.misses, 3)
+        self.assertEqual(self.stats.cache.hits, 6)
+        # played_levels needs one query per level and one more
+        self.assertEqual(self.stats.connection.execute.call_count, 4)
+
+    def test_arguments(self):
+        self.stats.add(*self.TEST_ITEM)
+        self.assertEqual(self.stats.success_rates(level=3), [0.7])
+        self.assertEqual(self.stats.success_rates(level=4), [])
+
+    def test_invalidated_by_writes(self):
+        self.assertEqual(self.stats.played_levels(), set())
+        self.stats.add(*self.TEST_ITEM)
+        self.assertEqual(self.stats.played_levels(), {3})
+        self.stats.delete_rows()
+        self.assertEqual(self.stats.played_levels(), set())
+        self.assertEqual(self.stats.cache.hits, 0)
+
+    def test_result_copied(self):
+        self.stats.add(*self.TEST_ITEM)
+        self.stats.success_rates(level=3).append(1)
+        self.assertEqual(self.stats.success_rates(level=3), [0.7])
+
+    def test_bounded(self):
+        cache = QueryCache(size=2)
+        for key in xrange(3):
+            cache.get(key, lambda: key)
+        self.assertEqual(len(cache), 2)
+        cache.get(0, lambda: 0)
+        self.assertEqual(cache.misses, 4)
+
+    def test_stale_result_not_stored(self):
+        cache = QueryCache()
+
+        def query():
+            # write committed by other thread while the query runs
+            cache.invalidate()
+            return 1
+
+        cache.get("key", query)
+        self.assertEqual(len(cache), 0)
+
+
+class QueryCache(object):
+    """Bounded LRU cache of query results.
+
+    Results are valid until the next write to the database, writes from
+    other threads invalidate the cache too - a result of a query which
+    was running during invalidation is not stored."""
+
+    DEFAULT_SIZE = 128
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    @property
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return float(self.hits) / requests if requests else 0.0
+
+    def get(self, key, query):
+        """Returns result stored under key, query is called on cache miss"""
+        with self._lock:
+            if key in self._results:
+                result = self._results.pop(key)
+                self._results[key] = result
+                self.hits += 1
+                return result
+            self.misses += 1
+            generation = self._generation
+        result = query()
+        with self._lock:
+            if generation == self._generation:
+                if len(self._results) >= self.size:
+                    self._results.popitem(last=False)
+                self._results[key] = result
+        return result
+
+    def invalidate(self):
+        """Drop all results, called after every write"""
+        with self._lock:
+            self._results.clear()
+            self._generation += 1
+
+
+def cached(fn):
+    """Memoize results of a read query method in its instance cache, the
+    results are copied so callers cannot modify the cached ones"""
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        key = (fn.__name__, args, tuple(sorted(kwargs.items())))
+        return copy.copy(self.cache.get(key,
+                                        lambda: fn(self, *args, **kwargs)))
+    return wrapper
+
+
+# rows fetched or inserted at once by bulk operations
+IO_CHUNK_SIZE = 10000
+
+# maximal length of success rate series
+SERIES_POINTS = 200
+
+# julian day of 1970-01-01
+UNIX_EPOCH_DAYS = 2440587.5
+MS_PER_DAY = 86400000
+
+JULIAN_DAY_EPOCH = datetime.datetime(2000, 1, 1)
+# julian day of the epoch
+JULIAN_DAY_EPOCH_DAYS = 2451544.5
+
+
+def from_julian_day(day):
+    """Convert julian day (as returned by sqlite julianday) to datetime"""
+    return JULIAN_DAY_EPOCH + datetime.timedelta(
+        days=day - JULIAN_DAY_EPOCH_DAYS)
+
+
+DailySummary = collections.namedtuple("DailySummary", [
+    "sessions", "items", "success_rate"])
+
+
 class Statistics(object):
     """Store overall statistics """
 
@@ -210,37 +621,189 @@ class Statistics(object):
     COUNT_COL = "count"
     TABLE_COLS = [DATE_COL, LEVEL_COL, POSITION_COL, SHAPE_COL, SUCCESS_COL,
                   COUNT_COL]
+    # added by migration to version 3
+    NOISE_COL = "noise"
+    # added by migration to version 4, count of sessions rolled up into
+    # the row by compaction
+    SESSIONS_COL = "sessions"
 
-    def __init__(self, db_name=DB_NAME):
-        self.db_name = db_name
-        self.connection = lite.connect(self.db_name)
-        if not self._table_exists(self.TABLE_NAME):
-            self._create_statistics_table()
+    ID_COL = "id"
+
+    TRIALS_TABLE_NAME = "trials"
+    SESSION_COL = "session"
+    TRIALS_COLS = [SESSION_COL, "trial", "onset", "position", "shape",
+                   "p_latency", "s_latency", "p_correct", "s_correct"]
 
-    def _table_exists(self, table_name):
-        query = "SELECT name FROM sqlite_master WHERE type=? AND name=?"
-        result = self.connection.execute(query, ("table", table_name))
-        return bool(result.fetchone())
+    # numpy types of columns returned by load_columns
+    ANALYTICS_DTYPES = collections.OrderedDict([
+        (ID_COL, numpy.int64), (DATE_COL, "datetime64[ms]"),
+        (LEVEL_COL, numpy.int64), (POSITION_COL, numpy.float64),
+        (SHAPE_COL, numpy.float64), (SUCCESS_COL, numpy.float64),
+        (COUNT_COL, numpy.int64), (NOISE_COL, numpy.float64),
+        (SESSIONS_COL, numpy.int64)])
 
-    def _create_statistics_table(self):
+    # columns of exported and imported sessions
+    TRANSFER_COLS = TABLE_COLS + [NOISE_COL, SESSIONS_COL]
+
+    # stored in the database as PRAGMA user_version
+    SCHEMA_VERSION = 4
+
+    def __init__(self, db_name=DB_NAME):
+        self.db_name = db_name
+        self.cache = QueryCache()
+        self.connection = connect(self.db_name)
+        self._migrate()
+
+    def schema_version(self):
+        return self.connection.execute("PRAGMA user_version").fetchone()[0]
+
+    def _migrations(self):
+        """Statement lists of all migrations, migration at index i upgrades
+        the schema to version i + 1"""
+        return [self._create_tables(), self._add_id_and_indexes(),
+                self._add_noise(), self._add_sessions()]
+
+    def _migrate(self):
+        """Upgrade database schema to SCHEMA_VERSION in place, every
+        migration is run in its own transaction"""
+        if self.schema_version() >= self.SCHEMA_VERSION:
+            return
+        # transactions are handled explicitly here
+        isolation_level = self.connection.isolation_level
+        self.connection.isolation_level = None
+        try:
+            for version, statements in enumerate(self._migrations(), 1):
+                self.connection.execute("BEGIN IMMEDIATE")
+                try:
+                    # other connection could migrate the database meanwhile
+                    if self.schema_version() < version:
+                        for statement in statements:
+                            self.connection.execute(statement)
+                        self.connection.execute("PRAGMA user_version = %d"
+                                                % version)
+                    self.connection.execute("COMMIT")
+                except Exception:
+                    self.connection.execute("ROLLBACK")
+                    raise
+        finally:
+            self.connection.isolation_level = isolation_level
+
+    def _create_tables(self):
         """Create statistics table that contains current timestamp as id,
         nback level, position success rate, shape success rate,
-        overall success rate and items displayed during session"""
-        q = "CREATE TABLE %s (%s date PRIMARY KEY default current_timestamp," \
-            "%s integer, %s real, %s real, %s real, %s integer)"
-        q %= tuple([self.TABLE_NAME] + self.TABLE_COLS)
-        self.connection.execute(q)
-        self.connection.commit()
+        overall success rate and items displayed during session.
+
+        Trials table contains all trials of sessions, session is id of
+        the session in statistics table, onset is relative to the onset of
+        the first trial, latencies are in seconds from onset.
 
+        Databases created before migrations have these tables already."""
+        q = "CREATE TABLE IF NOT EXISTS %s (%s date PRIMARY KEY" \
+            " default current_timestamp," \
+            "%s integer, %s real, %s real, %s real, %s integer)"
+        statistics = q % tuple([self.TABLE_NAME] + self.TABLE_COLS)
+        q = "CREATE TABLE IF NOT EXISTS %s (%s integer, %s integer, %s real," \
+            " %s integer, %s integer, %s real, %s real, %s integer," \
+            " %s integer)"
+        trials = q % tuple([self.TRIALS_TABLE_NAME] + self.TRIALS_COLS)
+        return [statistics, trials]
+
+    def _add_id_and_indexes(self):
+        """Replace date primary key by surrogate id (sessions with the same
+        timestamp collided), ids are the former rowids so trials stay
+        linked to their sessions. Indexes cover queries by level and by
+        date."""
+        tmp_table = self.TABLE_NAME + "_new"
+        q = "CREATE TABLE %s (%s integer PRIMARY KEY AUTOINCREMENT," \
+            " %s date NOT NULL default current_timestamp," \
+            " %s integer, %s real, %s real, %s real, %s integer)"
+        create = q % tuple([tmp_table, self.ID_COL] + self.TABLE_COLS)
+        cols = ", ".join(self.TABLE_COLS)
+        copy = "INSERT INTO %s (%s, %s) SELECT rowid, %s FROM %s" \
+               % (tmp_table, self.ID_COL, cols, cols, self.TABLE_NAME)
+        q = "CREATE INDEX %s_%s ON %s (%s)"
+        return [
+            create, copy,
+            "DROP TABLE %s" % self.TABLE_NAME,
+            "ALTER TABLE %s RENAME TO %s" % (tmp_table, self.TABLE_NAME),
+            q % (self.TABLE_NAME, "level_date", self.TABLE_NAME,
+                 ", ".join([self.LEVEL_COL, self.DATE_COL, self.SUCCESS_COL])),
+            q % (self.TABLE_NAME, "date", self.TABLE_NAME,
+                 ", ".join([self.DATE_COL, self.COUNT_COL, self.SUCCESS_COL])),
+            q % (self.TRIALS_TABLE_NAME, self.SESSION_COL,
+                 self.TRIALS_TABLE_NAME, self.SESSION_COL)]
+
+    def _add_noise(self):
+        """Noise level shapes were displayed with, unknown (NULL) for
+        sessions played before"""
+        return ["ALTER TABLE %s ADD COLUMN %s real"
+                % (self.TABLE_NAME, self.NOISE_COL)]
+
+    def _add_sessions(self):
+        """Every row is one session until it is rolled up by compaction.
+        Indexes are extended by the columns item weighted queries need."""
+        q = "CREATE INDEX %s_%s ON %s (%s)"
+        return [
+            "ALTER TABLE %s ADD COLUMN %s integer NOT NULL DEFAULT 1"
+            % (self.TABLE_NAME, self.SESSIONS_COL),
+            "DROP INDEX %s_level_date" % self.TABLE_NAME,
+            "DROP INDEX %s_date" % self.TABLE_NAME,
+            q % (self.TABLE_NAME, "level_date", self.TABLE_NAME,
+                 ", ".join([self.LEVEL_COL, self.DATE_COL, self.SUCCESS_COL,
+                            self.COUNT_COL])),
+            q % (self.TABLE_NAME, "date", self.TABLE_NAME,
+                 ", ".join([self.DATE_COL, self.COUNT_COL, self.SUCCESS_COL,
+                            self.SESSIONS_COL]))]
+
+    # set_date_if_not_set must be innermost, it inspects arguments of add
+    @traced("statistics.add")
+    @retry_when_locked
     @set_date_if_not_set
-    def add(self, level, position, shape, success, item_count, date=None):
-        """Add game results"""
-        q = "INSERT INTO %s (%s, %s, %s, %s, %s, %s)" \
-            " values (?, ?, ?, ?, ?, ?)"
-        q %= tuple([self.TABLE_NAME] + self.TABLE_COLS)
-        self.connection.execute(q, (date, level, position, shape, success,
-                                    item_count))
+    def add(self, level, position, shape, success, item_count, date=None,
+            trials=None, noise=None):
+        """Add game results, trials are (trial, onset, position, shape,
+        p_latency, s_latency, p_correct, s_correct) tuples, everything is
+        written in one transaction"""
+        self._insert(level, position, shape, success, item_count, date,
+                     trials, noise)
+        self.connection.commit()
+        self.cache.invalidate()
+
+    @traced("statistics.add_many")
+    @retry_when_locked
+    def add_many(self, results, skip_stored=False):
+        """Add results (tuples of add arguments, date included) in one
+        transaction. When skip_stored is set, results with level, date
+        and success rate equal to a stored session are skipped (e.g.
+        results sent twice). Returns count of added results."""
+        q = "SELECT %s" % self._stored_condition()
+        added = 0
+        for result in results:
+            level, success, date = result[0], result[3], result[5]
+            params = self._stored_params(level, date, success)
+            if skip_stored and \
+                    self.connection.execute(q, params).fetchone()[0]:
+                continue
+            self._insert(*result)
+            added += 1
         self.connection.commit()
+        self.cache.invalidate()
+        return added
+
+    def _insert(self, level, position, shape, success, item_count, date,
+                trials=None, noise=None):
+        q = "INSERT INTO %s (%s, %s, %s, %s, %s, %s, %s)" \
+            " values (?, ?, ?, ?, ?, ?, ?)"
+        q %= tuple([self.TABLE_NAME] + self.TABLE_COLS + [self.NOISE_COL])
+        cur = self.connection.execute(q, (date, level, position, shape,
+                                          success, item_count, noise))
+        if trials is not None:
+            session = cur.lastrowid
+            q = "INSERT INTO %s VALUES (%s)"
+            q %= (self.TRIALS_TABLE_NAME,
+                  ", ".join("?" * len(self.TRIALS_COLS)))
+            self.connection.executemany(q, ((session,) + tuple(trial)
+                                            for trial in trials))
 
     def get(self, level=None):
         """Gather new statistics for given n-back level,
@@ -256,63 +819,225 @@ class Statistics(object):
         cur = self.connection.execute(q, params)
         return cur.fetchall()
 
+    @set_date_if_not_set
+    def daily_summary(self, date=None):
+        """Returns sessions played, items tested and success rate (weighted
+        by item count) of given day, computed by one query served by the
+        date index"""
+        # cached per day, not per timestamp
+        return self._daily_summary(date.date())
+
+    @cached
+    def _daily_summary(self, date):
+        q = "select SUM(%s), SUM(%s), SUM(%s * %s) from %s" \
+            " where date >= date(?) AND date <  date(?, '+1 day')"
+        q %= (self.SESSIONS_COL, self.COUNT_COL, self.COUNT_COL,
+              self.SUCCESS_COL, self.TABLE_NAME)
+        sessions, items, success = self.connection.execute(
+            q, (date, date)).fetchone()
+        if not sessions:
+            return DailySummary(0, 0, 0.0)
+        return DailySummary(sessions, items, success / float(items))
+
     @set_date_if_not_set
     def sessions_played(self, date=None):
         """Returns how many sessions have been played on given day"""
-        q = "select COUNT(*) from %s" \
-            " where date >= date(?) AND date <  date(?, '+1 day')"
-        q %= self.TABLE_NAME
-        cur = self.connection.execute(q, (date, date))
-        return cur.fetchone()[0]
+        return self.daily_summary(date).sessions
 
     @set_date_if_not_set
     def tested_items(self, date=None):
         """Returns how many items were tested on given day"""
-        q = "select SUM(%s) from %s" \
-            " where date >= date(?) AND date <  date(?, '+1 day')"
-        q %= (self.COUNT_COL, self.TABLE_NAME)
-        cur = self.connection.execute(q, (date, date)).fetchone()[0]
-        result = 0 if cur is None else cur
-        return result
+        return self.daily_summary(date).items
 
     @set_date_if_not_set
     def success_rate(self, date=None):
-        q = "select %s, %s from %s" \
-            " where date >= date(?) AND date <  date(?, '+1 day')"
-        q %= (self.COUNT_COL, self.SUCCESS_COL, self.TABLE_NAME)
-        rows = self.connection.execute(q, (date, date)).fetchall()
-        success = 0.0
-        item_count = 0.0
-        if rows:
-            for row in rows:
-                success += row[0] * row[1]
-                item_count += row[0]
-            success /= item_count
-        return success
-
-    def success_rates(self, level=None):
-        q = "select %s from %s where %s = ? ORDER BY %s ASC"
-        # if level is None select all success rates for any level
-        if level is None:
-            params = (self.SUCCESS_COL, self.TABLE_NAME, 1,
-                      self.DATE_COL)
-            values = (1,)
-        else:
-            params = (self.SUCCESS_COL, self.TABLE_NAME, self.LEVEL_COL,
-                      self.DATE_COL)
-            values = (level,)
-        q %= params
+        return self.daily_summary(date).success_rate
+
+    @cached
+    def success_rates(self, level=None, start=None, end=None):
+        """Success rates of all sessions played in [start, end)"""
+        where, values = self._where(level, start, end)
+        q = "select %s from %s%s ORDER BY %s ASC"
+        q %= (self.SUCCESS_COL, self.TABLE_NAME, where, self.DATE_COL)
         rates = [i[0] for i in self.connection.execute(q, values).fetchall()]
         return rates
 
+    def _where(self, level=None, start=None, end=None):
+        """Returns where clause and its parameters selecting sessions of
+        given level (any level if None) played in [start, end)"""
+        conditions = []
+        values = []
+        # if level is None select sessions of any level
+        for col, op, value in [(self.LEVEL_COL, "=", level),
+                               (self.DATE_COL, ">=", start),
+                               (self.DATE_COL, "<", end)]:
+            if value is not None:
+                conditions.append("%s %s ?" % (col, op))
+                values.append(value)
+        if not conditions:
+            return "", ()
+        return " where " + " AND ".join(conditions), tuple(values)
+
+    @cached
+    def success_series(self, level=None, start=None, end=None,
+                       points=SERIES_POINTS):
+        """Returns at most 'points' success rates of sessions played in
+        [start, end) in date order. Longer history is split into equally
+        long time buckets and success rate (weighted by item count) of
+        every non empty bucket is returned. Count of plotted points is
+        bounded, the buckets are still summed from every session of the
+        range (in the covering indexes), so the cost is linear in count of
+        sessions in the range."""
+        where, values = self._where(level, start, end)
+        # sessions are counted only up to the first one over points
+        q = "select COUNT(*) from (select 1 from %s%s limit ?)"
+        count = self.connection.execute(q % (self.TABLE_NAME, where),
+                                        values + (points + 1,)).fetchone()[0]
+        if count <= points:
+            return self.success_rates(level, start, end)
+        # separate queries, sqlite looks up MIN or MAX alone in the index
+        # but scans all rows for both of them in one query
+        q = "select %s from %s%s"
+        first, last = [
+            self.connection.execute(q % (col, self.TABLE_NAME, where),
+                                    values).fetchone()[0]
+            for col in ["julianday(MIN(%s))" % self.DATE_COL,
+                        "julianday(MAX(%s))" % self.DATE_COL]]
+        # one range query per bucket is served by the covering indexes,
+        # grouping by an expression computed from date would not be
+        step = (last - first) / points
+        bounds = [start] + [from_julian_day(first + i * step)
+                            for i in xrange(1, points)] + [end]
+        series = []
+        for bucket_start, bucket_end in zip(bounds, bounds[1:]):
+            where, values = self._where(level, bucket_start, bucket_end)
+            q = "select SUM(%s * %s) / SUM(%s) from %s%s"
+            q %= (self.SUCCESS_COL, self.COUNT_COL, self.COUNT_COL,
+                  self.TABLE_NAME, where)
+            rate = self.connection.execute(q, values).fetchone()[0]
+            if rate is not None:
+                series.append(rate)
+        return series
+
+    def load_columns(self, columns=None, level=None, start=None, end=None):
+        """Returns sessions played in [start, end) ordered by date as numpy
+        structured array, fetched at once. Columns are ANALYTICS_DTYPES
+        keys (all by default), dates are datetime64 and unknown values
+        of float columns are NaN."""
+        if columns is None:
+            columns = list(self.ANALYTICS_DTYPES)
+        select = []
+        for col in columns:
+            if col == self.DATE_COL:
+                # milliseconds since unix epoch
+                col = "(julianday(%s) - %s) * %s" % (col, UNIX_EPOCH_DAYS,
+                                                     MS_PER_DAY)
+            select.append(col)
+        where, values = self._where(level, start, end)
+        q = "select %s from %s%s ORDER BY %s"
+        q %= (", ".join(select), self.TABLE_NAME, where, self.DATE_COL)
+        # dates are fetched as floats and converted afterwards
+        fetched = numpy.array(
+            self.connection.execute(q, values).fetchall(),
+            dtype=[(col, numpy.float64 if col == self.DATE_COL
+                    else self.ANALYTICS_DTYPES[col]) for col in columns])
+        if self.DATE_COL not in columns:
+            return fetched
+        sessions = numpy.empty(len(fetched), dtype=[
+            (col, self.ANALYTICS_DTYPES[col]) for col in columns])
+        for col in columns:
+            if col == self.DATE_COL:
+                sessions[col] = numpy.round(fetched[col]).astype(
+                    numpy.int64).view(sessions.dtype[col])
+            else:
+                sessions[col] = fetched[col]
+        return sessions
+
+    @cached
     def played_levels(self):
         """Gathers from db the overall set of different levels played."""
-        q = "select distinct %s from %s"
-        q %= (self.LEVEL_COL, self.TABLE_NAME)
-        rows = self.connection.execute(q)
-        levels = [row[0] for row in rows.fetchall()]
-        return set(levels)
+        # one index lookup per played level instead of scanning all rows
+        q = "select min(%s) from %s where %s > ?"
+        q %= (self.LEVEL_COL, self.TABLE_NAME, self.LEVEL_COL)
+        levels = set()
+        level = self.connection.execute(q, (-1,)).fetchone()[0]
+        while level is not None:
+            levels.add(level)
+            level = self.connection.execute(q, (level,)).fetchone()[0]
+        return levels
+
+    def iter_sessions(self, chunk_size=IO_CHUNK_SIZE):
+        """Yields all sessions as tuples of TRANSFER_COLS values ordered by
+        date, rows are fetched in chunks so memory use does not depend on
+        database size"""
+        q = "select %s from %s ORDER BY %s"
+        q %= (", ".join(self.TRANSFER_COLS), self.TABLE_NAME, self.DATE_COL)
+        # own cursor, rows are not affected by other queries
+        cursor = self.connection.cursor()
+        cursor.execute(q)
+        rows = cursor.fetchmany(chunk_size)
+        while rows:
+            for row in rows:
+                yield row
+            rows = cursor.fetchmany(chunk_size)
+        cursor.close()
+
+    def _stored_condition(self):
+        """Returns SQL condition which is true if a session given by
+        _stored_params is stored already. Sessions are equal if they
+        have the same level, date and success rate. Rolled up day has
+        other date and success rate than its sessions, so a rolled up
+        day (stored or given) equals any session of its level and day."""
+        q = "EXISTS (SELECT 1 FROM %(table)s WHERE %(level)s = ? AND" \
+            " %(date)s = ? AND %(success)s = ?) OR EXISTS (SELECT 1 FROM" \
+            " %(table)s WHERE %(level)s = ? AND %(date)s >= date(?) AND" \
+            " %(date)s < date(?, '+1 day') AND (%(sessions)s > 1 OR ? > 1))"
+        return q % {"table": self.TABLE_NAME, "level": self.LEVEL_COL,
+                    "date": self.DATE_COL, "success": self.SUCCESS_COL,
+                    "sessions": self.SESSIONS_COL}
+
+    @staticmethod
+    def _stored_params(level, date, success, sessions=1):
+        if sessions is None:
+            sessions = 1
+        return (level, date, success, level, date, date, sessions)
+
+    def import_sessions(self, sessions, chunk_size=IO_CHUNK_SIZE):
+        """Insert sessions (tuples of TRANSFER_COLS values), every chunk is
+        inserted in its own transaction. Sessions equal to a stored session
+        are skipped (see _stored_condition), so days rolled up by
+        compaction in one of the databases are not duplicated. Unknown
+        (None) count of sessions is taken as one session.
+
+        Returns count of inserted sessions."""
+        cols = ", ".join(self.TRANSFER_COLS)
+        values = ["?"] * len(self.TRANSFER_COLS)
+        values[self.TRANSFER_COLS.index(self.SESSIONS_COL)] = "COALESCE(?, 1)"
+        q = "INSERT INTO %s (%s) SELECT %s WHERE NOT (%s)"
+        q %= (self.TABLE_NAME, cols, ", ".join(values),
+              self._stored_condition())
+        key = [self.TRANSFER_COLS.index(col) for col in
+               [self.LEVEL_COL, self.DATE_COL, self.SUCCESS_COL,
+                self.SESSIONS_COL]]
+        changes = self.connection.total_changes
+        chunk = []
+        for session in sessions:
+            chunk.append(tuple(session) +
+                         self._stored_params(*[session[i] for i in key]))
+            if len(chunk) >= chunk_size:
+                self._insert_chunk(q, chunk)
+                chunk = []
+        if chunk:
+            self._insert_chunk(q, chunk)
+        return self.connection.total_changes - changes
+
+    @retry_when_locked
+    def _insert_chunk(self, query, chunk):
+        self.connection.executemany(query, chunk)
+        self.connection.commit()
+        self.cache.invalidate()
 
+    @retry_when_locked
     def delete_rows(self, level=None):
         q = "DELETE FROM %s" % self.TABLE_NAME
         params = ()
@@ -320,7 +1045,547 @@ class Statistics(object):
             q += " WHERE %s=?" % self.LEVEL_COL
             params = (level,)
         self.connection.execute(q, params)
+        self._delete_orphan_trials()
         self.connection.commit()
+        self.cache.invalidate()
+
+    def _delete_orphan_trials(self):
+        """Remove trials of deleted sessions"""
+        q = "DELETE FROM %s WHERE %s NOT IN (SELECT %s FROM %s)"
+        q %= (self.TRIALS_TABLE_NAME, self.SESSION_COL, self.ID_COL,
+              self.TABLE_NAME)
+        self.connection.execute(q)
+
+    @retry_when_locked
+    @set_date_if_not_set
+    def compact(self, max_age, date=None):
+        """Roll sessions played before the day of 'date - max_age' up into
+        one row per day and level. The row keeps count of sessions and
+        items and success rates weighted by items, so daily summaries stay
+        the same. Downsampled success series stay the same as long as
+        their buckets are not shorter than a day, short series return one
+        success rate per rolled up day instead of one per session, days of
+        a single session are kept as they are. Trials of all sessions
+        played before the day are deleted, vacuum returns the free pages
+        to the file system. Returns count of removed rows."""
+        end = (date - max_age).date()
+        q = "SELECT MAX(%s) FROM %s" % (self.ID_COL, self.TABLE_NAME)
+        last_id = self.connection.execute(q).fetchone()[0]
+        if last_id is None:
+            return 0
+        q = "DELETE FROM %s WHERE %s IN (SELECT %s FROM %s WHERE %s < ?)"
+        q %= (self.TRIALS_TABLE_NAME, self.SESSION_COL, self.ID_COL,
+              self.TABLE_NAME, self.DATE_COL)
+        self.connection.execute(q, (end,))
+        weighted = "SUM(%%s * %s) / SUM(%s)" % (self.COUNT_COL,
+                                                 self.COUNT_COL)
+        # sessions of unknown noise are left out of its weights
+        noise = "SUM(%s * %s) / SUM(CASE WHEN %s IS NULL THEN 0 ELSE %s END)"
+        noise %= (self.NOISE_COL, self.COUNT_COL, self.NOISE_COL,
+                  self.COUNT_COL)
+        cols = [self.DATE_COL, self.LEVEL_COL, self.POSITION_COL,
+                self.SHAPE_COL, self.SUCCESS_COL, self.COUNT_COL,
+                self.NOISE_COL, self.SESSIONS_COL]
+        # days rolled up already are skipped unless sessions were added
+        q = "INSERT INTO %s (%s) SELECT MIN(%s), %s, %s, %s, %s, SUM(%s)," \
+            " %s, SUM(%s) FROM %s WHERE %s < ?" \
+            " GROUP BY date(%s), %s HAVING COUNT(*) > 1"
+        q %= (self.TABLE_NAME, ", ".join(cols), self.DATE_COL,
+              self.LEVEL_COL, weighted % self.POSITION_COL,
+              weighted % self.SHAPE_COL, weighted % self.SUCCESS_COL,
+              self.COUNT_COL, noise, self.SESSIONS_COL,
+              self.TABLE_NAME, self.DATE_COL, self.DATE_COL, self.LEVEL_COL)
+        added = self.connection.execute(q, (end,)).rowcount
+        # rows rolled up into the new ones (with higher ids), the new row
+        # of the same level and day is looked up in the level index
+        q = "DELETE FROM %(table)s WHERE %(id)s <= ? AND %(date)s < ? AND" \
+            " EXISTS (SELECT 1 FROM %(table)s AS rolled WHERE" \
+            " rolled.%(level)s = %(table)s.%(level)s AND" \
+            " rolled.%(date)s >= date(%(table)s.%(date)s) AND" \
+            " rolled.%(date)s < date(%(table)s.%(date)s, '+1 day') AND" \
+            " rolled.%(id)s > ?)"
+        q %= {"table": self.TABLE_NAME, "id": self.ID_COL,
+              "date": self.DATE_COL, "level": self.LEVEL_COL}
+        deleted = self.connection.execute(q, (last_id, end,
+                                              last_id)).rowcount
+        self.connection.commit()
+        self.cache.invalidate()
+        return deleted - added
+
+    @retry_when_locked
+    def vacuum(self):
+        """Return free pages to the file system. Databases created with
+        other auto vacuum mode are rebuilt by the first vacuum."""
+        mode = self.connection.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if mode == INCREMENTAL_VACUUM:
+            self.connection.execute("PRAGMA incremental_vacuum").fetchall()
+        else:
+            self.connection.execute("PRAGMA auto_vacuum = %d"
+                                    % INCREMENTAL_VACUUM)
+            self.connection.execute("VACUUM")
+
+
+class TestStatisticsWriter(unittest.TestCase):
+    TEST_ITEM = [3, 0.8, 0.9, 0.7, 20]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, Statistics.DB_NAME)
+        self.writer = StatisticsWriter(self.db_name)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _count(self, table=Statistics.TABLE_NAME):
+        stats = Statistics(self.db_name)
+        q = "SELECT COUNT(*) FROM %s" % table
+        count = stats.connection.execute(q).fetchone()[0]
+        stats.connection.close()
+        return count
+
+    def test_wal(self):
+        stats = Statistics(self.db_name)
+        mode = stats.connection.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+
+    def test_flush(self):
+        self.writer.start()
+        trials = [(0, 0.0, 1, 2, None, None, None, None)]
+        for _ in xrange(5):
+            self.writer.add(*self.TEST_ITEM, trials=trials)
+        self.writer.flush()
+        self.assertEqual(self._count(), 5)
+        self.assertEqual(self._count(Statistics.TRIALS_TABLE_NAME), 5)
+
+    def test_batched_commit(self):
+        # sessions queued before the thread starts are written at once
+        for _ in xrange(3):
+            self.writer.add(*self.TEST_ITEM)
+        self.writer.start()
+        self.writer.flush()
+        self.assertEqual(self.writer.commits, 1)
+        self.assertEqual(self._count(), 3)
+
+    def test_on_commit(self):
+        stats = Statistics(self.db_name)
+        self.assertEqual(stats.played_levels(), set())
+        self.writer.on_commit = stats.cache.invalidate
+        self.writer.start()
+        self.writer.add(*self.TEST_ITEM)
+        self.writer.flush()
+        self.assertEqual(stats.played_levels(), {3})
+
+    def test_bad_result(self):
+        """Only the bad result of a batch is lost, the thread survives"""
+        # results are queued before the thread starts -> one batch
+        self.writer.add(*self.TEST_ITEM)
+        self.writer.add(*self.TEST_ITEM, trials=[5])
+        self.writer.add(*self.TEST_ITEM, trials=[(0,)])
+        self.writer.add(*self.TEST_ITEM)
+        self.writer.start()
+        self.writer.flush()
+        self.assertTrue(self.writer.is_alive())
+        self.assertEqual(self._count(), 2)
+        self.assertEqual(self._count(Statistics.TRIALS_TABLE_NAME), 0)
+
+    def test_compact(self):
+        self.writer.start()
+        for hour in [8, 9, 10]:
+            self.writer.add(*self.TEST_ITEM,
+                            date=datetime.datetime(2000, 1, 1, hour))
+        self.writer.add(*self.TEST_ITEM)
+        self.writer.compact(datetime.timedelta(days=30))
+        self.writer.flush()
+        self.assertEqual(self._count(), 2)
+        stats = Statistics(self.db_name)
+        self.assertEqual(stats.connection.execute(
+            "PRAGMA auto_vacuum").fetchone()[0], INCREMENTAL_VACUUM)
+        stats.connection.close()
+
+    def test_close(self):
+        self.writer.start()
+        self.writer.add(*self.TEST_ITEM)
+        self.writer.close()
+        self.assertFalse(self.writer.is_alive())
+        self.assertEqual(self._count(), 1)
+        # closing twice does nothing
+        self.writer.close()
+
+
+class TestConcurrentWriters(unittest.TestCase):
+    PROCESSES = 4
+    SESSIONS = 50
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, Statistics.DB_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_retry(self):
+        stats = Statistics(self.db_name)
+        locked = lite.OperationalError("database is locked")
+        with mock.patch.object(Statistics, "_insert",
+                               side_effect=[locked, None]) as insert, \
+                mock.patch("time.sleep") as sleep:
+            stats.add(3, 0.8, 0.9, 0.7, 20)
+        self.assertEqual(insert.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+
+    def test_no_retry_of_other_errors(self):
+        stats = Statistics(self.db_name)
+        error = lite.OperationalError("no such table: statistics")
+        with mock.patch.object(Statistics, "_insert", side_effect=error):
+            self.assertRaises(lite.OperationalError, stats.add,
+                              3, 0.8, 0.9, 0.7, 20)
+
+    def test_no_lost_writes(self):
+        """All processes write sessions with the same timestamp"""
+        sessions, elapsed = stress(self.db_name, self.PROCESSES,
+                                   self.SESSIONS)
+        self.assertEqual(sessions, self.PROCESSES * self.SESSIONS)
+        stats = Statistics(self.db_name)
+        q = "SELECT COUNT(*) FROM %s" % stats.TABLE_NAME
+        self.assertEqual(stats.connection.execute(q).fetchone()[0],
+                         sessions)
+
+
+def _hammer(task):
+    """Add sessions one by one, every one in its own transaction"""
+    db_name, sessions, date = task
+    stats = Statistics(db_name)
+    for _ in xrange(sessions):
+        stats.add(3, 0.8, 0.9, 0.7, 20, date=date)
+    stats.connection.close()
+    return sessions
+
+
+def stress(db_name, processes, sessions):
+    """Every process adds given count of sessions at once, returns count
+    of added sessions and elapsed time"""
+    # migrations run before processes start
+    Statistics(db_name).connection.close()
+    date = datetime.datetime.now()
+    pool = multiprocessing.Pool(processes)
+    begin = time.time()
+    try:
+        added = pool.map(_hammer, [(db_name, sessions, date)] * processes)
+    finally:
+        pool.close()
+        pool.join()
+    return sum(added), time.time() - begin
+
+
+class StatisticsWriter(threading.Thread):
+    """Writes game results in a background thread, so the caller does not
+    wait for the disk. The thread owns its own connection, results
+    waiting in the queue are written in one transaction."""
+
+    MAX_BATCH = 64
+    # queue item requesting the thread to stop
+    _STOP = object()
+
+    def __init__(self, db_name=Statistics.DB_NAME, on_commit=None):
+        """on_commit is called from the writer thread after every commit"""
+        super(StatisticsWriter, self).__init__(name="StatisticsWriter")
+        self.daemon = True
+        self.db_name = db_name
+        self.on_commit = on_commit
+        self.commits = 0
+        self._queue = Queue.Queue()
+        self._closed = False
+
+    @set_date_if_not_set
+    def add(self, level, position, shape, success, item_count, date=None,
+            trials=None, noise=None):
+        """Same as Statistics.add, returns immediately"""
+        if trials is not None:
+            trials = list(trials)
+        self._queue.put((level, position, shape, success, item_count, date,
+                         trials, noise))
+
+    def compact(self, max_age):
+        """Same as Statistics.compact, runs after results added so far"""
+        self._queue.put(max_age)
+
+    def flush(self):
+        """Block until everything added so far is committed, the thread
+        must be running"""
+        barrier = threading.Event()
+        self._queue.put(barrier)
+        barrier.wait()
+
+    def close(self):
+        """Write remaining results and stop the thread"""
+        if self._closed:
+            return
+        self._closed = True
+        if self.is_alive():
+            self._queue.put(self._STOP)
+            self.join()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while batch[-1] is not self._STOP and len(batch) < self.MAX_BATCH:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        stats = Statistics(self.db_name)
+        running = True
+        while running:
+            barriers = []
+            results = []
+            compactions = []
+            for item in self._next_batch():
+                if item is self._STOP:
+                    running = False
+                elif isinstance(item, tuple):
+                    results.append(item)
+                elif isinstance(item, datetime.timedelta):
+                    compactions.append(item)
+                else:
+                    barriers.append(item)
+            if results:
+                self._store(stats, results)
+                self._committed()
+            for max_age in compactions:
+                try:
+                    removed = stats.compact(max_age)
+                    Logger.info("Statistics: %s rows rolled up" % removed)
+                except Exception:
+                    Logger.exception("Statistics: cannot compact database")
+                self._committed()
+                # rows are committed already, vacuum is retried on its own
+                try:
+                    stats.vacuum()
+                except Exception:
+                    Logger.exception("Statistics: cannot vacuum database")
+            for barrier in barriers:
+                barrier.set()
+        stats.connection.close()
+
+    def _store(self, stats, results):
+        """Errors do not stop the thread, failed batch is stored result by
+        result so only the bad results are lost"""
+        try:
+            stats.add_many(results)
+            self.commits += 1
+        except Exception:
+            if len(results) == 1:
+                Logger.exception("Statistics: cannot store result %s"
+                                 % (results[0][:6],))
+                return
+            Logger.warning("Statistics: cannot store %s results at once,"
+                           " storing them one by one" % len(results))
+            for result in results:
+                self._store(stats, [result])
+
+    def _committed(self):
+        if self.on_commit is None:
+            return
+        try:
+            self.on_commit()
+        except Exception:
+            Logger.exception("Statistics: on_commit callback failed")
+
+
+class TestStatisticsLoader(unittest.TestCase):
+    TEST_ITEM = [3, 0.8, 0.9, 0.7, 20]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, Statistics.DB_NAME)
+        Statistics(self.db_name).add(*self.TEST_ITEM)
+        # scheduled callbacks are run by the test instead of kivy clock
+        self.scheduled = Queue.Queue()
+        self.loader = StatisticsLoader(self.db_name,
+                                       schedule=self.scheduled.put)
+        self.loader.start()
+
+    def tearDown(self):
+        self.loader.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _run_scheduled(self):
+        self.scheduled.get(timeout=5)(0)
+
+    def test_load(self):
+        results = []
+        self.loader.request("rates", lambda stats: stats.success_rates(),
+                            results.append)
+        self._run_scheduled()
+        self.assertEqual(results, [[0.7]])
+        self.assertNotEqual(self.loader.ident,
+                            threading.current_thread().ident)
+
+    def test_latest_request_wins(self):
+        started = threading.Event()
+        release = threading.Event()
+        ran = []
+        results = []
+
+        def query(value, block=False):
+            def run(stats):
+                ran.append(value)
+                if block:
+                    started.set()
+                    release.wait()
+                return value
+            return run
+
+        self.loader.request("level", query(1, block=True), results.append)
+        started.wait()
+        # requested while the first one runs, only the last one is run
+        self.loader.request("level", query(2), results.append)
+        self.loader.request("level", query(3), results.append)
+        release.set()
+        self._run_scheduled()
+        self._run_scheduled()
+        self.assertEqual(ran, [1, 3])
+        self.assertEqual(results, [3])
+
+    def test_interrupted(self):
+        """Running query is interrupted by newer request of the key"""
+        started = threading.Event()
+        results = []
+
+        def endless(stats):
+            started.set()
+            q = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1" \
+                " FROM c) SELECT COUNT(*) FROM c"
+            return stats.connection.execute(q).fetchone()
+
+        self.loader.request("level", endless, results.append)
+        started.wait()
+        self.loader.request("level", lambda stats: 2, results.append)
+        while not results:
+            self._run_scheduled()
+        self.assertEqual(results, [2])
+
+    def test_error(self):
+        """Callback gets None when query fails, loader keeps running"""
+        results = []
+        self.loader.request("rates", lambda stats: 1 / 0, results.append)
+        self._run_scheduled()
+        self.loader.request("rates", lambda stats: 1, results.append)
+        self._run_scheduled()
+        self.assertEqual(results, [None, 1])
+
+    def test_cancel(self):
+        results = []
+        self.loader.request("rates", lambda stats: 1, results.append)
+        self.loader.cancel("rates")
+        self.loader.request("other", lambda stats: 2, results.append)
+        # cancelled request could be run already, its result is dropped
+        while not results:
+            self._run_scheduled()
+        self.loader.close()
+        while not self.scheduled.empty():
+            self._run_scheduled()
+        self.assertEqual(results, [2])
+
+
+class StatisticsLoader(threading.Thread):
+    """Runs statistics queries in a background thread with its own
+    connection, so the UI does not wait for the disk. Results are passed
+    to callbacks in the main thread. Only the latest request of every key
+    is run, results of older requests are dropped and their running query
+    is interrupted."""
+
+    # sqlite virtual machine instructions between superseded checks
+    PROGRESS_STEPS = 1000
+
+    def __init__(self, db_name=Statistics.DB_NAME, cache=None,
+                 schedule=None):
+        """cache is shared with other Statistics objects (so it can be
+        invalidated by their writes), schedule(fn) has to call fn(dt)
+        in the main thread, kivy clock is used by default"""
+        super(StatisticsLoader, self).__init__(name="StatisticsLoader")
+        self.daemon = True
+        self.db_name = db_name
+        self.cache = cache
+        self.schedule = schedule or Clock.schedule_once
+        self._condition = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._generations = collections.defaultdict(int)
+        self._closed = False
+        # key of the running query, its sqlite statements are aborted by
+        # the progress handler once the query is superseded
+        self._running = None
+        self._superseded = False
+
+    def request(self, key, query, callback):
+        """query(stats) is run in the loader thread, callback(result) in
+        the main thread (result is None if the query failed), previous
+        request of the key is cancelled"""
+        with self._condition:
+            self._interrupt(key)
+            self._generations[key] += 1
+            self._pending[key] = (self._generations[key], query, callback)
+            self._condition.notify()
+
+    def cancel(self, key):
+        with self._condition:
+            self._interrupt(key)
+            self._generations[key] += 1
+            self._pending.pop(key, None)
+
+    def _interrupt(self, key):
+        # the condition must be held, running key changes under it
+        if self._running == key:
+            self._superseded = True
+
+    def _progress(self):
+        # non zero return value interrupts the running statement
+        return self._superseded
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
+
+    def _deliver(self, key, generation, callback, result, *largs):
+        # newer request could come while the result waited for the clock
+        with self._condition:
+            if self._generations[key] != generation:
+                return
+        callback(result)
+
+    def run(self):
+        stats = Statistics(self.db_name)
+        if self.cache is not None:
+            stats.cache = self.cache
+        stats.connection.set_progress_handler(self._progress,
+                                              self.PROGRESS_STEPS)
+        while True:
+            with self._condition:
+                self._running = None
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    break
+                key, (generation, query, callback) = \
+                    self._pending.popitem(last=False)
+                self._running = key
+                self._superseded = False
+            try:
+                result = query(stats)
+            except Exception:
+                # result of superseded query is dropped by _deliver anyway
+                if not self._superseded:
+                    Logger.exception("Statistics: cannot load %s" % (key,))
+                result = None
+            self.schedule(functools.partial(self._deliver, key, generation,
+                                            callback, result))
+        stats.connection.close()
 
 
 def round_up(num):
@@ -341,6 +1606,8 @@ class SuccessGraph(object):
 
     X_MAJOR_TICKS_SCALE = 8.0
 
+    LOADING_TEXT = "Loading..."
+
     def __init__(self):
         self._plot = MeshLinePlot(color=self.PLOT_LINE_COLOR)
         self._graph = Graph(xlabel=self.X_LABEL, ylabel=self.Y_LABEL,
@@ -349,9 +1616,15 @@ class SuccessGraph(object):
                             y_grid_label=True, x_grid_label=True, padding=10,
                             xmin=0, ymin=0, ymax=self.Y_MAX_VAL,
                             xmax=self.HISTORY_MAX)
+        # placeholder is displayed over the graph while points are loaded
+        self._placeholder = Label(text=self.LOADING_TEXT)
+        self._view = AnchorLayout(anchor_x='center', anchor_y='center')
+        self._view.add_widget(self._graph)
         self.level = None
-        self.stats = App.get_running_app().stats
-        self.display_level(self.DEFAULT_LEVEL)
+        app = App.get_running_app()
+        self.stats = app.stats
+        self.loader = app.stats_loader
+        self._view.add_widget(self._placeholder)
         self._graph.add_plot(self._plot)
 
     def display_level(self, level):
@@ -359,18 +1632,39 @@ class SuccessGraph(object):
             self.level = None
         else:
             self.level = int(level)
-        success_rates = self.stats.success_rates(self.level)
-        # limit items to last HISTROY_MAX items
-        success_rates = success_rates[-self.HISTORY_MAX:]
-        self._plot.points = [(x, y) for x, y in enumerate(success_rates)]
-        points_count = len(success_rates)
+        self._plot.points = []
+        if self._placeholder.parent is None:
+            self._view.add_widget(self._placeholder)
+        # points are loaded in background, request of other level
+        # cancels the one in flight
+        self.loader.request(self, functools.partial(self._load_points,
+                                                    self.level),
+                            self._show_points)
+
+    def _load_points(self, level, stats):
+        """Runs in the loader thread, whole history is downsampled to at
+        most HISTORY_MAX points"""
+        success_rates = stats.success_series(level, points=self.HISTORY_MAX)
+        return [(x, y) for x, y in enumerate(success_rates)]
+
+    def _show_points(self, points):
+        self._view.remove_widget(self._placeholder)
+        if points is None:
+            # loading failed, it is logged by the loader
+            points = []
+        self._plot.points = points
+        points_count = len(points)
         self._graph.xmax = points_count
 
         self._graph.x_ticks_major = round_up(points_count /
                                              self.X_MAJOR_TICKS_SCALE)
 
+    def cancel(self):
+        """Drop points which are being loaded"""
+        self.loader.cancel(self)
+
     def get_view(self):
-        return self._graph
+        return self._view
 
     def clear_statistics(self, *largs):
         """Delete actually selected statistics"""
@@ -435,8 +1729,8 @@ class StatisticsScreen(BasicScreen):
         info_label = Label(text=self.STATISTICS_INFO_TEXT,
                            font_size=self.STATISTICS_INFO_FONT_SIZE)
 
+        # values are set by refresh
         self.spinner = Spinner(text=SuccessGraph.DEFAULT_LEVEL,
-                               values=self._get_spinner_choices(),
                                size_hint=self.SPINNER_SIZE_HINT)
 
         clear_btn = Button(text=self.CLEAR_BTN_TEXT,
@@ -461,7 +1755,7 @@ class StatisticsScreen(BasicScreen):
 
         return box_layout
 
-    def on_enter(self, *args):
+    def build(self):
         box_layout = BoxLayout(orientation="vertical")
         for widget in [self._build_heading_view(),
                        self._build_statistics_view()]:
@@ -470,7 +1764,16 @@ class StatisticsScreen(BasicScreen):
         anchor_layout.add_widget(box_layout)
         self.add_widget(anchor_layout)
 
+    def refresh(self):
+        """Overall progress is displayed on every enter"""
+        self.spinner.values = self._get_spinner_choices()
+        if self.spinner.text == SuccessGraph.DEFAULT_LEVEL:
+            self.graph.display_level(SuccessGraph.DEFAULT_LEVEL)
+        else:
+            # displayed by the spinner callback
+            self.spinner.text = SuccessGraph.DEFAULT_LEVEL
+
     def on_leave(self, *args):
-        self.clear_widgets()
+        self.graph.cancel()
 
 # eof
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Timeline of session events computed from the session start.
+
+Every deadline is an absolute time so late firing of one event does not
+shift the following ones (timing errors do not accumulate)."""
+
+__author__ = 'Tomas Novacik'
+
+import collections
+import numpy
+import unittest
+
+ONSET = "onset"
+CLEAR = "clear"
+EVALUATE = "evaluate"
+FINISH = "finish"
+
+# order of events with the same deadline
+PRIORITIES = {CLEAR: 0, EVALUATE: 1, FINISH: 2, ONSET: 3}
+
+Event = collections.namedtuple("Event", ["deadline", "kind", "trial"])
+
+
+class TestTimeline(unittest.TestCase):
+    START = 100.0
+    TRIALS = 4
+    HISTORY = 2
+    STEP = 2.0
+    DISPLAY = 1.0
+    EVALUATE_INTERVAL = 0.3
+    LEAD_IN = 0.5
+
+    def setUp(self):
+        self.timeline = Timeline(self.START, self.TRIALS, self.HISTORY,
+                                 self.STEP, self.DISPLAY,
+                                 self.EVALUATE_INTERVAL, self.LEAD_IN)
+
+    def _events(self, kind):
+        return [e for e in self.timeline.events if e.kind == kind]
+
+    def test_events(self):
+        onsets = self._events(ONSET)
+        self.assertEqual([e.deadline for e in onsets],
+                         [100.5, 102.5, 104.5, 106.5])
+        self.assertEqual([e.deadline for e in self._events(CLEAR)],
+                         [101.5, 103.5, 105.5, 107.5])
+        evaluations = self._events(EVALUATE)
+        self.assertEqual([e.trial for e in evaluations], [2, 3])
+        self.assertEqual([e.deadline for e in evaluations], [106.2, 108.2])
+        self.assertEqual(self.timeline.events[-1],
+                         Event(108.5, FINISH, None))
+
+    def test_sorted(self):
+        deadlines = [e.deadline for e in self.timeline.events]
+        self.assertEqual(deadlines, sorted(deadlines))
+
+    def test_same_deadline_order(self):
+        timeline = Timeline(0, 2, 1, 1.0, 1.0, 0, 0)
+        kinds = [e.kind for e in timeline.events if e.deadline == 1.0]
+        self.assertEqual(kinds, [CLEAR, ONSET])
+        kinds = [e.kind for e in timeline.events if e.deadline == 2.0]
+        self.assertEqual(kinds, [CLEAR, EVALUATE, FINISH])
+
+    def test_due(self):
+        self.assertEqual(self.timeline.due(self.START), [])
+        self.assertEqual(self.timeline.next_deadline(), 100.5)
+        due = self.timeline.due(102.6)
+        self.assertEqual([e.kind for e in due], [ONSET, CLEAR, ONSET])
+        self.assertEqual(self.timeline.next_deadline(), 103.5)
+        errors = self.timeline.errors[:3]
+        self.assertTrue(numpy.allclose(errors, [2.1, 1.1, 0.1]))
+        self.assertTrue(numpy.isnan(self.timeline.errors[3:]).all())
+
+    def test_finished(self):
+        self.timeline.due(1000)
+        self.assertTrue(self.timeline.finished)
+        self.assertEqual(self.timeline.next_deadline(), None)
+        self.assertEqual(self.timeline.due(1001), [])
+
+    def test_error_summary(self):
+        self.timeline.due(100.6)
+        self.timeline.due(101.5)
+        summary = self.timeline.error_summary()
+        self.assertEqual(summary[CLEAR], (0, 0))
+        self.assertAlmostEqual(summary[ONSET][0], 0.1)
+        self.assertFalse(EVALUATE in summary)
+
+
+class Timeline(object):
+    """Deadlines of all events of one session.
+
+    Trial k is displayed at start + lead_in + k * step_duration, cleared
+    display_duration later and (when there are 'history' trials before
+    it) evaluated evaluate_interval before the next onset. The session
+    finishes when the step of the last trial ends."""
+
+    def __init__(self, start, trials, history, step_duration,
+                 display_duration, evaluate_interval, lead_in=0):
+        self.start = start
+        events = []
+        for trial in xrange(trials):
+            onset = start + lead_in + trial * step_duration
+            events.append(Event(onset, ONSET, trial))
+            events.append(Event(onset + display_duration, CLEAR, trial))
+            if trial >= history:
+                events.append(Event(onset + step_duration - evaluate_interval,
+                                    EVALUATE, trial))
+        events.append(Event(start + lead_in + trials * step_duration, FINISH,
+                            None))
+        events.sort(key=lambda e: (e.deadline, PRIORITIES[e.kind]))
+        self.events = events
+        # actual - scheduled time of every fired event
+        self.errors = numpy.empty(len(events))
+        self.errors.fill(numpy.nan)
+        self._next = 0
+
+    @property
+    def finished(self):
+        return self._next >= len(self.events)
+
+    def next_deadline(self):
+        if self.finished:
+            return None
+        return self.events[self._next].deadline
+
+    def due(self, now):
+        """Returns events which deadline has passed and were not returned
+        yet, their timing errors are recorded"""
+        due = []
+        while not self.finished and self.events[self._next].deadline <= now:
+            event = self.events[self._next]
+            self.errors[self._next] = now - event.deadline
+            due.append(event)
+            self._next += 1
+        return due
+
+    def error_summary(self):
+        """Returns {kind: (mean error, max error)} of fired events"""
+        summary = {}
+        for kind in PRIORITIES:
+            errors = [self.errors[i] for i, e in enumerate(self.events)
+                      if e.kind == kind and i < self._next]
+            if errors:
+                summary[kind] = (numpy.mean(errors), numpy.max(errors))
+        return summary
+
+# eof
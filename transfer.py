@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""Export and import of played sessions as CSV or JSON Lines.
+
+usage: python transfer.py export DB FILE
+       python transfer.py import DB FILE [FILE ...]
+
+Format is given by file extension (.csv or .jsonl). Import skips sessions
+which are in the database already, so data of many devices can be merged
+repeatedly."""
+
+__author__ = 'Tomas Novacik'
+
+import os
+# command line arguments belong to the script, not to kivy
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+
+import argparse
+import csv
+import datetime
+import json
+import shutil
+import tempfile
+import unittest
+
+from statistics import Statistics
+
+CSV = ".csv"
+JSONL = ".jsonl"
+
+# conversion of text values of imported columns
+COLUMN_TYPES = {Statistics.DATE_COL: str, Statistics.LEVEL_COL: int,
+                Statistics.POSITION_COL: float, Statistics.SHAPE_COL: float,
+                Statistics.SUCCESS_COL: float, Statistics.COUNT_COL: int,
+                Statistics.NOISE_COL: float, Statistics.SESSIONS_COL: int}
+
+
+class TestTransfer(unittest.TestCase):
+    SESSIONS = [(3, 0.8, 0.9, 0.7, 20, datetime.datetime(2000, 1, 1), 0.5),
+                (4, 0.5, 0.6, 0.1 + 0.2, 21,
+                 datetime.datetime(2000, 1, 2, 10, 30, 0, 1), None),
+                (4, 0.5, 0.6, 0.2, 21, datetime.datetime(2000, 1, 3), 0.3)]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stats = self._stats("source")
+        for level, position, shape, success, count, date, noise in \
+                self.SESSIONS:
+            self.stats.add(level, position, shape, success, count, date,
+                           noise=noise)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _stats(self, name):
+        return Statistics(os.path.join(self.tmp_dir, name + ".sqlite3"))
+
+    def _round_trip(self, extension):
+        path = os.path.join(self.tmp_dir, "sessions" + extension)
+        self.assertEqual(export_sessions(self.stats, path), 3)
+        target = self._stats("target" + extension)
+        self.assertEqual(import_sessions(target, path, chunk_size=2), 3)
+        self.assertEqual(list(target.iter_sessions()),
+                         list(self.stats.iter_sessions()))
+        # importing the same data again adds nothing
+        self.assertEqual(import_sessions(target, path), 0)
+        self.assertEqual(len(list(target.iter_sessions())), 3)
+
+    def test_csv(self):
+        self._round_trip(CSV)
+
+    def test_jsonl(self):
+        self._round_trip(JSONL)
+
+    def test_merge(self):
+        path = os.path.join(self.tmp_dir, "sessions" + CSV)
+        export_sessions(self.stats, path)
+        target = self._stats("target")
+        target.add(5, 0.1, 0.1, 0.1, 10, datetime.datetime(2001, 1, 1))
+        self.assertEqual(import_sessions(target, path), 3)
+        self.assertEqual(target.played_levels(), {3, 4, 5})
+
+    def test_old_format(self):
+        """Files exported before compaction have no sessions column"""
+        path = os.path.join(self.tmp_dir, "old" + CSV)
+        with open(path, "wb") as f:
+            f.write("date,level,position,shape,success,count,noise\n"
+                    "2000-01-01 00:00:00,3,0.8,0.9,0.7,20,\n")
+        target = self._stats("target")
+        self.assertEqual(import_sessions(target, path), 1)
+        self.assertEqual(list(target.iter_sessions()),
+                         [("2000-01-01 00:00:00", 3, 0.8, 0.9, 0.7, 20,
+                           None, 1)])
+
+    def test_compacted(self):
+        """Days rolled up in one of the databases are not duplicated"""
+        copy = self._stats("copy")
+        copy.import_sessions(self.stats.iter_sessions())
+        self.stats.add(4, 0.5, 0.6, 0.4, 21,
+                       datetime.datetime(2000, 1, 2, 12), noise=0.3)
+        self.stats.compact(datetime.timedelta(days=1),
+                           datetime.datetime(2001, 1, 1))
+        self.assertEqual(copy.import_sessions(self.stats.iter_sessions()), 0)
+        self.assertEqual(self.stats.import_sessions(copy.iter_sessions()), 0)
+        # rolled up days keep their sessions count
+        target = self._stats("target")
+        path = os.path.join(self.tmp_dir, "sessions" + CSV)
+        export_sessions(self.stats, path)
+        self.assertEqual(import_sessions(target, path), 3)
+        day = datetime.datetime(2000, 1, 2)
+        self.assertEqual(target.daily_summary(day),
+                         self.stats.daily_summary(day))
+        self.assertEqual(target.daily_summary(day).sessions, 2)
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, export_sessions, self.stats,
+                          os.path.join(self.tmp_dir, "sessions.txt"))
+
+
+def _format(path):
+    extension = os.path.splitext(path)[1]
+    if extension not in (CSV, JSONL):
+        raise ValueError("Unknown format of %s, use %s or %s files."
+                         % (path, CSV, JSONL))
+    return extension
+
+
+def _csv_value(value):
+    """Floats are written with full precision, None as empty string"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return repr(value)
+    return value
+
+
+def export_sessions(stats, path):
+    """Write all sessions into the file, returns count of sessions"""
+    extension = _format(path)
+    count = 0
+    cols = Statistics.TRANSFER_COLS
+    with open(path, "wb") as f:
+        if extension == CSV:
+            writer = csv.writer(f)
+            writer.writerow(cols)
+            for session in stats.iter_sessions():
+                writer.writerow([_csv_value(value) for value in session])
+                count += 1
+        else:
+            for session in stats.iter_sessions():
+                f.write(json.dumps(dict(zip(cols, session))) + "\n")
+                count += 1
+    return count
+
+
+def _read_csv(f):
+    reader = csv.reader(f)
+    header = next(reader)
+    types = [COLUMN_TYPES[col] for col in header]
+    # columns missing in files of older versions are unknown
+    order = [header.index(col) if col in header else None
+             for col in Statistics.TRANSFER_COLS]
+    for row in reader:
+        values = [convert(value) if value else None
+                  for convert, value in zip(types, row)]
+        yield tuple(None if i is None else values[i] for i in order)
+
+
+def _read_jsonl(f):
+    for line in f:
+        if line.strip():
+            session = json.loads(line)
+            yield tuple(session.get(col)
+                        for col in Statistics.TRANSFER_COLS)
+
+
+def import_sessions(stats, path, chunk_size=None):
+    """Insert sessions from the file which are not in the database yet,
+    returns count of inserted sessions"""
+    read = _read_csv if _format(path) == CSV else _read_jsonl
+    kwargs = {} if chunk_size is None else {"chunk_size": chunk_size}
+    with open(path, "rb") as f:
+        return stats.import_sessions(read(f), **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command")
+    export_parser = subparsers.add_parser("export")
+    export_parser.add_argument("db")
+    export_parser.add_argument("file")
+    import_parser = subparsers.add_parser("import")
+    import_parser.add_argument("db")
+    import_parser.add_argument("files", nargs="+")
+    args = parser.parse_args()
+    stats = Statistics(args.db)
+    if args.command == "export":
+        print("Exported %s sessions" % export_sessions(stats, args.file))
+    else:
+        for path in args.files:
+            print("%s: imported %s sessions"
+                  % (path, import_sessions(stats, path)))
+
+
+if __name__ == '__main__':
+    main()
+
+# eof